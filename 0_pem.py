@@ -1,20 +1,41 @@
-import subprocess
+# pem.py - Convierte la FIEL (.cer/.key en DER) a cert.pem y fiel.pem, en proceso y sin
+# archivos temporales, para todos los clientes de clientes/ en paralelo
+import argparse
+import hashlib
 import os
-import shutil
-import yaml
-import string
-
-def load_config():
-    with open("config.yml", encoding="utf-8") as f:
-        raw = f.read()
-        prelim = yaml.safe_load(raw)
-        vars_dict = {
-            "cliente_rfc": prelim["cliente_rfc"],
-            "base_path": f"clientes/{prelim['cliente_rfc']}"
-        }
-        template = string.Template(raw)
-        substituted = template.safe_substitute(vars_dict)
-        return yaml.safe_load(substituted)
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.config import CLIENTES_DIR, load_config
+from utils.lazy import lazy_import
+from utils.signer import pem_a_der
+
+x509 = lazy_import("cryptography.x509")
+serialization = lazy_import("cryptography.hazmat.primitives.serialization")
+
+# Mismo formato que dejaba openssl pkcs12 -clcerts -nokeys (el BinarySecurityToken
+# de 1_auth.py se arma con el contenido completo de cert.pem)
+FRIENDLY_NAME = "miFIEL"
+
+# Nombres cortos con los que openssl imprime subject= / issuer=
+NOMBRES_CORTOS = {
+    "2.5.4.3": "CN",
+    "2.5.4.4": "SN",
+    "2.5.4.5": "serialNumber",
+    "2.5.4.6": "C",
+    "2.5.4.7": "L",
+    "2.5.4.8": "ST",
+    "2.5.4.9": "street",
+    "2.5.4.10": "O",
+    "2.5.4.11": "OU",
+    "2.5.4.12": "title",
+    "2.5.4.17": "postalCode",
+    "2.5.4.41": "name",
+    "2.5.4.42": "GN",
+    "2.5.4.45": "x500UniqueIdentifier",
+    "1.2.840.113549.1.9.1": "emailAddress",
+    "1.2.840.113549.1.9.2": "unstructuredName",
+}
+_ESPECIALES = set(',+"\\<>;')
 
 def es_formato_pem(file_path):
     with open(file_path, 'rb') as f:
@@ -36,103 +57,155 @@ def buscar_archivo_por_extension(directorio, extension):
         raise ValueError(f"⚠️ Se encontró más de un archivo con extensión {extension} en {directorio}. Solo debe haber uno.")
     return os.path.join(directorio, archivos[0])
 
-def convertir_clave_privada_der_cifrada(key_path, key_pem, pfx_pass):
-    temp_pem = key_pem + ".tmp"
+def _valor_oneline(valor):
+    # Escapado de openssl -nameopt oneline: comillas si hay caracteres especiales o
+    # espacios en los extremos; bytes de control y no ASCII (UTF-8) como \XX
+    comillas = valor[:1] in (" ", "#") or valor[-1:] == " " or any(c in _ESPECIALES for c in valor)
+    texto = ""
+    for b in valor.encode("utf-8"):
+        c = chr(b)
+        if b > 0x7f or b < 0x20:
+            texto += "\\%02X" % b
+        elif c == "\\" or (c == '"' and comillas):
+            texto += "\\" + c
+        else:
+            texto += c
+    return f'"{texto}"' if comillas else texto
+
+def nombre_oneline(nombre):
+    rdns = []
+    for rdn in nombre.rdns:
+        rdns.append(" + ".join(f"{NOMBRES_CORTOS.get(a.oid.dotted_string, a.oid.dotted_string)} = "
+                               f"{_valor_oneline(a.value if isinstance(a.value, str) else a.value.hex())}"
+                               for a in rdn))
+    return ", ".join(rdns)
+
+def cert_pem_con_atributos(cert_der):
+    # Bag Attributes + subject/issuer + bloque PEM, como el cert.pem que generaba openssl
+    cert = x509.load_der_x509_certificate(cert_der)
+    local_key_id = "".join(f"{b:02X} " for b in hashlib.sha1(cert_der).digest())
+    encabezado = (f"Bag Attributes\n"
+                  f"    friendlyName: {FRIENDLY_NAME}\n"
+                  f"    localKeyID: {local_key_id}\n"
+                  f"subject={nombre_oneline(cert.subject)}\n"
+                  f"issuer={nombre_oneline(cert.issuer)}\n")
+    return encabezado.encode() + cert.public_bytes(serialization.Encoding.PEM)
+
+def llave_pem(key_bytes, password):
+    # .key del SAT: PKCS#8 DER cifrado → PKCS#8 PEM sin cifrar (lo que daba openssl rsa)
+    if key_bytes.lstrip().startswith(b"-----BEGIN"):
+        try:
+            serialization.load_pem_private_key(key_bytes, None)
+            return key_bytes
+        except TypeError:
+            # PEM cifrado
+            llave = serialization.load_pem_private_key(key_bytes, password.encode())
+    else:
+        llave = serialization.load_der_private_key(key_bytes, password.encode())
+    return llave.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                               serialization.NoEncryption())
+
+def _huella_publica(llave_o_cert):
+    publica = llave_o_cert.public_key()
+    return hashlib.sha256(publica.public_bytes(serialization.Encoding.DER,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)).hexdigest()
+
+def pems_vigentes(cert_der, cert_pem, key_pem):
+    # cert.pem trae el mismo certificado que el .cer y fiel.pem es la llave de ese certificado
     try:
-        # Paso 1: DER cifrado → PEM cifrado
-        subprocess.run([
-            "openssl", "pkcs8",
-            "-inform", "DER",
-            "-in", key_path,
-            "-out", temp_pem,
-            "-passin", f"pass:{pfx_pass}"
-        ], check=True)
-
-        # Paso 2: PEM cifrado → PEM sin cifrar (RSA)
-        subprocess.run([
-            "openssl", "rsa",
-            "-in", temp_pem,
-            "-out", key_pem
-        ], check=True)
-
-        os.remove(temp_pem)
-        print(f"✅ Clave privada convertida: {key_pem}")
-
-    except subprocess.CalledProcessError as e:
-        print("❌ Error al convertir clave privada:")
-        print(e)
-        raise
-
-def convertir_y_generar_desde_config():
-    config = load_config()
+        with open(cert_pem, "rb") as f:
+            if pem_a_der(f.read()) != cert_der:
+                return False
+        with open(key_pem, "rb") as f:
+            llave = serialization.load_pem_private_key(f.read(), None)
+    except (FileNotFoundError, ValueError, TypeError):
+        return False
+    return _huella_publica(llave) == _huella_publica(x509.load_der_x509_certificate(cert_der))
+
+def escribir_privado(path, contenido):
+    # Directo al archivo final con permisos 600 desde su creación
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(contenido)
+    os.chmod(path, 0o600)
+
+def convertir_cliente(rfc, forzar=False):
+    # Regresa "convertido" u "omitido"; los errores se propagan
+    config = load_config(rfc)
     certificados_dir = os.path.join(config["base_path"], "certificados")
-
-    pfx_pass = leer_password_desde_txt(config["pfx_password_path"])
     cer_path = buscar_archivo_por_extension(certificados_dir, ".cer")
     key_path = buscar_archivo_por_extension(certificados_dir, ".key")
-
     cert_pem = os.path.join(certificados_dir, "cert.pem")
     key_pem = os.path.join(certificados_dir, "fiel.pem")
-    pfx_tmp = os.path.join(certificados_dir, "tmp_cert.pfx")
-    final_pem = os.path.join(certificados_dir, "cert_expandido.pem")
 
-    try:
-        # Convertir certificado
-        subprocess.run([
-            'openssl', 'x509',
-            '-inform', 'DER',
-            '-in', cer_path,
-            '-out', cert_pem
-        ], check=True)
-        print(f"✅ Certificado convertido: {cert_pem}")
-
-        # Convertir clave privada
-        if es_formato_pem(key_path):
-            shutil.copyfile(key_path, key_pem)
-            print(f"🔁 Clave ya estaba en PEM. Copiada como: {key_pem}")
-        else:
-            convertir_clave_privada_der_cifrada(key_path, key_pem, pfx_pass)
-
-        # Generar archivo PFX temporal
-        subprocess.run([
-            'openssl', 'pkcs12',
-            '-export',
-            '-inkey', key_pem,
-            '-in', cert_pem,
-            '-name', 'miFIEL',
-            '-out', pfx_tmp,
-            '-passout', f'pass:{pfx_pass}'
-        ], check=True)
-        print(f"📦 PFX generado: {pfx_tmp}")
-
-        # Extraer cert_expandido.pem con Bag Attributes
-        subprocess.run([
-            'openssl', 'pkcs12',
-            '-in', pfx_tmp,
-            '-out', final_pem,
-            '-clcerts',
-            '-nokeys',
-            '-passin', f'pass:{pfx_pass}'
-        ], check=True)
-        
-        # Renombrar cert_expandido.pem → cert.pem (reemplaza el anterior)
-        os.replace(final_pem, cert_pem)
-        print(f"✅ Se renombró {final_pem} como {cert_pem}")
-
-        # Eliminar archivo temporal pfx
-        os.remove(pfx_tmp)
-
-        # Proteger archivos
-        for path in [cert_pem, key_pem]:
-            os.chmod(path, 0o600)
-
-
-    except subprocess.CalledProcessError as e:
-        print("❌ Error al ejecutar OpenSSL:")
-        print(e)
-    except Exception as ex:
-        print(f"❌ Error inesperado: {ex}")
+    with open(cer_path, "rb") as f:
+        cert_der = f.read()
+    if es_formato_pem(cer_path):
+        cert_der = pem_a_der(cert_der)
+    if not forzar and pems_vigentes(cert_der, cert_pem, key_pem):
+        return "omitido"
+
+    with open(key_path, "rb") as f:
+        key_bytes = f.read()
+    password = leer_password_desde_txt(config["pfx_password_path"])
+    llave = llave_pem(key_bytes, password)
+    if _huella_publica(serialization.load_pem_private_key(llave, None)) != \
+            _huella_publica(x509.load_der_x509_certificate(cert_der)):
+        raise ValueError(f"❌ {os.path.basename(key_path)} no corresponde a {os.path.basename(cer_path)}")
+
+    escribir_privado(key_pem, llave)
+    escribir_privado(cert_pem, cert_pem_con_atributos(cert_der))
+    return "convertido"
+
+def clientes_con_fiel(clientes_dir=CLIENTES_DIR):
+    # RFCs con certificados/ que tengan .cer y .key
+    rfcs = []
+    for nombre in sorted(os.listdir(clientes_dir)) if os.path.isdir(clientes_dir) else []:
+        cert_dir = os.path.join(clientes_dir, nombre, "certificados")
+        if os.path.isdir(cert_dir) and any(f.lower().endswith(".cer") for f in os.listdir(cert_dir)) \
+                and any(f.lower().endswith(".key") for f in os.listdir(cert_dir)):
+            rfcs.append(nombre)
+    return rfcs
+
+def convertir_clientes(rfcs, workers=None, forzar=False):
+    # Convierte en paralelo; regresa {rfc: "convertido" | "omitido" | "error: ..."}
+    resultados = {}
+    with ThreadPoolExecutor(max_workers=workers or min(32, len(rfcs) or 1)) as pool:
+        futuros = {pool.submit(convertir_cliente, rfc, forzar): rfc for rfc in rfcs}
+        for futuro in as_completed(futuros):
+            rfc = futuros[futuro]
+            try:
+                resultados[rfc] = futuro.result()
+            except Exception as e:
+                resultados[rfc] = f"error: {e}"
+    return resultados
+
+def convertir_y_generar_desde_config():
+    # Compatibilidad: solo el cliente de config.yml
+    estado = convertir_cliente(load_config()["cliente_rfc"])
+    print(f"✅ {estado}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Conversión de la FIEL (.cer/.key) a PEM")
+    parser.add_argument("--rfc", nargs="*", help="Solo estos RFCs (por defecto todos los de clientes/)")
+    parser.add_argument("--workers", type=int, help="Clientes convertidos al mismo tiempo")
+    parser.add_argument("--forzar", action="store_true", help="Convertir aunque los PEM ya estén al día")
+    args = parser.parse_args()
+
+    rfcs = args.rfc or ([os.environ["SAT_RFC"]] if os.environ.get("SAT_RFC") else clientes_con_fiel())
+    if not rfcs:
+        print("❌ No hay clientes con .cer y .key en clientes/")
+        return
+
+    inicio = time.perf_counter()
+    resultados = convertir_clientes(rfcs, args.workers, args.forzar)
+    for rfc in rfcs:
+        estado = resultados[rfc]
+        icono = {"convertido": "✅", "omitido": "🔁"}.get(estado, "❌")
+        print(f"{icono} {rfc}: {estado}")
+    convertidos = sum(1 for r in resultados.values() if r == "convertido")
+    print(f"\n{convertidos} convertidos, {len(rfcs)} clientes en {time.perf_counter() - inicio:.2f}s")
 
 # Ejecutar
 if __name__ == "__main__":
-    convertir_y_generar_desde_config()
+    main()
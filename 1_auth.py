@@ -1,53 +1,53 @@
 # auth.py - Autenticación
-import yaml
-import requests
-from lxml import etree
+from utils import metricas
+from utils.config import load_config
+from utils.http import post_sat
+from utils.lazy import lazy_import
 from utils.signer import build_soap_envelope, sign_envelope
-import string
-import os
-
-def load_config():
-    with open("config.yml", encoding="utf-8") as f:
-        raw = f.read()
-        prelim = yaml.safe_load(raw)
-        vars_dict = {
-            "cliente_rfc": prelim["cliente_rfc"],
-            "base_path": f"clientes/{prelim['cliente_rfc']}"
-        }
-        template = string.Template(raw)
-        substituted = template.safe_substitute(vars_dict)
-        return yaml.safe_load(substituted)
-
-def get_token():
-    config = load_config()
-    env, ts, sec, bst_id = build_soap_envelope(config["cer_path"], config["key_path"])
-    signed = sign_envelope(env, ts, sec, config["key_path"], config["cer_path"], bst_id)
+from utils.token_manager import get_token_provider
+
+etree = lazy_import("lxml.etree")
+
+def armar_autenticacion(config):
+    # Sobre firmado listo para enviar y sus encabezados
+    with metricas.cronometro(config, "autenticacion", "armado"):
+        env, ts, sec, bst_id = build_soap_envelope(config["cer_path"], config["key_path"])
+    with metricas.cronometro(config, "autenticacion", "firma"):
+        signed = sign_envelope(env, ts, sec, config["key_path"], config["cer_path"], bst_id)
+        xml_data = etree.tostring(signed, xml_declaration=True, encoding="utf-8")
 
     headers = {
         "Content-Type": "text/xml; charset=utf-8",
         "SOAPAction": config["endpoints"]["autenticacion_action"]
     }
+    return xml_data, headers
+
+def parse_token(config, content):
+    with metricas.cronometro(config, "autenticacion", "parseo"):
+        root = etree.fromstring(content)
+        token = root.find(".//{http://DescargaMasivaTerceros.gob.mx}AutenticaResult")
+    return token.text if token is not None else None
 
-    xml_data = etree.tostring(signed, xml_declaration=True, encoding="utf-8")
-    resp = requests.post(config["endpoints"]["autenticacion"], data=xml_data, headers=headers)
+def get_token(config=None):
+    config = config or load_config()
+    xml_data, headers = armar_autenticacion(config)
+    resp = post_sat(config, config["endpoints"]["autenticacion"], data=xml_data, headers=headers, timeout=60)
 
     if resp.status_code != 200:
         print(f"Error en autenticación: {resp.status_code}")
         print(resp.text)
         raise Exception("Error al autenticar.")
 
-    root = etree.fromstring(resp.content)
-    token = root.find(".//{http://DescargaMasivaTerceros.gob.mx}AutenticaResult")
-    return token.text if token is not None else None
+    return parse_token(config, resp.content)
 
-if __name__ == "__main__":
+def main():
+    metricas.iniciar("auth")
     config = load_config()
-    token = get_token()
+    tokens = get_token_provider(config, fetch=get_token)
+    token = tokens.get()
     print("Token obtenido exitosamente")
-    
-    token_dir = os.path.dirname(config["token_path"])
-    os.makedirs(token_dir, exist_ok=True)
-    
-    with open(config["token_path"], "w", encoding="utf-8") as f:
-        f.write(token)
-    print(f"Token guardado en {config['token_path']}") 
\ No newline at end of file
+    print(f"Token guardado en {config['token_path']} (vigente {int(tokens.expires_in())}s más)")
+
+if __name__ == "__main__":
+    main()
+ 
\ No newline at end of file
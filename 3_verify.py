@@ -1,27 +1,30 @@
 #verify.py - Verificación
-import yaml, string, os
-import requests
-from lxml import etree
-import xmlsec
+import os
+import argparse
+import heapq
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from urllib.parse import unquote
 from datetime import datetime
+from utils import archivos
+from utils.config import load_config
+from utils.historial_db import get_historial
+from utils.http import post_sat
+from utils.lazy import lazy_import
+from utils import control, metricas, plantillas
+from utils.signer import get_signer
+from utils.token_manager import get_token_provider
 
+etree = lazy_import("lxml.etree")
+requests = lazy_import("requests")
 
-def load_config():
-    with open("config.yml", encoding="utf-8") as f:
-        raw = f.read()
-        prelim = yaml.safe_load(raw)
-        vars_dict = {
-            "cliente_rfc": prelim["cliente_rfc"],
-            "base_path": f"clientes/{prelim['cliente_rfc']}"
-        }
-        template = string.Template(raw)
-        substituted = template.safe_substitute(vars_dict)
-        return yaml.safe_load(substituted)
 
 def load_token(config):
-    with open(config["token_path"], encoding="utf-8") as f:
-        return f.read().strip()
+    # Token vigente del RFC; se renueva automáticamente antes de expirar
+    return get_token_provider(config).get()
     
 def load_pending_ids(config):
     try:
@@ -35,64 +38,25 @@ def load_solicitud_id():
         return f.read().strip()
 
 def build_verificacion_xml(config, id_solicitud):
-    NS_SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
-    NS_DESCARGA = "http://DescargaMasivaTerceros.sat.gob.mx"
-    NS_DS = "http://www.w3.org/2000/09/xmldsig#"
-
-    envelope = etree.Element("{%s}Envelope" % NS_SOAP, nsmap={
-        's': NS_SOAP,
-        'ds': NS_DS
-    })
-
-    header = etree.SubElement(envelope, "{%s}Header" % NS_SOAP)
-    body = etree.SubElement(envelope, "{%s}Body" % NS_SOAP)
-
-    verifica = etree.SubElement(body, "{%s}VerificaSolicitudDescarga" % NS_DESCARGA)
-    solicitud = etree.SubElement(verifica, "{%s}solicitud" % NS_DESCARGA)
-    solicitud.set("IdSolicitud", id_solicitud)
-    solicitud.set("RfcSolicitante", config["rfc"])
-
-    return envelope
+    # Clon del sobre prearmado del RFC (utils/plantillas.py) con el IdSolicitud
+    return plantillas.verificacion(config, id_solicitud)
 
 def sign_xml(doc, config):
     solicitud_node = doc.find(".//{http://DescargaMasivaTerceros.sat.gob.mx}solicitud")
     if solicitud_node is None:
         raise Exception("No se encontró el nodo <solicitud> para firmar.")
 
-    signature_node = xmlsec.template.create(
-        solicitud_node,
-        xmlsec.Transform.EXCL_C14N,
-        xmlsec.Transform.RSA_SHA1,
-        ns="ds"
-    )
-
-    solicitud_node.insert(0, signature_node)
-
-    ref = xmlsec.template.add_reference(
-        signature_node,
-        xmlsec.Transform.SHA1,
-        uri=""
-    )
-    xmlsec.template.add_transform(ref, xmlsec.Transform.ENVELOPED)
-
-    key_info = xmlsec.template.ensure_key_info(signature_node)
-    xmlsec.template.add_x509_data(key_info)
-
-    key = xmlsec.Key.from_file(config["key_path"], xmlsec.KeyFormat.PEM)
-    key.load_cert_from_file(config["cer_path"], xmlsec.KeyFormat.CERT_PEM)
-
-    ctx = xmlsec.SignatureContext()
-    ctx.key = key
+    signer = get_signer(config["key_path"], config["cer_path"])
 
     try:
-        ctx.sign(signature_node)
+        signer.sign_enveloped(solicitud_node, "")
     except Exception as e:
         print(f"Error durante la firma: {e}")
         raise
 
-    return etree.tostring(doc, encoding="utf-8", xml_declaration=True, pretty_print=True)
+    return plantillas.serializar(doc)
 
-def send_verificacion_request(xml_bytes, config, token):
+def send_verificacion_request(xml_bytes, config, token, id_solicitud=None):
     clean_token = unquote(token) if '%' in token else token
 
     headers = {
@@ -104,7 +68,7 @@ def send_verificacion_request(xml_bytes, config, token):
     url = config["endpoints"]["verificacion"]
 
     try:
-        response = requests.post(url, data=xml_bytes, headers=headers, timeout=60)
+        response = post_sat(config, url, id_auditoria=id_solicitud, data=xml_bytes, headers=headers, timeout=60)
         print(f"Código de respuesta: {response.status_code}")
 
         if response.status_code == 200:
@@ -120,10 +84,6 @@ def send_verificacion_request(xml_bytes, config, token):
         raise
 
 def parse_verificacion_response(xml_response, config, id_solicitud):
-    with open("respuesta_verificacion.xml", "wb") as f:
-        f.write(xml_response)
-    print("Respuesta guardada en 'respuesta_verificacion.xml'")
-
     try:
         tree = etree.fromstring(xml_response)
         result_nodes = tree.xpath("//*[local-name()='VerificaSolicitudDescargaResult']")
@@ -139,21 +99,24 @@ def parse_verificacion_response(xml_response, config, id_solicitud):
             print(f"Código de estatus: {cod_estatus}")
             print(f"Mensaje: {mensaje}")
             print(f"Número de CFDIs: {numero_cfdis}")
+            metricas.cod_estatus(config, "verificacion", cod_estatus, mensaje, id_solicitud=id_solicitud)
+            metricas.estado_solicitud(config, id_solicitud, estado)
+            control.cod_estatus(config, "verificacion", cod_estatus)
+            # Una solicitud rechazada por límite (5002) frena las solicitudes nuevas del RFC
+            control.cod_estatus(config, "solicitud", result.get("CodigoEstadoSolicitud"))
 
             if estado == "3":
-                paquetes_nodo = tree.xpath("//*[local-name()='IdsPaquetes']")
+                # El SAT regresa un <IdsPaquetes> por paquete (se aceptan también separados por |)
                 paquetes = []
-
-                if paquetes_nodo:
-                    texto = paquetes_nodo[0].text
-                    if texto:
-                        paquetes = [p.strip() for p in texto.split("|") if p.strip()]
+                for nodo in tree.xpath("//*[local-name()='IdsPaquetes']"):
+                    paquetes.extend(p.strip() for p in (nodo.text or "").split("|") if p.strip())
 
                 if paquetes:
-                    os.makedirs(os.path.dirname(config["paquetes_path"]), exist_ok=True)
-                    with open(config["paquetes_path"], "w", encoding="utf-8") as f:
-                        for paquete in paquetes:
-                            f.write(paquete + "\n")
+                    # Se agregan a la cola: otra solicitud lista en la misma corrida no
+                    # debe borrar los paquetes que aún no se descargan
+                    with metricas.cronometro(config, "verificacion", "escritura"):
+                        get_historial(config).registrar_paquetes(config["rfc"], id_solicitud, paquetes)
+                        archivos.agregar_lineas(config["paquetes_path"], paquetes)
                     print(f"Paquetes guardados en {config['paquetes_path']}")
 
                 return {"estado": estado, "paquetes": paquetes}
@@ -168,29 +131,15 @@ def parse_verificacion_response(xml_response, config, id_solicitud):
         return None
     
 def actualizar_historial(config, id_solicitud, nuevo_estado):
-    path = config["historial_path"]
-    if not os.path.exists(path):
-        print(f"(⚠) Historial no encontrado: {path}")
-        return
-
-    actualizado = []
-    with open(path, "r", encoding="utf-8") as f:
-        lineas = f.readlines()
-
-    for linea in lineas:
-        if linea.startswith(id_solicitud + ","):
-            partes = linea.strip().split(",")
-            partes[7] = nuevo_estado  # campo estado
-            if nuevo_estado == "listo_para_descarga":
-                partes[8] = str(datetime.now().date())  # fecha_descarga
-            actualizado.append(",".join(partes) + "\n")
-        else:
-            actualizado.append(linea)
+    actualizar_historial_lote(config, [(id_solicitud, nuevo_estado)])
 
-    with open(path, "w", encoding="utf-8") as f:
-        f.writelines(actualizado)
-
-    print(f"✓ Historial actualizado para {id_solicitud} → {nuevo_estado}")
+def actualizar_historial_lote(config, cambios):
+    # cambios: [(id_solicitud, nuevo_estado)] en una sola transacción
+    if not cambios:
+        return
+    get_historial(config).actualizar_solicitudes(cambios)
+    for id_solicitud, nuevo_estado in cambios:
+        print(f"✓ Historial actualizado para {id_solicitud} → {nuevo_estado}")
 
 def preparar_paths_por_anio(config):
     fecha_inicio = config["fechas"]["inicio"]
@@ -207,44 +156,225 @@ def preparar_paths_por_anio(config):
     return config
 
 
-def main():
-    print("=== Verificación de solicitudes de descarga SAT ===")
-    try:
-        config = load_config()
-        config = preparar_paths_por_anio(config)
-        token = load_token(config)
-        ids = load_pending_ids(config)
-        if not ids:
-            print("No hay solicitudes pendientes.")
-            return
+# parse_verificacion_response escribe archivos fijos (respuesta y paquetes.txt)
+_archivos_lock = threading.Lock()
+
+def verificar_solicitud(config, id_solicitud):
+    print(f"\n→ Verificando Solicitud: {id_solicitud}")
+    with metricas.cronometro(config, "verificacion", "armado"):
+        doc = build_verificacion_xml(config, id_solicitud)
+    with metricas.cronometro(config, "verificacion", "firma"):
+        xml_firmado = sign_xml(doc, config)
+    token = load_token(config)
+    response = send_verificacion_request(xml_firmado, config, token, id_solicitud)
+
+    with _archivos_lock, metricas.cronometro(config, "verificacion", "parseo"):
+        return parse_verificacion_response(response, config, id_solicitud)
+
+def guardar_pendientes(config, ids):
+    archivos.escribir_lineas(config["ids_path"], ids)
+
+# ---------------------------------------------------------------------------
+# Modo poll: verificación continua con intervalos adaptativos
+
+# EstadoSolicitud que ya no van a cambiar (3 = terminada se maneja aparte)
+ESTADOS_FINALES = {"4": "error", "5": "rechazada", "6": "vencida"}
+
+INTERVALO_MIN = 5 * 60
+INTERVALO_MAX = 2 * 60 * 60
+# Tiempo a listo cuando el historial no tiene solicitudes terminadas
+ESTIMADO_DEFAULT = 6 * 60 * 60
+
+def parse_fecha(texto):
+    # Fechas del historial (ISO, con o sin hora); se aceptan también las de historial.csv (02/01/2024)
+    texto = (texto or "").strip()
+    for formato in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+    return None
+
+def cargar_historial(config):
+    # Solicitudes del RFC con "solicitada" y "lista": fecha y hora en que se registraron y
+    # quedaron listas (tabla transiciones; fecha_solicitud y fecha_listo son solo el día)
+    db = get_historial(config)
+    momentos = db.momentos_solicitudes(config["rfc"])
+    historial = {}
+    for fila in db.solicitudes(config["rfc"]):
+        m = momentos.get(fila["id_solicitud"], {})
+        historial[fila["id_solicitud"]] = dict(fila, solicitada=m.get("solicitado"),
+                                               lista=m.get("listo_para_descarga"))
+    return historial
+
+def momento_solicitud(fila):
+    # Segundos epoch del registro de la solicitud; las importadas de historial.csv solo tienen el día
+    fecha = parse_fecha(fila.get("solicitada")) or parse_fecha(fila.get("fecha_solicitud"))
+    return fecha.timestamp() if fecha else None
+
+def estimar_tiempo_listo(historial):
+    # Mediana (en segundos) entre el registro de la solicitud y el momento en que quedó lista.
+    # Solo cuentan las que tienen ambas horas; con días completos la estimación no sirve
+    duraciones = []
+    for fila in historial.values():
+        inicio = parse_fecha(fila.get("solicitada"))
+        listo = parse_fecha(fila.get("lista"))
+        if inicio and listo and listo >= inicio:
+            duraciones.append((listo - inicio).total_seconds())
+
+    if not duraciones:
+        return ESTIMADO_DEFAULT
+    return max(statistics.median(duraciones), INTERVALO_MIN)
+
+def siguiente_intervalo(estado, edad, estimado, revisiones, minimo=INTERVALO_MIN, maximo=INTERVALO_MAX):
+    # edad: segundos desde la solicitud; revisiones: verificaciones sin cambio
+    restante = estimado - edad
+    if estado is None:
+        # Error de red/SAT: backoff exponencial
+        intervalo = minimo * 2 ** min(revisiones, 6)
+    elif restante > 0:
+        # Antes del tiempo estimado se revisa a la mitad de lo que falta
+        intervalo = restante / 2
+    else:
+        # Pasado el estimado: backoff desde el mínimo
+        intervalo = minimo * 2 ** min(revisiones, 6)
+
+    if estado == "2":
+        # En proceso: ya falta poco
+        intervalo /= 2
+
+    intervalo *= random.uniform(0.9, 1.1)
+    return min(max(intervalo, minimo), maximo)
+
+def poll(config, workers=4, minimo=INTERVALO_MIN, maximo=INTERVALO_MAX, max_horas=None):
+    pendientes = load_pending_ids(config)
+    if not pendientes:
+        print("No hay solicitudes pendientes.")
+        return
+
+    historial = cargar_historial(config)
+    estimado = estimar_tiempo_listo(historial)
+    print(f"Tiempo estimado a listo: {estimado / 3600:.1f} h – {len(pendientes)} pendientes")
+
+    limite = time.time() + max_horas * 3600 if max_horas else None
+    ahora = time.time()
+    cola = [(ahora, id_) for id_ in pendientes]   # (siguiente revisión, IdSolicitud)
+    heapq.heapify(cola)
+    revisiones = {id_: 0 for id_ in pendientes}
+    ultimo_estado = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        en_vuelo = {}
+        while cola or en_vuelo:
+            ahora = time.time()
+            vencido = limite is not None and ahora >= limite
+            if vencido and not en_vuelo:
+                print("⏱ Se alcanzó el tiempo máximo de poll.")
+                break
+
+            while not vencido and cola and cola[0][0] <= ahora and len(en_vuelo) < workers:
+                _, id_ = heapq.heappop(cola)
+                en_vuelo[pool.submit(verificar_solicitud, config, id_)] = id_
+
+            if vencido or not cola or len(en_vuelo) >= workers:
+                espera = None   # solo esperar a las verificaciones en curso
+            else:
+                espera = max(0.0, cola[0][0] - ahora)
+                if limite:
+                    espera = min(espera, limite - ahora)
+            if not en_vuelo:
+                time.sleep(espera or 0)
+                continue
+            listos, _ = wait(en_vuelo, timeout=espera, return_when=FIRST_COMPLETED)
+
+            for futuro in listos:
+                id_ = en_vuelo.pop(futuro)
+                try:
+                    result = futuro.result()
+                except Exception as e:
+                    print(f"✗ Error al verificar {id_}: {e}")
+                    metricas.reintento(config, "verificacion", str(e), id_solicitud=id_)
+                    result = None
+                estado = result["estado"] if result else None
+
+                if estado == "3":
+                    actualizar_historial(config, id_, "listo_para_descarga")
+                    pendientes.remove(id_)
+                    guardar_pendientes(config, pendientes)
+                    continue
+                if estado in ESTADOS_FINALES:
+                    print(f"✗ Solicitud {id_} terminó en estado {estado} ({ESTADOS_FINALES[estado]})")
+                    actualizar_historial(config, id_, ESTADOS_FINALES[estado])
+                    pendientes.remove(id_)
+                    guardar_pendientes(config, pendientes)
+                    continue
+
+                if estado is None or estado == ultimo_estado.get(id_):
+                    revisiones[id_] += 1
+                else:
+                    revisiones[id_] = 0
+                ultimo_estado[id_] = estado
+
+                inicio = momento_solicitud(historial.get(id_, {}))
+                edad = time.time() - inicio if inicio else 0
+                intervalo = siguiente_intervalo(estado, edad, estimado, revisiones[id_], minimo, maximo)
+                heapq.heappush(cola, (time.time() + intervalo, id_))
+                print(f"  {id_}: estado {estado} – siguiente revisión en {intervalo / 60:.0f} min")
+
+    print(f"\n Pendientes restantes: {len(pendientes)}")
+
+def verificar_pendientes(config):
+    # Una pasada sobre id_solicitud.txt; regresa los IDs que siguen pendientes
+    ids = load_pending_ids(config)
+    if not ids:
+        print("No hay solicitudes pendientes.")
+        return []
 
-        nuevos_pendientes = []
+    nuevos_pendientes = []
+    listos = []
 
-        for id_solicitud in ids:
-            print(f"\n→ Verificando Solicitud: {id_solicitud}")
+    for id_solicitud in ids:
+        try:
+            result = verificar_solicitud(config, id_solicitud)
 
-            try:
-                doc = build_verificacion_xml(config, id_solicitud)
-                xml_firmado = sign_xml(doc, config)
-                response = send_verificacion_request(xml_firmado, config, token)
+            if result and result["estado"] == "3":
+                listos.append((id_solicitud, "listo_para_descarga"))
+            else:
+                nuevos_pendientes.append(id_solicitud)
 
-                result = parse_verificacion_response(response, config, id_solicitud)
+        except Exception as e:
+            print(f"✗ Error al verificar {id_solicitud}: {e}")
+            nuevos_pendientes.append(id_solicitud)
 
-                if result and result["estado"] == "3":
-                    actualizar_historial(config, id_solicitud, "listo_para_descarga")
-                else:
-                    nuevos_pendientes.append(id_solicitud)
+    actualizar_historial_lote(config, listos)
 
-            except Exception as e:
-                print(f"✗ Error al verificar {id_solicitud}: {e}")
-                nuevos_pendientes.append(id_solicitud)
+    # Reescribe el archivo de pendientes
+    guardar_pendientes(config, nuevos_pendientes)
 
-        # Reescribe el archivo de pendientes
-        with open(config["ids_path"], "w", encoding="utf-8") as f:
-            for id_ in nuevos_pendientes:
-                f.write(id_ + "\n")
+    print(f"\n Pendientes restantes: {len(nuevos_pendientes)}")
+    return nuevos_pendientes
+
+def main():
+    parser = argparse.ArgumentParser(description="Verificación de solicitudes de descarga SAT")
+    parser.add_argument("--poll", action="store_true",
+                        help="Verificar continuamente hasta que no queden pendientes")
+    parser.add_argument("--workers", type=int, default=4, help="Verificaciones en paralelo (modo poll)")
+    parser.add_argument("--intervalo-min", type=int, default=INTERVALO_MIN, help="Segundos mínimos entre revisiones")
+    parser.add_argument("--intervalo-max", type=int, default=INTERVALO_MAX, help="Segundos máximos entre revisiones")
+    parser.add_argument("--max-horas", type=float, help="Tiempo máximo en modo poll")
+    args = parser.parse_args()
+    metricas.iniciar("verify")
+
+    print("=== Verificación de solicitudes de descarga SAT ===")
+    try:
+        config = load_config()
+        config = preparar_paths_por_anio(config)
+
+        if args.poll:
+            poll(config, args.workers, args.intervalo_min, args.intervalo_max, args.max_horas)
+            return
 
-        print(f"\n Pendientes restantes: {len(nuevos_pendientes)}")
+        verificar_pendientes(config)
 
     except Exception as e:
         print(f"✗ Error general: {e}")
@@ -1,146 +1,198 @@
 # c_dwnld.py - Descarga masiva de CFDIs
-import base64
 import os
 import pathlib
-import yaml, string
-import requests
-import xmlsec
-from lxml import etree
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import unquote
 from datetime import datetime
-
-def load_config():
-    with open("config.yml", encoding="utf-8") as f:
-        raw = f.read()
-        prelim = yaml.safe_load(raw)
-        vars_dict = {
-            "cliente_rfc": prelim["cliente_rfc"],
-            "base_path": f"clientes/{prelim['cliente_rfc']}"
-        }
-        template = string.Template(raw)
-        substituted = template.safe_substitute(vars_dict)
-        return yaml.safe_load(substituted)
+from utils import archivos
+from utils.config import load_config
+from utils.historial_db import PAQUETES_POR_DESCARGAR, get_historial
+from utils.http import post_sat
+from utils.lazy import lazy_import
+from utils import control, metricas, plantillas
+from utils.signer import get_signer
+from utils.token_manager import get_token_provider
+from utils.xml_tools import CHUNK_SIZE, stream_descarga
+
+dedup = lazy_import("utils.dedup")
+almacen = lazy_import("utils.almacen")
+reportes = lazy_import("utils.reportes")
 
 def load_token(config):
-    with open(config["token_path"], encoding="utf-8") as f:
-        return f.read().strip()
+    # Token vigente del RFC; se renueva automáticamente antes de expirar
+    return get_token_provider(config).get()
 
 def load_paquetes(config):
-    try:
-        with open(config["paquetes_path"], encoding="utf-8") as f:
-            return [p.strip() for p in f if p.strip()]
-    except FileNotFoundError:
-        return []
-
-def build_descarga_xml(cfg, paquete_id):
-    NS_SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
-    NS_DES  = "http://DescargaMasivaTerceros.sat.gob.mx"
-    NS_DS   = "http://www.w3.org/2000/09/xmldsig#"
-
-    env  = etree.Element("{%s}Envelope" % NS_SOAP,
-                         nsmap={'s': NS_SOAP, 'des': NS_DES, 'ds': NS_DS})
-    body = etree.SubElement(env, "{%s}Body" % NS_SOAP)
-
-    entrada = etree.SubElement(
-        body, "{%s}PeticionDescargaMasivaTercerosEntrada" % NS_DES)
+    return archivos.leer_lineas(config["paquetes_path"])
 
-    pet = etree.SubElement(
-        entrada, "{%s}peticionDescarga" % NS_DES,
-        Id="_0",
-        RfcSolicitante=cfg["rfc"],
-        IdPaquete=paquete_id)
+def paquetes_por_descargar(config):
+    # paquetes.txt más los que la bitácora (historial.db) tiene sin terminar para solicitudes
+    # de este año: una corrida que se cayó a la mitad retoma exactamente esos
+    paquetes = load_paquetes(config)
+    db = get_historial(config)
+    anio = os.path.basename(config["anio_path"])
+    solicitudes = {}
+    for p in db.paquetes(config["rfc"], PAQUETES_POR_DESCARGAR):
+        id_solicitud = p["id_solicitud"]
+        if id_solicitud not in solicitudes:
+            solicitudes[id_solicitud] = db.solicitud(id_solicitud) if id_solicitud else None
+        s = solicitudes[id_solicitud]
+        if s and (s["fecha_inicio"] or "").startswith(anio):
+            paquetes.append(p["id_paquete"])
+    return list(dict.fromkeys(paquetes))
+
+def limpiar_parciales(config):
+    # .part / .dedup que dejó una corrida interrumpida (nunca son un paquete completo)
+    for sobrante in pathlib.Path(config["paquetes_dir"]).glob("*.zip.*"):
+        if sobrante.suffix in (".part", ".dedup"):
+            sobrante.unlink(missing_ok=True)
+
+def ruta_paquete(config, paquete_id):
+    return pathlib.Path(config["paquetes_dir"]) / f"{paquete_id}.zip"
 
-    return env, pet
+def build_descarga_xml(cfg, paquete_id):
+    # Clon del sobre prearmado del RFC (utils/plantillas.py) con el IdPaquete
+    return plantillas.descarga(cfg, paquete_id)
 
 def sign_peticion(node, cfg):
-    sig = xmlsec.template.create(
-        node,
-        xmlsec.Transform.EXCL_C14N,
-        xmlsec.Transform.RSA_SHA1,
-        ns="ds")
-
-    node.insert(0, sig)
-
-    ref = xmlsec.template.add_reference(
-        sig, xmlsec.Transform.SHA1, uri="#_0")
-    xmlsec.template.add_transform(ref, xmlsec.Transform.ENVELOPED)
-
-    ki = xmlsec.template.ensure_key_info(sig)
-    xmlsec.template.add_x509_data(ki)
-
-    key = xmlsec.Key.from_file(cfg["key_path"], xmlsec.KeyFormat.PEM)
-    key.load_cert_from_file(cfg["cer_path"], xmlsec.KeyFormat.CERT_PEM)
-
-    ctx = xmlsec.SignatureContext()
-    ctx.key = key
-    ctx.register_id(node, "Id")
-
-    ctx.sign(sig)
+    signer = get_signer(cfg["key_path"], cfg["cer_path"])
+    signer.sign_enveloped(node, "#_0", id_attr="Id")
     print("✓ Firma digital aplicada al nodo peticionDescarga")
 
-def send_descarga(xml_bytes, cfg, token):
+def send_descarga(xml_bytes, cfg, token, paquete_id=None):
+    # Respuesta en modo streaming: regresa un iterador de bloques del cuerpo HTTP
     headers = {
         "Content-Type": "text/xml; charset=utf-8",
         "SOAPAction": cfg["endpoints"]["descarga_action"],
         "Authorization": f'WRAP access_token="{unquote(token)}"'
     }
     url = cfg["endpoints"]["descarga"]
-    resp = requests.post(url, data=xml_bytes, headers=headers, timeout=120)
+    resp = post_sat(cfg, url, id_auditoria=paquete_id, data=xml_bytes, headers=headers, timeout=120, stream=True)
     print(f"→ HTTP {resp.status_code}")
-    resp.raise_for_status()
+    try:
+        resp.raise_for_status()
+    except Exception:
+        resp.close()
+        raise
+    return _Respuesta(resp)
 
-    with open("respuesta_descarga.xml", "wb") as f:
-        f.write(resp.content)
-    return resp.content
+class _Respuesta:
+    # Bloques del cuerpo; cada uno pasa también al archivo de auditoría (en segundo plano).
+    # close() suelta la conexión y el lugar en la ventana de descargas (utils/control.py),
+    # se haya leído todo o no
 
-def parse_and_save(xml_bytes, paquete_id, config):
-    root = etree.fromstring(xml_bytes)
-    cod = root.xpath("//*[local-name()='respuesta']/@CodEstatus")
-    msg = root.xpath("//*[local-name()='respuesta']/@Mensaje")
-
-    if not cod or cod[0] != "5000":
-        raise RuntimeError(f"SAT devolvió {cod}:{msg}")
-
-    b64 = root.xpath("//*[local-name()='Paquete']/text()")
-    if not b64 or not b64[0].strip():
-        raise RuntimeError("Respuesta 5000 pero Paquete vacío")
-
-    raw = base64.b64decode(b64[0])
-    dest_dir = pathlib.Path(config["paquetes_dir"])
-    dest_dir.mkdir(parents=True, exist_ok=True)
-    fname = dest_dir / f"{paquete_id}.zip"
-    fname.write_bytes(raw)
-    print(f"✓ Paquete guardado → {fname}")
-    
-def marcar_descargado_en_historial(config, paquete_id):
-    path = config["historial_path"]
-    if not os.path.exists(path):
-        print(f"(⚠) Historial no encontrado: {path}")
-        return
-
-    actualizado = []
-    encontrado = False
-
-    with open(path, "r", encoding="utf-8") as f:
-        lineas = f.readlines()
-
-    for linea in lineas:
-        if linea.startswith(paquete_id + ","):
-            partes = linea.strip().split(",")
-            partes[7] = "descargado"
-            partes[8] = str(datetime.now().date())
-            actualizado.append(",".join(partes) + "\n")
-            encontrado = True
-        else:
-            actualizado.append(linea)
+    def __init__(self, resp):
+        self.resp = resp
+
+    def __iter__(self):
+        return iter(self.resp.auditoria.flujo(self.resp.iter_content(chunk_size=CHUNK_SIZE), self.resp.status_code))
 
-    with open(path, "w", encoding="utf-8") as f:
-        f.writelines(actualizado)
+    def close(self):
+        self.resp.close()
+        self.resp.permiso.liberar()
 
-    if encontrado:
-        print(f"✓ Historial actualizado: {paquete_id} marcado como descargado")
-    else:
-        print(f"(⚠) No se encontró {paquete_id} en historial")
+def parse_and_save(xml_bytes, paquete_id, config):
+    # xml_bytes puede ser la respuesta completa o un iterador de bloques (send_descarga);
+    # el base64 de <Paquete> se decodifica por bloques a <id>.zip.part, que solo se renombra
+    # a <id>.zip después de revisar tamaño y CRC. Los CFDI pasan además al almacén por UUID
+    # (utils/almacen.py); con almacen.conservar_zips: false el zip no se guarda. Los de
+    # metadata se concilian en los agregados de reportes (utils/reportes.py).
+    # Regresa (resumen de dedup, (bytes, sha256)).
+    chunks = [xml_bytes] if isinstance(xml_bytes, bytes) else xml_bytes
+
+    fname = ruta_paquete(config, paquete_id)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    parcial = fname.with_name(fname.name + ".part")
+
+    try:
+        # Con streaming el parseo incluye la recepción del cuerpo de la respuesta
+        with metricas.cronometro(config, "descarga", "parseo"), open(parcial, "wb") as out:
+            respuesta, fault, escritos = stream_descarga(chunks, out)
+            out.flush()
+            os.fsync(out.fileno())
+
+        if fault:
+            metricas.cod_estatus(config, "descarga", "fault", fault.get("faultstring"), id_paquete=paquete_id)
+            raise RuntimeError(f"SOAP Fault {fault.get('faultcode')}: {fault.get('faultstring')}")
+
+        cod = respuesta.get("CodEstatus")
+        msg = respuesta.get("Mensaje")
+        metricas.cod_estatus(config, "descarga", cod, msg, id_paquete=paquete_id)
+        control.cod_estatus(config, "descarga", cod)
+        if cod != "5000":
+            raise RuntimeError(f"SAT devolvió {cod}:{msg}")
+
+        if not escritos:
+            raise RuntimeError("Respuesta 5000 pero Paquete vacío")
+
+        # Los CFDI que ya llegaron en otro paquete (ventanas traslapadas) no se guardan de nuevo
+        resumen = None
+        es_cfdi = dedup.es_paquete_cfdi(parcial)
+        if config.get("deduplicar", True) and es_cfdi:
+            with metricas.cronometro(config, "descarga", "dedup"):
+                resumen = dedup.filtrar_paquete(str(parcial), paquete_id, dedup.get_vistos(config))
+
+        # El SAT no informa el tamaño del paquete: un zip cortado se detecta por CRC
+        integridad = archivos.verificar_zip(parcial)
+
+        # Antes de dar el paquete por guardado: si el almacén falla, la descarga se reintenta
+        guardados = None
+        alm = almacen.get_almacen(config) if es_cfdi else None
+        if alm is not None:
+            with metricas.cronometro(config, "descarga", "almacen"):
+                guardados = alm.agregar_paquete(parcial, paquete_id)
+        if alm is not None and not almacen.conservar_zips(config):
+            parcial.unlink()
+        else:
+            archivos.reemplazar(parcial, fname)
+    except BaseException:
+        parcial.unlink(missing_ok=True)
+        raise
+
+    metricas.bytes_descargados(config, paquete_id, escritos)
+
+    # La metadata se concilia en reportes.db en cuanto llega (con el último paquete de la
+    # solicitud, también los faltantes); si falla, el paquete ya está guardado y se aplica
+    # con python reportes.py --actualizar
+    conciliado = None
+    if not es_cfdi:
+        try:
+            with metricas.cronometro(config, "descarga", "reportes"):
+                conciliado = reportes.conciliar_zip(config, fname, paquete_id)
+        except Exception as e:
+            print(f"(⚠) {paquete_id} no entró a los reportes: {e}")
+
+    print(f"✓ Paquete guardado → {fname if fname.exists() else 'almacén'} ({escritos} bytes)")
+    if resumen:
+        print(f"  {resumen['nuevos']} CFDI nuevos, {resumen['duplicados']} duplicados omitidos")
+    if guardados:
+        print(f"  {guardados['nuevos']} CFDI al almacén ({guardados['bytes']} → {guardados['comprimidos']} bytes)")
+    if conciliado and conciliado["cambios"]:
+        print(f"  Reportes: {reportes.resumen_cambios(conciliado)}")
+    return resumen, integridad
+
+def marcar_descargado_en_historial(config, paquete_id, integridad):
+    tamano, sha256 = integridad
+    get_historial(config).terminar_descarga(config["rfc"], paquete_id, tamano, sha256)
+    print(f"✓ Historial actualizado: {paquete_id} marcado como descargado")
+
+def recuperar_existente(config, paquete_id):
+    # Un <id>.zip solo existe si ya pasó la revisión; si la corrida se cayó antes de
+    # anotarlo en el historial, se anota sin volver a descargarlo
+    fname = ruta_paquete(config, paquete_id)
+    if not fname.exists():
+        return False
+    try:
+        integridad = archivos.verificar_zip(fname)
+    except RuntimeError as e:
+        print(f"(⚠) {e}; se descarga de nuevo")
+        fname.replace(fname.with_name(fname.name + ".corrupto"))
+        return False
+    print(f"✓ {paquete_id} ya estaba en {fname}; no se descarga de nuevo")
+    marcar_descargado_en_historial(config, paquete_id, integridad)
+    return True
 
 def preparar_paths_por_anio(config):
     fecha_inicio = config["fechas"]["inicio"]
@@ -156,37 +208,109 @@ def preparar_paths_por_anio(config):
 
     return config
 
-def main():
-    print("=== Descarga masiva de CFDI – Paso 4 ===")
-    config = load_config()
-    config = preparar_paths_por_anio(config)
-    token = load_token(config)
-    paquetes = load_paquetes(config)
+def descargar_paquete(paquete_id, config):
+    if recuperar_existente(config, paquete_id):
+        return None
+    print(f"\nDescargando {paquete_id} …")
+    db = get_historial(config)
+    db.iniciar_descarga(config["rfc"], paquete_id)
+    try:
+        with metricas.cronometro(config, "descarga", "armado"):
+            env, pet = build_descarga_xml(config, paquete_id)
+        with metricas.cronometro(config, "descarga", "firma"):
+            sign_peticion(pet, config)
+            xml_out = plantillas.serializar(env)
+        token = load_token(config)
+        respuesta = send_descarga(xml_out, config, token, paquete_id)
+        try:
+            resumen, integridad = parse_and_save(respuesta, paquete_id, config)
+        finally:
+            respuesta.close()
+    except Exception as e:
+        db.fallo_descarga(paquete_id, e)
+        raise
+    with metricas.cronometro(config, "descarga", "escritura"):
+        marcar_descargado_en_historial(config, paquete_id, integridad)
+    return resumen
+
+def _descargar_con_registro(paquete_id, config):
+    inicio = time.perf_counter()
+    try:
+        resumen = descargar_paquete(paquete_id, config)
+        return {"ok": True, "error": None, "segundos": time.perf_counter() - inicio, "dedup": resumen}
+    except Exception as e:
+        print(f"✗ Error al descargar paquete {paquete_id}: {e}")
+        return {"ok": False, "error": str(e), "segundos": time.perf_counter() - inicio, "dedup": None}
+
+def descargar_paquetes(paquetes, config, workers=1, al_terminar=None):
+    # Descarga cada paquete en su propio hilo (máximo `workers` a la vez);
+    # regresa {paquete_id: {"ok", "error", "segundos", "dedup"}}.
+    # al_terminar(paquete_id, resultado) se llama en este hilo conforme termina cada uno.
+    resultados = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futuros = {pool.submit(_descargar_con_registro, p, config): p for p in paquetes}
+        for futuro in as_completed(futuros):
+            resultados[futuros[futuro]] = futuro.result()
+            if al_terminar:
+                al_terminar(futuros[futuro], resultados[futuros[futuro]])
+    return resultados
+
+def workers_descarga(config, workers=None):
+    if workers:
+        return workers
+    return int(config.get("concurrencia", {}).get("descargas", 1))
+
+def descargar_pendientes(config, workers=None):
+    # Descarga los paquetes de paquetes.txt y los que quedaron a medias; regresa los
+    # resultados por paquete
+    paquetes = paquetes_por_descargar(config)
 
     if not paquetes:
         print("No hay paquetes por descargar.")
-        return
+        return {}
 
-    nuevos_pendientes = []
+    limpiar_parciales(config)
+    workers = workers_descarga(config, workers)
+    print(f"Paquetes: {len(paquetes)} – descargas en paralelo: {workers}")
 
-    for paquete_id in paquetes:
-        print(f"\nDescargando {paquete_id} …")
-        try:
-            env, pet = build_descarga_xml(config, paquete_id)
-            sign_peticion(pet, config)
-            xml_out = etree.tostring(env, encoding="utf-8", xml_declaration=True)
-            respuesta = send_descarga(xml_out, config, token)
-            parse_and_save(respuesta, paquete_id, config)
-            marcar_descargado_en_historial(config, paquete_id)
-        except Exception as e:
-            print(f"✗ Error al descargar paquete {paquete_id}: {e}")
-            nuevos_pendientes.append(paquete_id)
+    # paquetes.txt se reescribe (atómico) al terminar cada paquete, no al final
+    terminados = set()
+
+    def al_terminar(paquete_id, resultado):
+        if resultado["ok"]:
+            terminados.add(paquete_id)
+            archivos.escribir_lineas(config["paquetes_path"],
+                                     [p for p in load_paquetes(config) if p not in terminados])
+
+    resultados = descargar_paquetes(paquetes, config, workers, al_terminar)
+
+    # Se conserva el orden original de paquetes.txt para los pendientes
+    nuevos_pendientes = [p for p in paquetes if not resultados[p]["ok"]]
+    archivos.escribir_lineas(config["paquetes_path"],
+                             list(dict.fromkeys(nuevos_pendientes + [p for p in load_paquetes(config)
+                                                                     if p not in terminados])))
 
-    with open(config["paquetes_path"], "w", encoding="utf-8") as f:
-        for p in nuevos_pendientes:
-            f.write(p + "\n")
+    print("\nResumen por paquete:")
+    for p in paquetes:
+        r = resultados[p]
+        estado = "✓" if r["ok"] else f"✗ {r['error']}"
+        if r["dedup"]:
+            estado += f" {r['dedup']['nuevos']} nuevos / {r['dedup']['duplicados']} duplicados"
+        print(f"  {p}: {estado} ({r['segundos']:.1f}s)")
 
     print(f"\n✓ Descarga completada. Pendientes restantes: {len(nuevos_pendientes)}")
+    return resultados
+
+def main():
+    parser = argparse.ArgumentParser(description="Descarga masiva de CFDI – Paso 4")
+    parser.add_argument("--workers", type=int, help="Paquetes a descargar en paralelo")
+    args = parser.parse_args()
+    metricas.iniciar("dwnld")
+
+    print("=== Descarga masiva de CFDI – Paso 4 ===")
+    config = load_config()
+    config = preparar_paths_por_anio(config)
+    descargar_pendientes(config, args.workers)
 
 
 if __name__ == "__main__":
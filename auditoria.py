@@ -0,0 +1,74 @@
+# auditoria.py - Consulta del archivo de auditoría (utils/auditoria.py): lista las peticiones y
+# respuestas guardadas, muestra o extrae su XML y aplica la retención
+# Uso: python auditoria.py [--rfc RFC] [--servicio verificacion] [--id IdSolicitud|IdPaquete]
+#                          [--desde 2026-01-01] [--hasta 2026-01-31] [--ultimos 50]
+#                          [--mostrar N] [--extraer carpeta] [--purgar]
+import argparse
+import os
+import sys
+from utils.auditoria import get_archivo
+from utils.config import load_config
+
+SERVICIOS = ("autenticacion", "solicitud", "verificacion", "descarga")
+
+
+def imprimir(registros):
+    print(f"{'n':>7} {'fecha':<23} {'rfc':<13} {'servicio':<13} {'tipo':<9} {'status':>6} {'bytes':>10}  id")
+    for r in registros:
+        nota = "  (⚠ incompleta)" if not r["completo"] else ""
+        print(f"{r['id']:>7} {r['fecha']:<23} {r['rfc']:<13} {r['servicio']:<13} {r['tipo']:<9} "
+              f"{r['status'] or '-':>6} {r['bytes']:>10}  {r['id_ref'] or '-'}{nota}")
+
+
+def extraer(archivo, registros, carpeta):
+    os.makedirs(carpeta, exist_ok=True)
+    for r in registros:
+        nombre = f"{r['id']}_{r['servicio']}_{r['tipo']}{'_' + r['id_ref'] if r['id_ref'] else ''}.xml"
+        with open(os.path.join(carpeta, nombre), "wb") as f:
+            f.write(archivo.leer(r))
+    print(f"✓ {len(registros)} registros extraídos en {carpeta}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peticiones y respuestas del SAT archivadas")
+    parser.add_argument("--rfc", help="Solo este RFC")
+    parser.add_argument("--servicio", choices=SERVICIOS)
+    parser.add_argument("--id", help="IdSolicitud o IdPaquete")
+    parser.add_argument("--desde", help="Fecha (AAAA-MM-DD) o fecha y hora ISO")
+    parser.add_argument("--hasta", help="Fecha (AAAA-MM-DD, incluida) o fecha y hora ISO")
+    parser.add_argument("--ultimos", type=int, default=50, help="Máximo de registros (0 = todos)")
+    parser.add_argument("--mostrar", type=int, metavar="N", help="Imprime el XML del registro N")
+    parser.add_argument("--extraer", metavar="CARPETA", help="Guarda el XML de cada registro encontrado")
+    parser.add_argument("--purgar", action="store_true", help="Borra lo que rebasa auditoria.retencion_dias")
+    args = parser.parse_args()
+
+    archivo = get_archivo(load_config())
+    if archivo is None:
+        print("✗ No hay archivo de auditoría: configura auditoria.dir en config.yml")
+        sys.exit(1)
+
+    if args.purgar:
+        borrados = archivo.purgar()
+        print(f"✓ {len(borrados)} segmentos borrados (retención: {archivo.retencion_dias or 'sin límite'} días)")
+        return
+
+    if args.mostrar is not None:
+        registro = archivo.registro(args.mostrar)
+        if registro is None:
+            print(f"✗ No existe el registro {args.mostrar}")
+            sys.exit(1)
+        sys.stdout.buffer.write(archivo.leer(registro) + b"\n")
+        return
+
+    registros = archivo.buscar(args.rfc, args.servicio, args.id, args.desde, args.hasta, args.ultimos)
+    if not registros:
+        print("No hay registros con esos filtros.")
+        return
+    if args.extraer:
+        extraer(archivo, registros, args.extraer)
+    else:
+        imprimir(registros)
+
+
+if __name__ == "__main__":
+    main()
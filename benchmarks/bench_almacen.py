@@ -0,0 +1,106 @@
+# bench_almacen.py - Almacén de CFDI (utils/almacen.py) contra los zips: tamaño en disco,
+# búsqueda de un CFDI por UUID y recorrido completo
+# Uso (desde la raíz del repo): python -m benchmarks.bench_almacen [paquetes] [--tamano-paquete 5MB]
+import argparse
+import os
+import random
+import tempfile
+import time
+import zipfile
+import zstandard as zstd
+from benchmarks import sat_simulado
+from utils.almacen import Almacen
+from utils.config import load_config
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def buscar_en_zips(zips, nombre):
+    # Lo que había que hacer antes: abrir zip por zip hasta dar con el miembro
+    for ruta in zips:
+        with zipfile.ZipFile(ruta) as z:
+            try:
+                return z.read(nombre)
+            except KeyError:
+                continue
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Almacén de CFDI vs zips")
+    parser.add_argument("paquetes", nargs="?", type=int, default=40)
+    parser.add_argument("--tamano-paquete", type=sat_simulado.tamano_en_bytes, default=2 * 1024 * 1024)
+    parser.add_argument("--busquedas", type=int, default=500)
+    args = parser.parse_args()
+
+    config = load_config()
+    simulador = sat_simulado.SimuladorSAT(sat_simulado.rutas_de_config(config),
+                                          tamano_paquete=args.tamano_paquete, semilla=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        zips = []
+        for i in range(args.paquetes):
+            ruta = os.path.join(tmp, f"PAQ_{i:04d}_01.zip")
+            with open(ruta, "wb") as f:
+                f.write(simulador.generar_paquete())
+            zips.append(ruta)
+
+        almacen = Almacen(os.path.join(tmp, "almacen"))
+        inicio = time.perf_counter()
+        for ruta in zips:
+            almacen.agregar_paquete(ruta, os.path.basename(ruta)[:-4])
+        t_alta = time.perf_counter() - inicio
+        almacen.compactar()
+
+        # Tamaños: zip del SAT, cada XML con zstd sin diccionario y el almacén
+        originales = sueltos = 0
+        compresor = zstd.ZstdCompressor(level=6)
+        nombres = []
+        for ruta in zips:
+            with zipfile.ZipFile(ruta) as z:
+                for nombre in z.namelist():
+                    contenido = z.read(nombre)
+                    originales += len(contenido)
+                    sueltos += len(compresor.compress(contenido))
+                    nombres.append((ruta, nombre))
+        en_zips = sum(os.path.getsize(r) for r in zips)
+        info = almacen.info()
+
+        print(f"=== Almacén de CFDI: {info['cfdi']} CFDI en {args.paquetes} paquetes ===")
+        print(f"\n{'formato':<22} {'bytes':>14} {'% del XML':>10}")
+        for titulo, tamano in (("XML sin comprimir", originales), ("zips", en_zips),
+                               ("zstd por XML", sueltos), ("almacén (diccionario)", info["bytes"])):
+            print(f"{titulo:<22} {tamano:>14,} {100 * tamano / originales:>9.1f}%")
+        print(f"\nAlta: {info['cfdi'] / t_alta:,.0f} CFDI/s")
+
+        muestra = random.Random(2).sample(nombres, min(args.busquedas, len(nombres)))
+        print(f"\nBúsqueda por UUID ({len(muestra)} al azar):")
+        print(f"{'':<10} {'p50':>10} {'p95':>10}")
+        for titulo, buscar in (("zips", lambda r, n: buscar_en_zips(zips, n)),
+                               ("almacén", lambda r, n: almacen.obtener(n[:-4]))):
+            tiempos = []
+            for ruta, nombre in muestra:
+                t0 = time.perf_counter()
+                assert buscar(ruta, nombre) is not None
+                tiempos.append((time.perf_counter() - t0) * 1000)
+            print(f"{titulo:<10} {percentil(tiempos, 50):8.3f}ms {percentil(tiempos, 95):8.3f}ms")
+
+        print("\nRecorrido completo:")
+        inicio = time.perf_counter()
+        for ruta in zips:
+            with zipfile.ZipFile(ruta) as z:
+                for nombre in z.namelist():
+                    z.read(nombre)
+        t_zips = time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        for _ in almacen.recorrer():
+            pass
+        t_almacen = time.perf_counter() - inicio
+        for titulo, segundos in (("zips", t_zips), ("almacén", t_almacen)):
+            print(f"{titulo:<10} {originales / segundos / 1e6:8.1f} MB/s de XML")
+
+
+if __name__ == "__main__":
+    main()
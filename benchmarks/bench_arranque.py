@@ -0,0 +1,66 @@
+# bench_arranque.py - Tiempo de arranque de `sat` en corridas sin trabajo (cron)
+# Uso (desde la raíz del repo): python -m benchmarks.bench_arranque [n]
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PESADOS = ("yaml", "lxml.etree", "xmlsec", "requests")
+
+# Lo que cargaba cualquier script antes de hacer nada
+ANTES = [sys.executable, "-c", "import yaml, lxml.etree, xmlsec, requests"]
+
+
+def carpeta_vacia():
+    # config.yml del repo y un cliente sin solicitudes ni paquetes pendientes
+    tmp = tempfile.mkdtemp(prefix="bench_sat_")
+    shutil.copy(os.path.join(RAIZ, "config.yml"), tmp)
+    os.makedirs(os.path.join(tmp, "clientes"))
+    return tmp
+
+
+def medir(nombre, cmd, n, cwd, base=None):
+    env = dict(os.environ, PYTHONPATH=RAIZ)
+    subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, check=True)   # calentamiento
+    tiempos = []
+    for _ in range(n):
+        inicio = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, check=True)
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    mediana = statistics.median(tiempos)
+    extra = f"  (+{mediana - base:.0f} ms sobre python)" if base is not None else ""
+    print(f"{nombre:<26} {mediana:8.1f} ms{extra}")
+    return mediana
+
+
+def modulos_cargados(comando, cwd):
+    codigo = ("import sys; from sat.cli import main; main([%r])\n"
+              "print('PESADOS:' + ','.join(m for m in %r if m in sys.modules))" % (comando, PESADOS))
+    salida = subprocess.run([sys.executable, "-c", codigo], cwd=cwd, env=dict(os.environ, PYTHONPATH=RAIZ),
+                            capture_output=True, text=True, check=True).stdout
+    return salida.rsplit("PESADOS:", 1)[-1].strip()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    tmp = carpeta_vacia()
+    try:
+        print(f"=== Arranque de sat sin trabajo ({n} corridas, mediana) ===")
+        base = medir("python -c pass", [sys.executable, "-c", "pass"], n, tmp)
+        medir("imports de antes", ANTES, n, tmp, base)
+        for comando in ("download", "verify", "status"):
+            medir(f"sat {comando}", [sys.executable, "-m", "sat", comando], n, tmp, base)
+
+        print("\nMódulos pesados cargados:")
+        for comando in ("download", "verify", "status"):
+            print(f"  sat {comando}: {modulos_cargados(comando, tmp) or 'ninguno'}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# bench_firma.py - Firmas por segundo: carga de FIEL por firma vs FielSigner cacheado
+# Uso (desde la raíz del repo): python -m benchmarks.bench_firma [n]
+import sys
+import time
+import yaml
+import xmlsec
+from lxml import etree
+from utils.signer import get_signer
+
+NS_DES = "http://DescargaMasivaTerceros.sat.gob.mx"
+
+
+def rutas_fiel():
+    with open("config.yml", encoding="utf-8") as f:
+        rfc = yaml.safe_load(f)["cliente_rfc"]
+    base = f"clientes/{rfc}/certificados"
+    return rfc, f"{base}/fiel.pem", f"{base}/cert.pem"
+
+
+def nueva_peticion(rfc, i):
+    env = etree.Element("{http://schemas.xmlsoap.org/soap/envelope/}Envelope")
+    return etree.SubElement(env, "{%s}peticionDescarga" % NS_DES,
+                            Id="_0", RfcSolicitante=rfc, IdPaquete=f"PAQ_{i:06d}")
+
+
+def firma_sin_cache(node, key_path, cer_path):
+    # Lo que hacía cada script antes: leer y parsear la FIEL en cada firma
+    sig = xmlsec.template.create(node, xmlsec.Transform.EXCL_C14N,
+                                 xmlsec.Transform.RSA_SHA1, ns="ds")
+    node.insert(0, sig)
+    ref = xmlsec.template.add_reference(sig, xmlsec.Transform.SHA1, uri="#_0")
+    xmlsec.template.add_transform(ref, xmlsec.Transform.ENVELOPED)
+    xmlsec.template.add_x509_data(xmlsec.template.ensure_key_info(sig))
+
+    key = xmlsec.Key.from_file(key_path, xmlsec.KeyFormat.PEM)
+    key.load_cert_from_file(cer_path, xmlsec.KeyFormat.CERT_PEM)
+    ctx = xmlsec.SignatureContext()
+    ctx.key = key
+    ctx.register_id(node, "Id")
+    ctx.sign(sig)
+
+
+def firma_con_cache(node, key_path, cer_path):
+    get_signer(key_path, cer_path).sign_enveloped(node, "#_0", id_attr="Id")
+
+
+def medir(nombre, fn, n, rfc, key_path, cer_path):
+    fn(nueva_peticion(rfc, -1), key_path, cer_path)   # calentamiento
+    inicio = time.perf_counter()
+    for i in range(n):
+        fn(nueva_peticion(rfc, i), key_path, cer_path)
+    total = time.perf_counter() - inicio
+    print(f"{nombre:<14} {n / total:10.1f} firmas/s  ({total / n * 1000:.3f} ms/firma)")
+    return n / total
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rfc, key_path, cer_path = rutas_fiel()
+    print(f"=== Benchmark de firma ({n} peticiones, RFC {rfc}) ===")
+    antes = medir("sin cache", firma_sin_cache, n, rfc, key_path, cer_path)
+    despues = medir("FielSigner", firma_con_cache, n, rfc, key_path, cer_path)
+    print(f"Mejora: x{despues / antes:.2f}")
+
+
+if __name__ == "__main__":
+    main()
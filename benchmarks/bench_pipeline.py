@@ -0,0 +1,272 @@
+# bench_pipeline.py - Peticiones por segundo, latencia (p50/p95/p99) y memoria pico de cada
+# etapa (auth, solicitud, verificación, descarga) contra el SAT simulado, sin tocar el servicio real.
+# Cada etapa corre en su propio proceso para que la memoria pico sea solo la suya.
+# Uso (desde la raíz del repo):
+#   python -m benchmarks.bench_pipeline [--n 50] [--workers 4] [--latencia 0.02] [--tamano-paquete 1MB]
+#   python -m benchmarks.bench_pipeline --guardar base.json     (referencia)
+#   python -m benchmarks.bench_pipeline --comparar base.json    (sale con 1 si hay regresiones)
+#   python -m benchmarks.bench_pipeline --capacidad 8 --workers 32 [--sin-control]
+#                                       (SAT que rechaza con 503 lo que pasa de 8 a la vez)
+import argparse
+import contextlib
+import copy
+import datetime
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+from benchmarks import sat_simulado
+from utils.config import load_config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RAIZ = sat_simulado.RAIZ
+ETAPAS = ("auth", "solicitud", "verificacion", "descarga")
+# Diferencia relativa contra la referencia a partir de la cual se reporta una regresión
+TOLERANCIA = 0.2
+
+
+def preparar_carpeta(config, url, sin_control=False):
+    # config.yml del repo, la FIEL del cliente y un clientes/<RFC>/config.yml que apunta al simulador
+    tmp = tempfile.mkdtemp(prefix="bench_pipeline_")
+    shutil.copy(os.path.join(RAIZ, "config.yml"), tmp)
+    rfc = config["cliente_rfc"]
+    shutil.copytree(os.path.join(RAIZ, "clientes", rfc, "certificados"),
+                    os.path.join(tmp, "clientes", rfc, "certificados"))
+    override = {
+        "endpoints": sat_simulado.endpoints_locales(config, url),
+        "descarga": {"tipo_solicitud": "CFDI"},
+        # Sin límite de peticiones: se mide el cliente, no el token bucket
+        "limites": {"peticiones_por_segundo": None},
+    }
+    if sin_control:
+        override["limites"]["control"] = None
+    with open(os.path.join(tmp, "clientes", rfc, "config.yml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(override, f)
+    return tmp
+
+
+# ---------------------------------------------------------------------------
+# Etapas (proceso hijo, dentro de la carpeta temporal)
+
+def token_previo(modulo, config, intentos=5):
+    # El token se pide antes de medir; con fallas inyectadas se reintenta y, si no se
+    # consigue, las tareas lo piden (y fallan) por su cuenta
+    for _ in range(intentos):
+        try:
+            return modulo.load_token(config)
+        except Exception:
+            continue
+    return None
+
+
+def tareas_auth(config, n):
+    auth = importlib.import_module("1_auth")
+    return [lambda: auth.get_token(config)] * n
+
+
+def tareas_solicitud(config, n):
+    req = importlib.import_module("2_req")
+    token_previo(req, config)
+    tareas = []
+    for i in range(n):
+        # Un día distinto por solicitud para no chocar con la validación de duplicados
+        cfg = copy.deepcopy(config)
+        dia = (datetime.date(2024, 1, 1) + datetime.timedelta(days=i)).isoformat()
+        cfg["fechas"] = {"inicio": dia, "fin": dia}
+        tareas.append(lambda cfg=cfg: req.solicitar(cfg))
+    return tareas
+
+
+def tareas_verificacion(config, n):
+    verify = importlib.import_module("3_verify")
+    token_previo(verify, config)
+    config = verify.preparar_paths_por_anio(config)
+    ids = [s["id_solicitud"] for s in verify.get_historial(config).solicitudes(config["rfc"], ["solicitado"])]
+    return [lambda id_=id_: verify.verificar_solicitud(config, id_) for id_ in ids[:n]]
+
+
+def tareas_descarga(config, n):
+    dwnld = importlib.import_module("4_dwnld")
+    token_previo(dwnld, config)
+    config = dwnld.preparar_paths_por_anio(config)
+    paquetes = [p["id_paquete"] for p in dwnld.get_historial(config).paquetes(config["rfc"], ["pendiente"])]
+    return [lambda p=p: dwnld.descargar_paquete(p, config) for p in paquetes[:n]]
+
+
+TAREAS = {"auth": tareas_auth, "solicitud": tareas_solicitud,
+          "verificacion": tareas_verificacion, "descarga": tareas_descarga}
+
+
+def rss_pico_mb():
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reporta KB; macOS, bytes
+    return pico / (1 << 20) if sys.platform == "darwin" else pico / 1024
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def correr_etapa(etapa, n, workers):
+    config = load_config()
+    latencias, errores = [], []
+
+    def medir(tarea):
+        inicio = time.perf_counter()
+        try:
+            tarea()
+        except Exception as e:
+            errores.append(str(e))
+        latencias.append(time.perf_counter() - inicio)
+
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        tareas = TAREAS[etapa](config, n)
+        rss_base = rss_pico_mb()
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(medir, tareas))
+        total = time.perf_counter() - inicio
+
+    ms = [t * 1000 for t in latencias]
+    return {
+        "etapa": etapa, "n": len(tareas), "errores": len(errores),
+        "por_segundo": len(tareas) / total if total and tareas else 0.0,
+        "p50_ms": percentil(ms, 50), "p95_ms": percentil(ms, 95), "p99_ms": percentil(ms, 99),
+        "rss_mb": rss_pico_mb(), "rss_base_mb": rss_base,
+        "primer_error": errores[0] if errores else None,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Proceso principal: simulador + una corrida por etapa
+
+def lanzar_etapa(etapa, tmp, n, workers):
+    cmd = [sys.executable, "-m", "benchmarks.bench_pipeline", "--etapa", etapa, "--n", str(n),
+           "--workers", str(workers)]
+    salida = subprocess.run(cmd, cwd=tmp, env=dict(os.environ, PYTHONPATH=RAIZ),
+                            capture_output=True, text=True)
+    if salida.returncode != 0:
+        raise RuntimeError(f"La etapa {etapa} terminó con error:\n{salida.stderr}")
+    return json.loads(salida.stdout.rsplit("RESULTADO:", 1)[-1])
+
+
+def _num(valor, formato):
+    return "-" if valor is None else format(valor, formato)
+
+
+def imprimir(resultados):
+    print(f"{'etapa':<13} {'n':>5} {'errores':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'RSS MB':>8}")
+    for r in resultados:
+        print(f"{r['etapa']:<13} {r['n']:>5} {r['errores']:>7} {r['por_segundo']:>9.1f} "
+              f"{_num(r['p50_ms'], '9.1f')} {_num(r['p95_ms'], '9.1f')} {_num(r['p99_ms'], '9.1f')} "
+              f"{_num(r['rss_mb'], '8.1f')}")
+        if r["primer_error"]:
+            print(f"  (⚠) {r['primer_error'][:150]}")
+
+
+def regresiones(resultados, referencia, tolerancia):
+    # Menos req/s, o más p95 o memoria que la referencia por encima de la tolerancia
+    base = {r["etapa"]: r for r in referencia["resultados"]}
+    encontradas = []
+    for r in resultados:
+        b = base.get(r["etapa"])
+        if b is None:
+            continue
+        if b["por_segundo"] and r["por_segundo"] < b["por_segundo"] * (1 - tolerancia):
+            encontradas.append(f"{r['etapa']}: {r['por_segundo']:.1f} req/s (antes {b['por_segundo']:.1f})")
+        for clave, nombre in (("p95_ms", "p95"), ("rss_mb", "RSS")):
+            if b.get(clave) and r.get(clave) and r[clave] > b[clave] * (1 + tolerancia):
+                encontradas.append(f"{r['etapa']}: {nombre} {r[clave]:.1f} (antes {b[clave]:.1f})")
+    return encontradas
+
+
+def opciones(args):
+    # Lo que define la corrida (para comparar solo contra referencias equivalentes)
+    return {k: v for k, v in vars(args).items() if k not in ("guardar", "comparar", "tolerancia", "etapa")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline contra el SAT simulado")
+    parser.add_argument("--n", type=int, default=50, help="Peticiones por etapa")
+    parser.add_argument("--workers", type=int, default=4, help="Peticiones en paralelo")
+    parser.add_argument("--etapas", default=",".join(ETAPAS), help="Etapas a medir, en orden")
+    parser.add_argument("--guardar", help="Guarda los resultados como referencia (JSON)")
+    parser.add_argument("--comparar", help="Compara contra una referencia guardada")
+    parser.add_argument("--tolerancia", type=float, default=TOLERANCIA)
+    parser.add_argument("--sin-control", action="store_true",
+                        help="Sin ventanas adaptativas ni reintentos (limites.control: null)")
+    parser.add_argument("--etapa", choices=ETAPAS, help=argparse.SUPPRESS)   # proceso hijo
+    sat_simulado.agregar_opciones(parser)
+    args = parser.parse_args()
+
+    if args.etapa:
+        print("RESULTADO:" + json.dumps(correr_etapa(args.etapa, args.n, args.workers)))
+        return
+
+    config = load_config()
+    try:
+        simulador = sat_simulado.desde_opciones(config, args)
+    except ValueError as e:
+        parser.error(str(e))
+    url = simulador.iniciar()
+    tmp = preparar_carpeta(config, url, args.sin_control)
+    etapas = [e for e in args.etapas.split(",") if e]
+    try:
+        print(f"=== Pipeline contra SAT simulado ({args.n} por etapa, {args.workers} en paralelo, "
+              f"latencia {args.latencia * 1000:.0f} ms) ===")
+        resultados = []
+        for etapa in etapas:
+            simulador.esperar_paquetes()
+            resultados.append(lanzar_etapa(etapa, tmp, args.n, args.workers))
+    finally:
+        simulador.detener()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    imprimir(resultados)
+    fallas = sum(c["fallas"] for c in simulador.contadores.values())
+    if fallas:
+        print("\nFallas inyectadas: " + ", ".join(f"{s} {c['fallas']}/{c['peticiones']}"
+                                                 for s, c in simulador.contadores.items() if c["peticiones"]))
+    rechazadas = sum(c["rechazadas"] for c in simulador.contadores.values())
+    if rechazadas:
+        print("\nRechazadas por capacidad (HTTP 503): " + ", ".join(
+            f"{s} {c['rechazadas']}" for s, c in simulador.contadores.items() if c["rechazadas"]))
+
+    if args.guardar:
+        with open(args.guardar, "w", encoding="utf-8") as f:
+            json.dump({"opciones": opciones(args), "resultados": resultados}, f, indent=2, ensure_ascii=False)
+        print(f"\n✓ Referencia guardada en {args.guardar}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            referencia = json.load(f)
+        distintas = [k for k, v in opciones(args).items() if referencia["opciones"].get(k) != v]
+        if distintas:
+            print(f"\n(⚠) La referencia se midió con otras opciones: {', '.join(distintas)}")
+        encontradas = regresiones(resultados, referencia, args.tolerancia)
+        if encontradas:
+            print(f"\n✗ Regresiones (tolerancia {args.tolerancia:.0%}):")
+            for r in encontradas:
+                print(f"  {r}")
+            sys.exit(1)
+        print(f"\n✓ Sin regresiones contra {args.comparar}")
+
+
+if __name__ == "__main__":
+    main()
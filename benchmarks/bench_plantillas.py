@@ -0,0 +1,122 @@
+# bench_plantillas.py - Sobres por segundo por servicio: armado desde cero vs plantilla prearmada
+# Uso (desde la raíz del repo): python -m benchmarks.bench_plantillas [n]
+import sys
+import time
+import uuid
+import xmlsec
+from lxml import etree
+from utils import plantillas
+from utils.config import load_config
+from utils.signer import get_signer
+
+NS_SOAP = plantillas.NS_SOAP
+NS_DES = plantillas.NS_DES
+NS_DS = plantillas.NS_DS
+
+
+def plantilla_firma(node, uri):
+    # Lo que hacía sign_enveloped en cada firma
+    sig = xmlsec.template.create(node, xmlsec.Transform.EXCL_C14N,
+                                 xmlsec.Transform.RSA_SHA1, ns="ds")
+    node.insert(0, sig)
+    ref = xmlsec.template.add_reference(sig, xmlsec.Transform.SHA1, uri=uri)
+    xmlsec.template.add_transform(ref, xmlsec.Transform.ENVELOPED)
+    xmlsec.template.add_x509_data(xmlsec.template.ensure_key_info(sig))
+    return sig
+
+
+# Armado de antes: árbol, namespaces y plantilla de firma desde cero + pretty_print
+def solicitud_antes(config, i):
+    env = etree.Element(f"{{{NS_SOAP}}}Envelope", nsmap={
+        "s": NS_SOAP, "wsa": plantillas.NS_WSA, "ds": NS_DS, "ns0": NS_DES})
+    hdr = etree.SubElement(env, f"{{{NS_SOAP}}}Header")
+    etree.SubElement(hdr, f"{{{plantillas.NS_WSA}}}Action").text = \
+        "http://DescargaMasivaTerceros.sat.gob.mx/ISolicitaDescargaService/SolicitaDescargaRecibidos"
+    etree.SubElement(hdr, f"{{{plantillas.NS_WSA}}}To").text = config["endpoints"]["solicitud"]
+    etree.SubElement(hdr, f"{{{plantillas.NS_WSA}}}MessageID").text = f"uuid:{uuid.uuid4()}"
+    body = etree.SubElement(env, f"{{{NS_SOAP}}}Body")
+    op = etree.SubElement(body, f"{{{NS_DES}}}SolicitaDescargaRecibidos")
+    sol = etree.SubElement(op, f"{{{NS_DES}}}solicitud", nsmap={"ds": NS_DS})
+    sol.set("Id", "Solicitud")
+    sol.set("RfcSolicitante", config["rfc"])
+    sol.set("FechaInicial", config["fechas"]["inicio"] + "T00:00:00")
+    sol.set("FechaFinal", config["fechas"]["fin"] + "T23:59:59")
+    sol.set("TipoSolicitud", "CFDI")
+    return env, plantilla_firma(sol, "#Solicitud"), sol
+
+
+def verificacion_antes(config, i):
+    env = etree.Element(f"{{{NS_SOAP}}}Envelope", nsmap={"s": NS_SOAP, "ds": NS_DS})
+    etree.SubElement(env, f"{{{NS_SOAP}}}Header")
+    body = etree.SubElement(env, f"{{{NS_SOAP}}}Body")
+    verifica = etree.SubElement(body, f"{{{NS_DES}}}VerificaSolicitudDescarga")
+    sol = etree.SubElement(verifica, f"{{{NS_DES}}}solicitud")
+    sol.set("IdSolicitud", f"SOL_{i:06d}")
+    sol.set("RfcSolicitante", config["rfc"])
+    return env, plantilla_firma(sol, ""), None
+
+
+def descarga_antes(config, i):
+    env = etree.Element(f"{{{NS_SOAP}}}Envelope", nsmap={"s": NS_SOAP, "des": NS_DES, "ds": NS_DS})
+    body = etree.SubElement(env, f"{{{NS_SOAP}}}Body")
+    entrada = etree.SubElement(body, f"{{{NS_DES}}}PeticionDescargaMasivaTercerosEntrada")
+    pet = etree.SubElement(entrada, f"{{{NS_DES}}}peticionDescarga",
+                           Id="_0", RfcSolicitante=config["rfc"], IdPaquete=f"PAQ_{i:06d}")
+    return env, plantilla_firma(pet, "#_0"), pet
+
+
+# Con plantilla: clonar y llenar
+def solicitud_ahora(config, i):
+    env, _ = plantillas.solicitud(config)
+    sol = env.find(f".//{{{NS_DES}}}solicitud")
+    return env, sol[0], sol
+
+
+def verificacion_ahora(config, i):
+    env = plantillas.verificacion(config, f"SOL_{i:06d}")
+    return env, env.find(f".//{{{NS_DES}}}solicitud")[0], None
+
+
+def descarga_ahora(config, i):
+    env, pet = plantillas.descarga(config, f"PAQ_{i:06d}")
+    return env, pet[0], pet
+
+
+SERVICIOS = {
+    "solicitud": (solicitud_antes, solicitud_ahora),
+    "verificacion": (verificacion_antes, verificacion_ahora),
+    "descarga": (descarga_antes, descarga_ahora),
+}
+
+
+def medir(armar, config, n, signer, pretty_print):
+    firmar = signer is not None
+    armar(config, -1)   # calentamiento (y plantilla armada)
+    inicio = time.perf_counter()
+    for i in range(n):
+        env, sig, nodo = armar(config, i)
+        if firmar:
+            signer.sign(sig, nodo, "Id" if nodo is not None else None)
+        etree.tostring(env, encoding="utf-8", xml_declaration=True, pretty_print=pretty_print)
+    return n / (time.perf_counter() - inicio)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    config = load_config()
+    config["fechas"] = {"inicio": "2024-01-01", "fin": "2024-01-31"}
+    config["descarga"] = {"tipo_solicitud": "CFDI"}
+    signer = get_signer(config["key_path"], config["cer_path"])
+
+    print(f"=== Sobres por segundo ({n} por servicio, RFC {config['rfc']}) ===")
+    for titulo, con_firma in (("Armado + serialización", None), ("Con firma RSA", signer)):
+        print(f"\n{titulo}:")
+        print(f"{'servicio':<14} {'antes':>12} {'plantilla':>12} {'mejora':>8}")
+        for nombre, (antes, ahora) in SERVICIOS.items():
+            t_antes = medir(antes, config, n, con_firma, True)
+            t_ahora = medir(ahora, config, n, con_firma, False)
+            print(f"{nombre:<14} {t_antes:10.0f}/s {t_ahora:10.0f}/s {t_ahora / t_antes:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
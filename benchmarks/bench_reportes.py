@@ -0,0 +1,114 @@
+# bench_reportes.py - Reporte de cierre de mes de todos los clientes: releyendo los zips de
+# metadata contra los agregados de utils/reportes.py (y lo que cuesta mantenerlos), y la
+# conciliación de una foto completa de metadata contra lo guardado
+# Uso (desde la raíz del repo): python -m benchmarks.bench_reportes [clientes] [renglones_por_cliente]
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+from collections import defaultdict
+from decimal import Decimal
+from utils.metadata import COLUMNAS, SEPARADOR, iter_metadata
+from utils.reportes import ReportesDB, _registro, resumen_cambios
+
+RENGLONES_POR_PAQUETE = 50_000
+
+
+def generar_paquetes(base, rfc, renglones, rnd):
+    # Metadata sintética: 12 meses, 500 contrapartes, 3% cancelados
+    carpeta = os.path.join(base, rfc, "2025", "paquetes")
+    os.makedirs(carpeta, exist_ok=True)
+    contrapartes = [f"XAX{i:06d}AA{i % 10}" for i in range(500)]
+    rutas = []
+    for n in range(0, renglones, RENGLONES_POR_PAQUETE):
+        nombre = f"{uuid.uuid4()}_{n // RENGLONES_POR_PAQUETE + 1:02d}".upper()
+        lineas = [SEPARADOR.join(COLUMNAS)]
+        for _ in range(min(RENGLONES_POR_PAQUETE, renglones - n)):
+            emitido = rnd.random() < 0.4
+            otro = rnd.choice(contrapartes)
+            cancelado = rnd.random() < 0.03
+            lineas.append(SEPARADOR.join([
+                str(uuid.uuid4()).upper(), rfc if emitido else otro, "EMISOR", otro if emitido else rfc, "RECEPTOR",
+                "PAC010101AAA", f"2025-{rnd.randint(1, 12):02d}-15 10:00:00", "2025-01-15 10:01:00",
+                f"{rnd.uniform(10, 50000):.2f}", rnd.choice("IIIIEPN"), "0" if cancelado else "1",
+                "2025-12-01 00:00:00" if cancelado else ""]))
+        ruta = os.path.join(carpeta, f"{nombre}.zip")
+        with zipfile.ZipFile(ruta, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(f"{nombre}.txt", "\r\n".join(lineas) + "\r\n")
+        rutas.append(ruta)
+    return rutas
+
+
+def releer(paquetes, periodo):
+    # Lo de antes: leer toda la metadata para sacar un mes
+    totales = defaultdict(lambda: [0, Decimal(0)])
+    for rfc, rutas in paquetes.items():
+        for ruta in rutas:
+            for fila in iter_metadata(ruta):
+                registro = _registro(rfc, fila)
+                if registro[0] == periodo:
+                    total = totales[(rfc, registro[4])]
+                    total[0] += 1
+                    total[1] += registro[5]
+    return totales
+
+
+def main():
+    clientes = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    renglones = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        paquetes = {f"AAA{i:06d}AA{i}": None for i in range(clientes)}
+        for rfc in paquetes:
+            paquetes[rfc] = generar_paquetes(tmp, rfc, renglones, rnd)
+        print(f"=== Reportes: {clientes} clientes x {renglones:,} renglones de metadata ===")
+
+        db = ReportesDB(os.path.join(tmp, "reportes.db"))
+        inicio = time.perf_counter()
+        for rfc, rutas in paquetes.items():
+            for ruta in rutas:
+                db.agregar_paquete(rfc, os.path.basename(ruta)[:-4], iter_metadata(ruta))
+        t_carga = time.perf_counter() - inicio
+        print(f"\nAgregados desde cero: {t_carga:.1f}s ({clientes * renglones / t_carga:,.0f} renglones/s)")
+
+        # Paquete nuevo con cancelaciones de CFDI ya contados (lo que llega día a día)
+        rfc = next(iter(paquetes))
+        nuevos = generar_paquetes(tmp, rfc, RENGLONES_POR_PAQUETE, rnd)
+        inicio = time.perf_counter()
+        db.agregar_paquete(rfc, os.path.basename(nuevos[0])[:-4], iter_metadata(nuevos[0]))
+        print(f"Paquete incremental ({RENGLONES_POR_PAQUETE:,} renglones): {time.perf_counter() - inicio:.2f}s")
+        paquetes[rfc] += nuevos
+
+        inicio = time.perf_counter()
+        releer(paquetes, "2025-06")
+        t_releer = time.perf_counter() - inicio
+        tiempos = []
+        for _ in range(20):
+            inicio = time.perf_counter()
+            db.consultar(["rfc", "estatus"], desde="2025-06", hasta="2025-06")
+            tiempos.append(time.perf_counter() - inicio)
+        t_agregados = sorted(tiempos)[len(tiempos) // 2]
+        print(f"\nCierre de mes, todos los clientes:")
+        print(f"{'releyendo zips':<18} {t_releer * 1000:12.1f} ms")
+        print(f"{'agregados':<18} {t_agregados * 1000:12.1f} ms  ({t_releer / t_agregados:,.0f}x)")
+
+        # Foto nueva de los recibidos del año del primer cliente: 0.5% recién cancelados y 0.1% que
+        # ya no aparecen, conciliada contra lo guardado (y otra vez, sin cambios, como cada día)
+        foto = [fila for ruta in paquetes[rfc] for fila in iter_metadata(ruta) if fila["RfcReceptor"] == rfc]
+        for fila in rnd.sample(foto, len(foto) // 200):
+            fila.update(Estatus="0", FechaCancelacion="2025-12-20 00:00:00")
+        del foto[:len(foto) // 1000]
+        ventana = ("2025-01-01", "2025-12-31 23:59:59", "recibido")
+        print(f"\nConciliación de {len(foto):,} recibidos:")
+        for titulo, rango in (("con cambios", ventana), ("sin cambios", ventana), ("renglón por renglón", None)):
+            inicio = time.perf_counter()
+            resultado = db.conciliar(rfc, [(f"FOTO_{titulo}", foto)], "FOTO", rango)
+            segundos = time.perf_counter() - inicio
+            print(f"{titulo:<20} {segundos * 1000:10.1f} ms  {resumen_cambios(resultado)}")
+
+
+if __name__ == "__main__":
+    main()
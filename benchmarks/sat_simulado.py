@@ -0,0 +1,408 @@
+# sat_simulado.py - Servidor local que imita los cuatro servicios del SAT configurados en
+# config.yml (Autenticacion, SolicitaDescarga, VerificaSolicitudDescarga, Descargar) a partir
+# de las respuestas capturadas en la raíz del repo, con latencia, fallas inyectadas y
+# paquetes del tamaño que se pida.
+# Uso (desde la raíz del repo): python -m benchmarks.sat_simulado [--puerto 8765] [opciones]
+import argparse
+import base64
+import copy
+import datetime
+import io
+import os
+import random
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from lxml import etree
+from utils.config import load_config
+from utils.xml_tools import local_name
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICIOS = ("autenticacion", "solicitud", "verificacion", "descarga")
+
+# Códigos del SAT que se pueden inyectar: mensaje y servicios que los regresan
+CODIGOS = {
+    "5002": ("Se agotó las solicitudes de por vida", ("solicitud", "verificacion")),
+    "5004": ("No se encontró la información", ("verificacion",)),
+    "5005": ("Ya se tiene una solicitud registrada", ("solicitud",)),
+    "5007": ("No existe el paquete solicitado", ("descarga",)),
+    "5008": ("Máximo de descargas permitidas", ("descarga",)),
+}
+FALLAS = ("soap_fault", "http500") + tuple(CODIGOS)
+
+SOAP_FAULT = (
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body><s:Fault>'
+    '<faultcode xmlns:a="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">'
+    'a:InvalidSecurity</faultcode><faultstring xml:lang="es-MX">An error occurred when verifying '
+    'security for the message.</faultstring></s:Fault></s:Body></s:Envelope>').encode()
+
+# No hay captura de Autenticacion: misma forma que la respuesta real
+AUTENTICACION = (
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:u="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd">'
+    '<s:Header><o:Security s:mustUnderstand="1" '
+    'xmlns:o="http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd">'
+    '<u:Timestamp u:Id="_0"><u:Created>{creado}</u:Created><u:Expires>{expira}</u:Expires></u:Timestamp>'
+    '</o:Security></s:Header><s:Body><AutenticaResponse xmlns="http://DescargaMasivaTerceros.gob.mx">'
+    '<AutenticaResult>{token}</AutenticaResult></AutenticaResponse></s:Body></s:Envelope>')
+
+
+def tamano_en_bytes(texto):
+    # "512KB", "5MB", "1.5GB" o bytes
+    texto = str(texto).strip().upper()
+    for sufijo, factor in (("GB", 1 << 30), ("MB", 1 << 20), ("KB", 1 << 10), ("B", 1)):
+        if texto.endswith(sufijo):
+            return int(float(texto[:-len(sufijo)]) * factor)
+    return int(texto)
+
+
+def _leer(nombre):
+    with open(os.path.join(RAIZ, nombre), "rb") as f:
+        return f.read()
+
+
+class SimuladorSAT:
+    # Estado en memoria de solicitudes y paquetes; atender() no depende de HTTP
+
+    def __init__(self, rutas, latencia=0.0, jitter=0.0, fallas=None, tamano_paquete=None,
+                 paquetes_por_solicitud=1, verificaciones_hasta_listo=0, duplicados=0.0, semilla=None,
+                 capacidad=None):
+        self.rutas = rutas                      # path → servicio
+        self.latencia = latencia if isinstance(latencia, dict) else {"*": latencia}
+        self.jitter = jitter
+        self.fallas = fallas or {}              # (servicio | "*", falla) → probabilidad
+        self.tamano_paquete = tamano_paquete
+        self.paquetes_por_solicitud = paquetes_por_solicitud
+        self.verificaciones_hasta_listo = verificaciones_hasta_listo
+        self.duplicados = duplicados
+        self.capacidad = capacidad or {}        # servicio | "*" → peticiones a la vez (más: HTTP 503)
+
+        self._random = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._solicitudes = {}                  # IdSolicitud → {"verificaciones", "paquetes"}
+        self._paquetes = {}                     # IdPaquete → Future con el zip
+        self._generador = ThreadPoolExecutor(max_workers=2, thread_name_prefix="paquetes")
+        self.contadores = {s: {"peticiones": 0, "fallas": 0, "rechazadas": 0} for s in SERVICIOS}
+        self._atendiendo = {s: 0 for s in SERVICIOS}
+
+        self._cargar_capturas()
+
+    # --- capturas -----------------------------------------------------------
+
+    def _cargar_capturas(self):
+        self._captura_solicitud = etree.fromstring(_leer("respuesta_solicitud.xml"))
+        self._captura_verificacion = etree.fromstring(_leer("respuesta_verificacion.xml"))
+
+        # Descarga: se conserva el sobre tal cual y solo se cambia el contenido de <Paquete>
+        descarga = _leer("respuesta_descarga.xml")
+        inicio = descarga.index(b"<Paquete>") + len(b"<Paquete>")
+        fin = descarga.index(b"</Paquete>")
+        self._captura_descarga = (descarga[:inicio], descarga[fin:])
+
+        self._miembros = []
+        with zipfile.ZipFile(io.BytesIO(base64.b64decode(descarga[inicio:fin]))) as z:
+            for nombre in z.namelist():
+                original = nombre.rsplit(".", 1)[0]
+                self._miembros.append((nombre, z.read(nombre), original))
+
+    def generar_paquete(self):
+        # Los CFDI capturados con UUID nuevo (salvo la fracción `duplicados`, que repite el
+        # original) hasta llegar a tamano_paquete; sin tamaño, una vuelta a la captura
+        buf = io.BytesIO()
+        usados = set()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+            i = 0
+            while True:
+                nombre, contenido, original = self._miembros[i % len(self._miembros)]
+                with self._lock:
+                    repetido = self._random.random() < self.duplicados and nombre not in usados
+                usados.add(nombre)
+                if not repetido:
+                    nuevo = str(uuid.uuid4())
+                    contenido = contenido.replace(original.upper().encode(), nuevo.upper().encode()) \
+                                         .replace(original.lower().encode(), nuevo.encode())
+                    nombre = f"{nuevo}.xml"
+                z.writestr(nombre, contenido)
+                i += 1
+                if self.tamano_paquete is None and i >= len(self._miembros):
+                    break
+                if self.tamano_paquete is not None and buf.tell() >= self.tamano_paquete:
+                    break
+        return buf.getvalue()
+
+    def esperar_paquetes(self):
+        # Para que la generación de los zips no se mida como latencia de la descarga
+        with self._lock:
+            pendientes = list(self._paquetes.values())
+        for futuro in pendientes:
+            futuro.result()
+
+    # --- fallas y latencia --------------------------------------------------
+
+    def _falla(self, servicio):
+        with self._lock:
+            for (donde, falla), probabilidad in self.fallas.items():
+                if donde not in ("*", servicio):
+                    continue
+                if falla in CODIGOS and servicio not in CODIGOS[falla][1]:
+                    continue
+                if self._random.random() < probabilidad:
+                    return falla
+        return None
+
+    def _esperar(self, servicio):
+        espera = self.latencia.get(servicio, self.latencia.get("*", 0.0))
+        if self.jitter:
+            with self._lock:
+                espera += self._random.uniform(0, self.jitter)
+        if espera > 0:
+            time.sleep(espera)
+
+    # --- servicios ----------------------------------------------------------
+
+    def atender(self, path, cuerpo):
+        # Regresa (código HTTP, cuerpo de la respuesta)
+        servicio = self.rutas.get(urlparse(path).path.rstrip("/"))
+        if servicio is None:
+            return 404, b"Servicio no encontrado"
+
+        # Como un IIS saturado: lo que pasa de la capacidad se rechaza sin procesar
+        capacidad = self.capacidad.get(servicio, self.capacidad.get("*"))
+        with self._lock:
+            if capacidad is not None and self._atendiendo[servicio] >= capacidad:
+                self.contadores[servicio]["rechazadas"] += 1
+                return 503, b"Server Too Busy"
+            self._atendiendo[servicio] += 1
+        try:
+            return self._atender(servicio, cuerpo)
+        finally:
+            with self._lock:
+                self._atendiendo[servicio] -= 1
+
+    def _atender(self, servicio, cuerpo):
+        self._esperar(servicio)
+        falla = self._falla(servicio)
+        with self._lock:
+            self.contadores[servicio]["peticiones"] += 1
+            if falla:
+                self.contadores[servicio]["fallas"] += 1
+        if falla == "http500":
+            return 500, b"Internal Server Error"
+        if falla == "soap_fault":
+            return 500, SOAP_FAULT
+
+        peticion = etree.fromstring(cuerpo)
+        return 200, getattr(self, f"_{servicio}")(peticion, falla)
+
+    def _autenticacion(self, peticion, falla):
+        creado = datetime.datetime.now(datetime.timezone.utc)
+        token = base64.b64encode(uuid.uuid4().bytes * 8).decode()
+        return AUTENTICACION.format(
+            creado=creado.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            expira=(creado + datetime.timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            token=f"eyJ{token}").encode()
+
+    def _solicitud(self, peticion, falla):
+        sol = peticion.find(".//{http://DescargaMasivaTerceros.sat.gob.mx}solicitud")
+        operacion = local_name(sol.getparent().tag)
+        resp = copy.deepcopy(self._captura_solicitud)
+        result = resp.xpath("//*[local-name()='SolicitaDescargaEmitidosResult']")[0]
+        result.getparent().tag = f"{{{etree.QName(result).namespace}}}{operacion}Response"
+        result.tag = f"{{{etree.QName(result).namespace}}}{operacion}Result"
+        result.set("RfcSolicitante", sol.get("RfcSolicitante", ""))
+
+        if falla:
+            result.attrib.pop("IdSolicitud", None)
+            result.set("CodEstatus", falla)
+            result.set("Mensaje", CODIGOS[falla][0])
+        else:
+            id_solicitud = str(uuid.uuid4())
+            with self._lock:
+                self._solicitudes[id_solicitud] = {"verificaciones": 0, "paquetes": []}
+            result.set("IdSolicitud", id_solicitud)
+        return etree.tostring(resp)
+
+    def _verificacion(self, peticion, falla):
+        sol = peticion.find(".//{http://DescargaMasivaTerceros.sat.gob.mx}solicitud")
+        id_solicitud = sol.get("IdSolicitud", "")
+        resp = copy.deepcopy(self._captura_verificacion)
+        result = resp.xpath("//*[local-name()='VerificaSolicitudDescargaResult']")[0]
+
+        if falla:
+            result.set("EstadoSolicitud", "5")
+            result.set("CodigoEstadoSolicitud", falla)
+            result.set("Mensaje", CODIGOS[falla][0])
+            return etree.tostring(resp)
+
+        with self._lock:
+            # Solicitudes que no pasaron por este servidor (p. ej. tras reiniciarlo) se aceptan igual
+            estado = self._solicitudes.setdefault(id_solicitud, {"verificaciones": 0, "paquetes": []})
+            estado["verificaciones"] += 1
+            listo = estado["verificaciones"] > self.verificaciones_hasta_listo
+            if listo and not estado["paquetes"]:
+                estado["paquetes"] = [f"{id_solicitud.upper()}_{i:02d}"
+                                      for i in range(1, self.paquetes_por_solicitud + 1)]
+                for id_paquete in estado["paquetes"]:
+                    self._paquetes[id_paquete] = self._generador.submit(self.generar_paquete)
+            paquetes = list(estado["paquetes"])
+            primera = estado["verificaciones"] == 1
+
+        if not listo:
+            result.set("EstadoSolicitud", "1" if primera else "2")
+            result.set("Mensaje", "Solicitud Aceptada" if primera else "Solicitud en proceso")
+            return etree.tostring(resp)
+
+        result.set("EstadoSolicitud", "3")
+        result.set("NumeroCFDIs", str(len(self._miembros) * len(paquetes)))
+        result.set("Mensaje", "Solicitud Aceptada")
+        # Un <IdsPaquetes> por paquete, como el servicio real
+        for id_paquete in paquetes:
+            etree.SubElement(result, f"{{{etree.QName(result).namespace}}}IdsPaquetes").text = id_paquete
+        return etree.tostring(resp)
+
+    def _descarga(self, peticion, falla):
+        pet = peticion.find(".//{http://DescargaMasivaTerceros.sat.gob.mx}peticionDescarga")
+        inicio, fin = self._captura_descarga
+        if falla:
+            inicio = inicio.replace(b'CodEstatus="5000" Mensaje="Solicitud Aceptada"',
+                                    f'CodEstatus="{falla}" Mensaje="{CODIGOS[falla][0]}"'.encode())
+            return inicio + fin
+
+        with self._lock:
+            # Cada paquete se entrega una vez; si se pide de nuevo se genera otro
+            futuro = self._paquetes.pop(pet.get("IdPaquete", ""), None)
+        paquete = futuro.result() if futuro is not None else self.generar_paquete()
+        return inicio + base64.b64encode(paquete) + fin
+
+    # --- HTTP ---------------------------------------------------------------
+
+    def iniciar(self, host="127.0.0.1", puerto=0):
+        # Servidor en un hilo; regresa la URL base (puerto 0 = uno libre)
+        self.servidor = ThreadingHTTPServer((host, puerto), _Manejador)
+        self.servidor.daemon_threads = True
+        self.servidor.simulador = self
+        threading.Thread(target=self.servidor.serve_forever, name="sat-simulado", daemon=True).start()
+        return f"http://{host}:{self.servidor.server_address[1]}"
+
+    def detener(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+        self._generador.shutdown(wait=False, cancel_futures=True)
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    # HTTP/1.1 para que requests.Session reutilice la conexión como con el SAT
+    protocol_version = "HTTP/1.1"
+    # Encabezados y cuerpo van en escrituras separadas: sin TCP_NODELAY, Nagle + ACK retrasado
+    # agregan ~40 ms a cada respuesta
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        cuerpo = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            codigo, respuesta = self.server.simulador.atender(self.path, cuerpo)
+        except Exception as e:
+            codigo, respuesta = 500, f"Error en el simulador: {e}".encode()
+        self.send_response(codigo)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(respuesta)))
+        self.end_headers()
+        self.wfile.write(respuesta)
+
+    def log_message(self, formato, *args):
+        pass
+
+
+def rutas_de_config(config):
+    # path de cada endpoint de config.yml → servicio
+    return {urlparse(config["endpoints"][s]).path.rstrip("/"): s for s in SERVICIOS}
+
+
+def endpoints_locales(config, url_base):
+    # Los endpoints de config.yml apuntando al simulador (mismos paths)
+    return {s: url_base + urlparse(config["endpoints"][s]).path for s in SERVICIOS}
+
+
+def parse_fallas(especificaciones):
+    # ["soap_fault=0.1", "descarga:http500=0.05", "solicitud:5005=0.2"]
+    fallas = {}
+    for espec in especificaciones or []:
+        clave, _, probabilidad = espec.partition("=")
+        servicio, _, falla = clave.rpartition(":")
+        servicio = servicio or "*"
+        if falla not in FALLAS or (servicio != "*" and servicio not in SERVICIOS):
+            raise ValueError(f"Falla no reconocida: {espec} (fallas: {', '.join(FALLAS)})")
+        fallas[(servicio, falla)] = float(probabilidad or 1)
+    return fallas
+
+
+def parse_capacidad(especificaciones):
+    # ["8", "descarga:2"] → {"*": 8, "descarga": 2}
+    capacidad = {}
+    for espec in especificaciones or []:
+        servicio, _, n = espec.rpartition(":")
+        servicio = servicio or "*"
+        if servicio != "*" and servicio not in SERVICIOS:
+            raise ValueError(f"Servicio no reconocido: {espec} (servicios: {', '.join(SERVICIOS)})")
+        capacidad[servicio] = int(n)
+    return capacidad
+
+
+def agregar_opciones(parser):
+    # Opciones del simulador, compartidas con benchmarks.bench_pipeline
+    parser.add_argument("--latencia", type=float, default=0.0, help="Segundos de espera por petición")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Espera extra aleatoria (0 a este valor)")
+    parser.add_argument("--falla", action="append", metavar="[SERVICIO:]FALLA=PROB",
+                        help=f"Falla inyectada ({', '.join(FALLAS)}); se puede repetir")
+    parser.add_argument("--tamano-paquete", type=tamano_en_bytes, help="Tamaño de cada zip (p. ej. 5MB)")
+    parser.add_argument("--paquetes", type=int, default=1, help="Paquetes por solicitud")
+    parser.add_argument("--verificaciones", type=int, default=0,
+                        help="Verificaciones en proceso antes de quedar lista")
+    parser.add_argument("--duplicados", type=float, default=0.0,
+                        help="Fracción de CFDI que repiten UUID entre paquetes")
+    parser.add_argument("--semilla", type=int, help="Semilla para fallas y duplicados")
+    parser.add_argument("--capacidad", action="append", metavar="[SERVICIO:]N",
+                        help="Peticiones atendidas a la vez; las demás reciben HTTP 503. Se puede repetir")
+
+
+def desde_opciones(config, args):
+    return SimuladorSAT(rutas_de_config(config), latencia=args.latencia, jitter=args.jitter,
+                        fallas=parse_fallas(args.falla), tamano_paquete=args.tamano_paquete,
+                        paquetes_por_solicitud=args.paquetes,
+                        verificaciones_hasta_listo=args.verificaciones,
+                        duplicados=args.duplicados, semilla=args.semilla,
+                        capacidad=parse_capacidad(args.capacidad))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SAT simulado para pruebas y benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8765)
+    agregar_opciones(parser)
+    args = parser.parse_args()
+
+    config = load_config()
+    try:
+        simulador = desde_opciones(config, args)
+    except ValueError as e:
+        parser.error(str(e))
+    url = simulador.iniciar(args.host, args.puerto)
+    print(f"✓ SAT simulado en {url}")
+    print("Para usarlo, en clientes/<RFC>/config.yml:\nendpoints:")
+    for servicio, endpoint in endpoints_locales(config, url).items():
+        print(f'  {servicio}: "{endpoint}"')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulador.detener()
+        for servicio, c in simulador.contadores.items():
+            print(f"  {servicio}: {c['peticiones']} peticiones, {c['fallas']} fallas, {c['rechazadas']} rechazadas")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# ingesta.py - Extrae los campos principales de cada CFDI de los paquetes descargados
+# y los agrega por lotes a clientes/<RFC>/cfdi.db (tabla comprobantes, llave UUID).
+# Los paquetes cuyo zip no se conservó se leen del almacén por UUID (utils/almacen.py)
+import argparse
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils.almacen import get_almacen
+from utils.cfdi import get_cfdi_db, leer_paquete, leer_paquete_almacen, paquetes_cfdi, uuid_de_nombre
+from utils.config import load_config
+
+
+def ya_en_base(db, nombres):
+    # Miembros cuyo UUID (tomado del nombre) ya está en comprobantes: no se parsean
+    por_uuid = {uuid_de_nombre(n): n for n in nombres if n.lower().endswith(".xml")}
+    por_uuid.pop(None, None)
+    return {por_uuid[u] for u in db.uuids_existentes(por_uuid)}
+
+
+def fuente(config, id_paquete, zip_path=None):
+    # De dónde se lee un paquete: su zip si está, si no el almacén.
+    # Regresa (nombres de los XML, función de lectura, argumentos sin `omitir`)
+    if zip_path:
+        with zipfile.ZipFile(zip_path) as z:
+            return z.namelist(), leer_paquete, (zip_path,)
+    almacen = get_almacen(config)
+    if almacen is None:
+        raise FileNotFoundError(f"{id_paquete}: no hay zip y el almacén está desactivado")
+    return almacen.nombres(id_paquete), leer_paquete_almacen, (almacen.directorio, id_paquete)
+
+
+def paquetes_por_ingestar(config, ya=()):
+    # id_paquete → zip, o None si el paquete solo está en el almacén
+    pendientes = {os.path.splitext(os.path.basename(p))[0]: p for p in paquetes_cfdi(config["base_path"])}
+    almacen = get_almacen(config)
+    if almacen is not None:
+        for id_paquete in almacen.paquetes():
+            pendientes.setdefault(id_paquete, None)
+    return {p: ruta for p, ruta in pendientes.items() if p not in ya}
+
+
+def ingestar(config, workers=None, forzar=False):
+    db = get_cfdi_db(config)
+    ya = set() if forzar else db.ingestados()
+    pendientes = paquetes_por_ingestar(config, ya)
+    if not pendientes:
+        print("No hay paquetes nuevos por ingestar.")
+        return {}
+
+    print(f"Paquetes por ingestar: {len(pendientes)}")
+    inicio = time.perf_counter()
+    resumen = {}
+    # Cada paquete se parsea en un proceso; la escritura se hace aquí, por lotes
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futuros = {}
+        for id_paquete, zip_path in pendientes.items():
+            nombres, leer, argumentos = fuente(config, id_paquete, zip_path)
+            omitir = set() if forzar else ya_en_base(db, nombres)
+            futuros[pool.submit(leer, *argumentos, omitir)] = (id_paquete, len(omitir))
+        for futuro in as_completed(futuros):
+            try:
+                id_paquete, filas, errores = futuro.result()
+            except Exception as e:
+                print(f"✗ Error al leer {futuros[futuro][0]}: {e}")
+                continue
+            nuevos = db.agregar_paquete(id_paquete, filas, len(errores))
+            duplicados = futuros[futuro][1] + len(filas) - nuevos
+            resumen[id_paquete] = {"comprobantes": len(filas), "nuevos": nuevos, "duplicados": duplicados,
+                                   "errores": len(errores)}
+            print(f"✓ {id_paquete}: {nuevos} nuevos, {duplicados} duplicados, {len(errores)} errores")
+            for nombre, error in errores:
+                print(f"  (⚠) {nombre}: {error}")
+
+    total = sum(r["comprobantes"] for r in resumen.values())
+    segundos = time.perf_counter() - inicio
+    print(f"\n✓ {total} comprobantes en {segundos:.1f}s → {db.path}")
+    return resumen
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingesta de CFDIs descargados")
+    parser.add_argument("--rfc", help="Cliente (por defecto cliente_rfc de config.yml)")
+    parser.add_argument("--workers", type=int, help="Procesos (por defecto uno por núcleo)")
+    parser.add_argument("--forzar", action="store_true", help="Volver a leer paquetes ya ingestados")
+    args = parser.parse_args()
+
+    print("=== Ingesta de CFDIs ===")
+    ingestar(load_config(args.rfc), args.workers, args.forzar)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+# motor.py - Pipeline completo en un solo event loop (asyncio): cada solicitud es una máquina
+# de estados solicitada → verificando → lista → descargando → descargada → ingestada, y miles
+# pueden estar en vuelo a la vez, de varios RFC, con una sola sesión HTTP. Cada paquete se
+# descarga en cuanto la verificación lo reporta y se ingesta en cuanto termina de bajar.
+# Los pasos son los de 1_auth.py ... 4_dwnld.py e ingesta.py (armado, firma, parseo,
+# historial.db, paquetes.txt); lo que usa CPU o disco corre en hilos, la lectura de CFDI
+# en procesos. Sin --solicitar/--sync solo retoma lo que está en curso en historial.db.
+# Uso: python motor.py [--rfc RFC ...] [--solicitar] [--sync] [--sin-ingesta] [--max-horas 6]
+import argparse
+import asyncio
+import copy
+import importlib
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import unquote
+import aiohttp
+import sync
+from utils import archivos, metricas, plantillas
+from utils.cfdi import get_cfdi_db
+from utils.config import listar_clientes, load_config
+from utils.historial_db import PAQUETES_POR_DESCARGAR, get_historial
+from utils.http import post_sat_async
+from utils.token_manager import get_token_provider
+from utils.xml_tools import CHUNK_SIZE
+
+auth = importlib.import_module("1_auth")
+req = importlib.import_module("2_req")
+verify = importlib.import_module("3_verify")
+dwnld = importlib.import_module("4_dwnld")
+ingesta = importlib.import_module("ingesta")
+
+# Conexiones HTTP abiertas a la vez (todas las solicitudes y RFC comparten la sesión)
+CONEXIONES = 64
+# Paquetes bajando a la vez
+DESCARGAS = 8
+INTENTOS_DESCARGA = 3
+# Segundos mínimos de vigencia para usar el token sin pasar por un hilo
+MARGEN_TOKEN = 5
+
+
+class _Cuerpo:
+    # Iterador síncrono (lo consume parse_and_save en un hilo) sobre el cuerpo de una
+    # respuesta de aiohttp que se sigue leyendo en el event loop, bloque por bloque
+
+    def __init__(self, resp, loop):
+        self.resp = resp
+        self.loop = loop
+
+    def __iter__(self):
+        while True:
+            bloque = asyncio.run_coroutine_threadsafe(self.resp.content.read(CHUNK_SIZE), self.loop).result()
+            if not bloque:
+                return
+            yield bloque
+
+
+class Motor:
+
+    def __init__(self, conexiones=CONEXIONES, descargas=DESCARGAS, ingestar=True,
+                 minimo=verify.INTERVALO_MIN, maximo=verify.INTERVALO_MAX, max_horas=None):
+        self.conexiones = conexiones
+        self.max_descargas = descargas
+        self.ingestar = ingestar
+        self.minimo = minimo
+        self.maximo = maximo
+        self.limite = time.time() + max_horas * 3600 if max_horas else None
+        self.hilos = ThreadPoolExecutor(max_workers=max(8, descargas * 2), thread_name_prefix="motor")
+        # Quien espera un token bloquea su hilo hasta que _autenticar (que firma en self.hilos)
+        # termina; con un pool aparte las esperas no pueden acaparar los hilos que lo destraban
+        self.hilos_token = ThreadPoolExecutor(max_workers=4, thread_name_prefix="motor_token")
+        self.procesos = ProcessPoolExecutor() if ingestar else None
+        self.estimados = {}    # rfc → segundos estimados a "lista"
+        self.cfdi_dbs = {}
+        self.estados = Counter()
+        self.loop = self.sesion = self.descargas = None
+
+    # --- utilidades ---------------------------------------------------------
+
+    async def _hilo(self, fn, *args):
+        return await self.loop.run_in_executor(self.hilos, fn, *args)
+
+    async def _archivo(self, fn, *args):
+        # id_solicitud.txt y paquetes.txt: el mismo candado que usa 3_verify.py
+        def editar():
+            with verify._archivos_lock:
+                return fn(*args)
+        return await self._hilo(editar)
+
+    async def _medido(self, cfg, servicio, fase, fn, *args):
+        def medir():
+            with metricas.cronometro(cfg, servicio, fase):
+                return fn(*args)
+        return await self._hilo(medir)
+
+    def _estado(self, cfg, id_solicitud, anterior, nuevo, detalle=""):
+        if anterior:
+            self.estados[anterior] -= 1
+        self.estados[nuevo] += 1
+        print(f"  [{cfg['rfc']}] {id_solicitud}: {anterior or '-'} → {nuevo}{detalle}")
+
+    def _config_solicitud(self, config, inicio, fin):
+        cfg = copy.deepcopy(config)
+        cfg["fechas"] = {"inicio": str(inicio), "fin": str(fin)}
+        return req.crear_estructura_anual(cfg)
+
+    # --- HTTP ---------------------------------------------------------------
+
+    async def _autenticar(self, cfg):
+        xml, headers = await self._hilo(auth.armar_autenticacion, cfg)
+        resp = await post_sat_async(self.sesion, cfg, cfg["endpoints"]["autenticacion"], data=xml,
+                                    headers=headers, timeout=aiohttp.ClientTimeout(total=60))
+        async with resp:
+            contenido = await resp.read()
+            if resp.status != 200:
+                raise Exception(f"Error al autenticar: HTTP {resp.status}")
+            resp.auditoria.respuesta(contenido, resp.status)
+        return auth.parse_token(cfg, contenido)
+
+    def _fetch_token(self, cfg):
+        # TokenProvider llama fetch desde un hilo; la petición se hace en el event loop
+        return asyncio.run_coroutine_threadsafe(self._autenticar(cfg), self.loop).result()
+
+    async def token(self, cfg):
+        # get() puede esperar una renovación que a su vez espera al loop (_fetch_token):
+        # en el loop solo se lee el token vigente, y si no hay, se pide desde un hilo
+        tokens = get_token_provider(cfg, fetch=self._fetch_token)
+        token = tokens.vigente(MARGEN_TOKEN)
+        if token is not None:
+            return token
+        return await self.loop.run_in_executor(self.hilos_token, tokens.get)
+
+    async def _post(self, cfg, servicio, xml, action, id_auditoria=None, stream=False):
+        token = await self.token(cfg)
+        headers = {
+            "Content-Type": "text/xml; charset=utf-8",
+            "SOAPAction": action,
+            "Authorization": f'WRAP access_token="{unquote(token)}"',
+        }
+        timeout = aiohttp.ClientTimeout(sock_read=120) if stream else aiohttp.ClientTimeout(total=60)
+        resp = await post_sat_async(self.sesion, cfg, cfg["endpoints"][servicio], id_auditoria, data=xml,
+                                    headers=headers, timeout=timeout, stream=stream)
+        if resp.status != 200:
+            # post_sat_async ya leyó y archivó el cuerpo (y reintentó lo que se podía)
+            contenido = await resp.read()
+            raise Exception(f"HTTP {resp.status}: {contenido.decode('utf-8', errors='ignore')[:200]}")
+        if stream:
+            return resp
+        async with resp:
+            contenido = await resp.read()
+        resp.auditoria.respuesta(contenido, resp.status)
+        return contenido
+
+    # --- pasos --------------------------------------------------------------
+
+    async def solicitar(self, cfg):
+        # Regresa el IdSolicitud, o None si ya había una con los mismos parámetros
+        db = get_historial(cfg)
+        if req.ya_existe_solicitud(db, cfg["rfc"], *req.parametros_solicitud(cfg)):
+            return None
+        with metricas.cronometro(cfg, "solicitud", "armado"):
+            doc, action = req.build_solicitud_xml(cfg)
+        xml = await self._medido(cfg, "solicitud", "firma", req.sign_solicitud_xml, doc, cfg)
+        contenido = await self._post(cfg, "solicitud", xml, action)
+        id_solicitud = await self._medido(cfg, "solicitud", "parseo", req.parse_solicitud_response, contenido, cfg)
+        await self._archivo(req.registrar_solicitud, cfg, id_solicitud)
+        return id_solicitud
+
+    def _parse_verificacion(self, contenido, cfg, id_solicitud):
+        with verify._archivos_lock, metricas.cronometro(cfg, "verificacion", "parseo"):
+            return verify.parse_verificacion_response(contenido, cfg, id_solicitud)
+
+    async def verificar(self, cfg, id_solicitud):
+        with metricas.cronometro(cfg, "verificacion", "armado"):
+            doc = verify.build_verificacion_xml(cfg, id_solicitud)
+        xml = await self._medido(cfg, "verificacion", "firma", verify.sign_xml, doc, cfg)
+        contenido = await self._post(cfg, "verificacion", xml, cfg["endpoints"]["verificacion_action"], id_solicitud)
+        return await self._hilo(self._parse_verificacion, contenido, cfg, id_solicitud)
+
+    async def _bajar(self, cfg, paquete_id):
+        # descargar_paquete de 4_dwnld.py con la petición en el event loop
+        db = get_historial(cfg)
+        await self._hilo(db.iniciar_descarga, cfg["rfc"], paquete_id)
+        try:
+            with metricas.cronometro(cfg, "descarga", "armado"):
+                env, pet = dwnld.build_descarga_xml(cfg, paquete_id)
+            xml = await self._medido(cfg, "descarga", "firma", self._firmar_descarga, env, pet, cfg)
+            resp = await self._post(cfg, "descarga", xml, cfg["endpoints"]["descarga_action"], paquete_id,
+                                    stream=True)
+            try:
+                async with resp:
+                    cuerpo = resp.auditoria.flujo(_Cuerpo(resp, self.loop), resp.status)
+                    resumen, integridad = await self._hilo(dwnld.parse_and_save, cuerpo, paquete_id, cfg)
+            finally:
+                resp.permiso.liberar()
+        except Exception as e:
+            await self._hilo(db.fallo_descarga, paquete_id, e)
+            raise
+        await self._medido(cfg, "descarga", "escritura", dwnld.marcar_descargado_en_historial,
+                           cfg, paquete_id, integridad)
+        return resumen
+
+    @staticmethod
+    def _firmar_descarga(env, pet, cfg):
+        dwnld.sign_peticion(pet, cfg)
+        return plantillas.serializar(env)
+
+    async def descargar(self, cfg, paquete_id):
+        async with self.descargas:
+            if await self._hilo(dwnld.recuperar_existente, cfg, paquete_id):
+                return True
+            for intento in range(1, INTENTOS_DESCARGA + 1):
+                try:
+                    await self._bajar(cfg, paquete_id)
+                    return True
+                except Exception as e:
+                    print(f"✗ Error al descargar paquete {paquete_id} (intento {intento}): {e}")
+                    if intento == INTENTOS_DESCARGA:
+                        return False
+                    metricas.reintento(cfg, "descarga", str(e), id_paquete=paquete_id)
+                    # Con jitter, para que los paquetes que fallaron juntos no reintenten juntos
+                    await asyncio.sleep(5 * 2 ** (intento - 1) * random.uniform(0.5, 1.5))
+
+    def _cfdi_db(self, cfg):
+        db = self.cfdi_dbs.get(cfg["rfc"])
+        if db is None:
+            db = self.cfdi_dbs[cfg["rfc"]] = get_cfdi_db(cfg)
+        return db
+
+    async def ingestar_paquete(self, cfg, paquete_id):
+        # Misma lectura que ingesta.py (en un proceso) y el lote se escribe en un hilo
+        db = self._cfdi_db(cfg)
+        ruta = dwnld.ruta_paquete(cfg, paquete_id)
+        nombres, leer, argumentos = await self._hilo(ingesta.fuente, cfg, paquete_id,
+                                                     str(ruta) if ruta.exists() else None)
+        omitir = await self._hilo(ingesta.ya_en_base, db, nombres)
+        _, filas, errores = await self.loop.run_in_executor(self.procesos, leer, *argumentos, omitir)
+        nuevos = await self._hilo(db.agregar_paquete, paquete_id, filas, len(errores))
+        print(f"✓ {paquete_id}: {nuevos} CFDI nuevos en {db.path}")
+
+    async def paquete(self, cfg, paquete_id, tipo_solicitud):
+        if not await self.descargar(cfg, paquete_id):
+            return False
+        await self._archivo(archivos.quitar_lineas, cfg["paquetes_path"], [paquete_id])
+        if self.ingestar and tipo_solicitud == "CFDI":
+            try:
+                await self.ingestar_paquete(cfg, paquete_id)
+            except Exception as e:
+                # El paquete ya está descargado: ingesta.py lo vuelve a intentar después
+                print(f"✗ Error al ingestar {paquete_id}: {e}")
+        return True
+
+    # --- máquina de estados -------------------------------------------------
+
+    async def esperar_lista(self, cfg, id_solicitud, solicitada):
+        # Verifica con los intervalos de 3_verify.py hasta que la solicitud termina; regresa
+        # ("lista", paquetes), (error/rechazada/vencida, None) o ("pendiente", None) si se
+        # acabó el tiempo. solicitada: segundos epoch del registro de la solicitud (o None)
+        estimado = self.estimados.get(cfg["rfc"], verify.ESTIMADO_DEFAULT)
+        revisiones, ultimo = 0, None
+        while True:
+            try:
+                resultado = await self.verificar(cfg, id_solicitud)
+            except Exception as e:
+                print(f"✗ Error al verificar {id_solicitud}: {e}")
+                metricas.reintento(cfg, "verificacion", str(e), id_solicitud=id_solicitud)
+                resultado = None
+            estado = resultado["estado"] if resultado else None
+
+            if estado == "3" or estado in verify.ESTADOS_FINALES:
+                final = "listo_para_descarga" if estado == "3" else verify.ESTADOS_FINALES[estado]
+                await self._hilo(verify.actualizar_historial, cfg, id_solicitud, final)
+                await self._archivo(archivos.quitar_lineas, cfg["ids_path"], [id_solicitud])
+                if estado == "3":
+                    return "lista", resultado["paquetes"]
+                return final, None
+
+            revisiones = revisiones + 1 if estado is None or estado == ultimo else 0
+            ultimo = estado
+            edad = time.time() - solicitada if solicitada else 0
+            intervalo = verify.siguiente_intervalo(estado, edad, estimado, revisiones, self.minimo, self.maximo)
+            if self.limite is not None and time.time() + intervalo >= self.limite:
+                return "pendiente", None
+            await asyncio.sleep(intervalo)
+
+    async def ciclo(self, cfg, solicitud):
+        id_solicitud = solicitud["id_solicitud"]
+        estado = "lista" if solicitud["estado"] == "listo_para_descarga" else "solicitada"
+        self._estado(cfg, id_solicitud, None, estado)
+        try:
+            if estado == "solicitada":
+                self._estado(cfg, id_solicitud, estado, "verificando")
+                estado = "verificando"
+                final, paquetes = await self.esperar_lista(cfg, id_solicitud, verify.momento_solicitud(solicitud))
+                if final != "lista":
+                    self._estado(cfg, id_solicitud, estado, final)
+                    return
+                self._estado(cfg, id_solicitud, estado, "lista", f" ({len(paquetes)} paquetes)")
+                estado = "lista"
+            else:
+                db = get_historial(cfg)
+                paquetes = [p["id_paquete"] for p in await self._hilo(
+                    db.paquetes, cfg["rfc"], PAQUETES_POR_DESCARGAR, id_solicitud)]
+
+            self._estado(cfg, id_solicitud, estado, "descargando")
+            estado = "descargando"
+            tipo = solicitud.get("tipo_solicitud") or cfg["descarga"].get("tipo_solicitud")
+            ok = await asyncio.gather(*(self.paquete(cfg, p, tipo) for p in paquetes))
+            if not all(ok):
+                self._estado(cfg, id_solicitud, estado, "incompleta", f" ({ok.count(False)} paquetes con error)")
+                return
+            final = "ingestada" if self.ingestar and tipo == "CFDI" else "descargada"
+            self._estado(cfg, id_solicitud, estado, final)
+        except Exception as e:
+            self._estado(cfg, id_solicitud, estado, "error", f": {e}")
+
+    async def nueva(self, cfg):
+        try:
+            id_solicitud = await self.solicitar(cfg)
+        except Exception as e:
+            print(f"✗ [{cfg['rfc']}] Error al solicitar {cfg['fechas']['inicio']} → {cfg['fechas']['fin']}: {e}")
+            return
+        if id_solicitud is None:
+            print(f"  [{cfg['rfc']}] Ya existe una solicitud para {cfg['fechas']['inicio']} → {cfg['fechas']['fin']}")
+            return
+        tipo = cfg["descarga"].get("tipo_solicitud")
+        await self.ciclo(cfg, {"id_solicitud": id_solicitud, "estado": "solicitado", "tipo_solicitud": tipo,
+                               "fecha_solicitud": time.strftime("%Y-%m-%d"),
+                               "solicitada": time.strftime("%Y-%m-%dT%H:%M:%S")})
+
+    # --- arranque -----------------------------------------------------------
+
+    def tareas_cliente(self, rfc, solicitar=False, sincronizar=False):
+        # (en curso en historial.db, configs de solicitudes nuevas) de un RFC
+        config = load_config(rfc)
+        db = get_historial(config)
+        historial = verify.cargar_historial(config)
+        self.estimados[config["rfc"]] = verify.estimar_tiempo_listo(historial)
+
+        en_curso = []
+        for s in db.solicitudes(config["rfc"], ["solicitado", "listo_para_descarga"]):
+            s = historial.get(s["id_solicitud"], s)
+            if s["fecha_inicio"] and s["fecha_fin"]:
+                en_curso.append((self._config_solicitud(config, s["fecha_inicio"], s["fecha_fin"]), s))
+
+        nuevas = []
+        if solicitar:
+            nuevas.append(self._config_solicitud(config, config["fechas"]["inicio"], config["fechas"]["fin"]))
+        if sincronizar:
+            _, _, ventanas = sync.planear_sync(config, *sync.rango_sync(config))
+            nuevas.extend(self._config_solicitud(config, desde, hasta) for desde, hasta, _ in ventanas)
+        return en_curso, nuevas
+
+    async def correr(self, rfcs, solicitar=False, sincronizar=False):
+        self.loop = asyncio.get_running_loop()
+        self.descargas = asyncio.Semaphore(self.max_descargas)
+        conector = aiohttp.TCPConnector(limit=self.conexiones)
+        inicio = time.perf_counter()
+        async with aiohttp.ClientSession(connector=conector) as self.sesion:
+            tareas = []
+            for rfc in rfcs:
+                try:
+                    en_curso, nuevas = await self._hilo(self.tareas_cliente, rfc, solicitar, sincronizar)
+                except Exception as e:
+                    print(f"✗ [{rfc}] {e}")
+                    continue
+                print(f"[{rfc}] En curso: {len(en_curso)} – nuevas: {len(nuevas)}")
+                tareas += [self.ciclo(cfg, s) for cfg, s in en_curso]
+                tareas += [self.nueva(cfg) for cfg in nuevas]
+            await asyncio.gather(*tareas)
+        self.hilos.shutdown()
+        self.hilos_token.shutdown()
+        if self.procesos:
+            self.procesos.shutdown()
+        return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline asíncrono: solicitud → verificación → descarga → ingesta")
+    parser.add_argument("--rfc", nargs="*", help="Solo estos RFCs (por defecto todos los de clientes/)")
+    parser.add_argument("--solicitar", action="store_true", help="Enviar también la solicitud de fechas/descarga")
+    parser.add_argument("--sync", action="store_true", help="Enviar también las ventanas que faltan (sync.py)")
+    parser.add_argument("--sin-ingesta", action="store_true", help="No cargar los CFDI a cfdi.db")
+    parser.add_argument("--conexiones", type=int, default=CONEXIONES, help="Conexiones HTTP a la vez")
+    parser.add_argument("--descargas", type=int, help="Paquetes bajando a la vez")
+    parser.add_argument("--intervalo-min", type=int, default=verify.INTERVALO_MIN, help="Segundos mínimos entre verificaciones")
+    parser.add_argument("--intervalo-max", type=int, default=verify.INTERVALO_MAX, help="Segundos máximos entre verificaciones")
+    parser.add_argument("--max-horas", type=float, help="Dejar de esperar verificaciones después de este tiempo")
+    args = parser.parse_args()
+    metricas.iniciar("motor")
+
+    rfcs = args.rfc or listar_clientes()
+    if not rfcs:
+        print("No hay clientes con FIEL en clientes/.")
+        return
+
+    descargas = args.descargas or DESCARGAS
+    print(f"=== Motor: {len(rfcs)} clientes, {args.conexiones} conexiones, {descargas} descargas a la vez ===")
+    motor = Motor(args.conexiones, descargas, not args.sin_ingesta, args.intervalo_min,
+                  args.intervalo_max, args.max_horas)
+    segundos = asyncio.run(motor.correr(rfcs, args.solicitar, args.sync))
+
+    print(f"\n=== Resumen ({segundos:.1f}s) ===")
+    for estado, n in sorted(motor.estados.items()):
+        if n:
+            print(f"  {estado:<12} {n}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# orquestador.py - Ejecuta autenticación, solicitud, verificación y descarga
+# para todos los clientes de clientes/ en paralelo
+import argparse
+import copy
+import importlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import metricas
+from utils.config import load_config, listar_clientes
+from utils.token_manager import get_token_provider
+import sync
+
+auth = importlib.import_module("1_auth")
+req = importlib.import_module("2_req")
+verify = importlib.import_module("3_verify")
+dwnld = importlib.import_module("4_dwnld")
+
+PASOS = ("auth", "solicitud", "verificacion", "descarga")
+# "sync" sustituye a "solicitud" cuando solo se quieren los días faltantes
+
+
+def paso_auth(config, args):
+    get_token_provider(config, fetch=auth.get_token).get()
+
+
+def paso_solicitud(config, args):
+    req.solicitar(config)
+
+
+def paso_sync(config, args):
+    sync.sync(config)
+
+
+def paso_verificacion(config, args):
+    config = verify.preparar_paths_por_anio(config)
+    if args.poll:
+        verify.poll(config, workers=int(config.get("concurrencia", {}).get("verificaciones", 4)),
+                    max_horas=args.max_horas)
+    else:
+        verify.verificar_pendientes(config)
+
+
+def paso_descarga(config, args):
+    dwnld.descargar_pendientes(dwnld.preparar_paths_por_anio(config))
+
+
+EJECUTORES = {
+    "auth": paso_auth,
+    "solicitud": paso_solicitud,
+    "sync": paso_sync,
+    "verificacion": paso_verificacion,
+    "descarga": paso_descarga,
+}
+
+
+def ejecutar_cliente(rfc, pasos, args):
+    config = load_config(rfc)
+    resultado = {}
+    for paso in pasos:
+        inicio = time.perf_counter()
+        try:
+            # Cada paso agrega sus rutas al config: se le pasa una copia
+            EJECUTORES[paso](copy.deepcopy(config), args)
+            resultado[paso] = ("ok", time.perf_counter() - inicio)
+        except Exception as e:
+            print(f"✗ [{rfc}] Error en {paso}: {e}")
+            resultado[paso] = (f"error: {e}", time.perf_counter() - inicio)
+            if paso == "auth":
+                # Sin token no tiene caso seguir con este cliente
+                break
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Descarga masiva para todos los clientes")
+    parser.add_argument("--rfc", nargs="*", help="Solo estos RFCs (por defecto todos los de clientes/)")
+    parser.add_argument("--pasos", default=",".join(PASOS),
+                        help=f"Pasos a ejecutar, separados por coma ({','.join(EJECUTORES)})")
+    parser.add_argument("--paralelo", type=int, help="Clientes procesados al mismo tiempo")
+    parser.add_argument("--poll", action="store_true", help="Verificación continua (3_verify --poll)")
+    parser.add_argument("--max-horas", type=float, help="Tiempo máximo de la verificación continua")
+    args = parser.parse_args()
+    metricas.iniciar("orquestador")
+
+    pasos = [p.strip() for p in args.pasos.split(",") if p.strip()]
+    desconocidos = [p for p in pasos if p not in EJECUTORES]
+    if desconocidos:
+        parser.error(f"Pasos desconocidos: {', '.join(desconocidos)}")
+
+    rfcs = args.rfc or listar_clientes()
+    if not rfcs:
+        print("No hay clientes con FIEL en clientes/.")
+        return
+
+    paralelo = args.paralelo or int(load_config().get("concurrencia", {}).get("clientes", 4))
+    print(f"=== Orquestador: {len(rfcs)} clientes, {paralelo} en paralelo, pasos {', '.join(pasos)} ===")
+
+    resultados = {}
+    with ThreadPoolExecutor(max_workers=max(1, paralelo)) as pool:
+        futuros = {pool.submit(ejecutar_cliente, rfc, pasos, args): rfc for rfc in rfcs}
+        for futuro in as_completed(futuros):
+            rfc = futuros[futuro]
+            try:
+                resultados[rfc] = futuro.result()
+            except Exception as e:
+                print(f"✗ [{rfc}] Error general: {e}")
+                resultados[rfc] = {"config": (f"error: {e}", 0.0)}
+
+    print("\nResumen por cliente:")
+    for rfc in rfcs:
+        detalle = ", ".join(f"{paso} {estado} ({seg:.1f}s)" for paso, (estado, seg) in resultados[rfc].items())
+        print(f"  {rfc}: {detalle}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# planificador.py - Divide un rango de fechas en las menos solicitudes posibles que
+# respeten los límites del SAT, estimando el volumen por día con la metadata disponible
+import argparse
+import copy
+import importlib
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from utils import metricas
+from utils.config import load_config
+from utils.cobertura import clave_descarga, clave_solicitud, coincide_rfc, partir_por_anio
+from utils.historial_db import get_historial, id_solicitud_de_paquete
+from utils.metadata import iter_metadata, paquetes_metadata
+
+req = importlib.import_module("2_req")
+
+# Máximo de comprobantes por solicitud que acepta el SAT
+LIMITES_DEFAULT = {"CFDI": 200000, "Metadata": 1000000}
+# Fracción del límite a usar, por si la estimación se queda corta
+MARGEN_DEFAULT = 0.9
+
+
+def limite_por_solicitud(config, tipo):
+    # Límite del SAT para el tipo de solicitud, ya con el margen del planificador
+    limites = config.get("limites") or {}
+    limite = int(limites.get("cfdi_por_solicitud" if tipo == "CFDI" else "metadata_por_solicitud",
+                             LIMITES_DEFAULT.get(tipo, LIMITES_DEFAULT["CFDI"])))
+    return int(limite * float(limites.get("margen_planificador", MARGEN_DEFAULT)))
+
+
+def rango_dias(inicio, fin):
+    dia = inicio
+    while dia <= fin:
+        yield dia
+        dia += timedelta(days=1)
+
+
+def conteo_diario(config, inicio, fin):
+    # Comprobantes por FechaEmision según la metadata ya descargada, y días cubiertos
+    # por esa metadata (rango de cada paquete y de las solicitudes Metadata descargadas).
+    # Un paquete cuenta si su solicitud tiene los mismos filtros (tipo_comp "E" pide los
+    # emitidos, no el EfectoComprobante); si no se sabe de qué solicitud viene, solo cuentan
+    # sus renglones con los mismos RFC.
+    descarga = config["descarga"]
+    filtros = clave_descarga(descarga)[1:]
+    db = get_historial(config)
+    solicitudes = {s["id_solicitud"]: s for s in db.solicitudes(config["rfc"])}
+    conteo = Counter()
+    cubiertos = set()
+    vistos = set()
+
+    for zip_path in paquetes_metadata(config["base_path"]):
+        origen = solicitudes.get(id_solicitud_de_paquete(os.path.splitext(os.path.basename(zip_path))[0]))
+        if origen is not None and clave_solicitud(origen)[1:] != filtros:
+            continue
+        primero = ultimo = None
+        for fila in iter_metadata(zip_path):
+            if origen is None and not coincide_rfc(fila, descarga):
+                continue
+            try:
+                dia = date.fromisoformat(fila["FechaEmision"][:10])
+            except (KeyError, ValueError):
+                continue
+            primero = dia if primero is None else min(primero, dia)
+            ultimo = dia if ultimo is None else max(ultimo, dia)
+
+            uuid = fila["Uuid"].upper()
+            if uuid in vistos:
+                continue
+            vistos.add(uuid)
+            if inicio <= dia <= fin:
+                conteo[dia] += 1
+        if primero is not None:
+            cubiertos.update(rango_dias(primero, ultimo))
+
+    for s in solicitudes.values():
+        if s["estado"] != "descargado" or s["tipo_solicitud"] != "Metadata":
+            continue
+        if not s["fecha_inicio"] or not s["fecha_fin"] or clave_solicitud(s)[1:] != filtros:
+            continue
+        cubiertos.update(rango_dias(date.fromisoformat(s["fecha_inicio"]), date.fromisoformat(s["fecha_fin"])))
+
+    return conteo, cubiertos
+
+
+def tramos(dias):
+    # Días consecutivos agrupados en (inicio, fin)
+    resultado = []
+    for dia in sorted(dias):
+        if resultado and resultado[-1][1] + timedelta(days=1) == dia:
+            resultado[-1] = (resultado[-1][0], dia)
+        else:
+            resultado.append((dia, dia))
+    return resultado
+
+
+def planear_ventanas(conteo, inicio, fin, limite):
+    # Greedy: cada ventana crece mientras no pase el límite ni cambie de año (cada solicitud
+    # se guarda en la carpeta del año de su fecha inicial). Para particiones en intervalos
+    # contiguos esto da el mínimo número de ventanas.
+    ventanas = []
+    desde, suma = None, 0
+    for dia in rango_dias(inicio, fin):
+        n = conteo.get(dia, 0)
+        if n > limite:
+            print(f"(⚠) {dia}: ~{n} comprobantes en un solo día, rebasa el límite de {limite}")
+        if desde is not None and (suma + n > limite or dia.year != desde.year):
+            ventanas.append((desde, dia - timedelta(days=1), suma))
+            desde, suma = None, 0
+        if desde is None:
+            desde = dia
+        suma += n
+    if desde is not None:
+        ventanas.append((desde, fin, suma))
+    return ventanas
+
+
+def enviar_ventanas(config, ventanas, workers=4, tipo_solicitud=None):
+    # Una solicitud por ventana, enviadas en paralelo; regresa {(inicio, fin): IdSolicitud}
+    def enviar(desde, hasta):
+        cfg = copy.deepcopy(config)
+        cfg["fechas"] = {"inicio": desde.isoformat(), "fin": hasta.isoformat()}
+        if tipo_solicitud:
+            cfg["descarga"]["tipo_solicitud"] = tipo_solicitud
+        return req.solicitar(cfg)
+
+    resultados = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futuros = {pool.submit(enviar, desde, hasta): (desde, hasta) for desde, hasta, *_ in ventanas}
+        for futuro in as_completed(futuros):
+            ventana = futuros[futuro]
+            try:
+                resultados[ventana] = futuro.result()
+            except Exception as e:
+                print(f"✗ Error en la ventana {ventana[0]} → {ventana[1]}: {e}")
+                resultados[ventana] = None
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planificador de solicitudes por rango de fechas")
+    parser.add_argument("--rfc", help="Cliente (por defecto cliente_rfc de config.yml)")
+    parser.add_argument("--inicio", help="Fecha inicial YYYY-MM-DD (por defecto fechas.inicio)")
+    parser.add_argument("--fin", help="Fecha final YYYY-MM-DD (por defecto fechas.fin)")
+    parser.add_argument("--dry-run", action="store_true", help="Solo mostrar el plan")
+    parser.add_argument("--sondeo", action="store_true",
+                        help="Solicitar Metadata para los días sin estimación")
+    parser.add_argument("--workers", type=int, default=4, help="Solicitudes enviadas en paralelo")
+    args = parser.parse_args()
+    metricas.iniciar("planificador")
+
+    config = load_config(args.rfc)
+    inicio = date.fromisoformat(args.inicio or config["fechas"]["inicio"])
+    fin = date.fromisoformat(args.fin or config["fechas"]["fin"])
+    tipo = config["descarga"].get("tipo_solicitud", "CFDI")
+
+    limite = limite_por_solicitud(config, tipo)
+
+    print(f"=== Planificador {config['rfc']}: {tipo} {inicio} → {fin} (máx. {limite} por solicitud) ===")
+    conteo, cubiertos = conteo_diario(config, inicio, fin)
+
+    sin_estimacion = tramos(d for d in rango_dias(inicio, fin) if d not in cubiertos)
+    if sin_estimacion and tipo != "Metadata":
+        print("Días sin metadata para estimar el volumen:")
+        for desde, hasta in sin_estimacion:
+            print(f"  {desde} → {hasta}")
+        if args.sondeo and not args.dry_run:
+            enviar_ventanas(config, list(partir_por_anio(sin_estimacion)), args.workers, tipo_solicitud="Metadata")
+            print("→ Cuando la metadata esté descargada vuelve a ejecutar el planificador.")
+        else:
+            print("→ Usa --sondeo para solicitar la Metadata de esos días.")
+        return
+
+    ventanas = planear_ventanas(conteo, inicio, fin, limite)
+    print(f"Plan: {len(ventanas)} solicitudes, ~{sum(conteo.values())} comprobantes")
+    for desde, hasta, n in ventanas:
+        print(f"  {desde} → {hasta}: ~{n}")
+
+    if args.dry_run:
+        return
+    resultados = enviar_ventanas(config, ventanas, args.workers)
+    enviadas = sum(1 for r in resultados.values() if r)
+    print(f"\n✓ Solicitudes enviadas: {enviadas} de {len(ventanas)}")
+
+
+if __name__ == "__main__":
+    main()
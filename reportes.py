@@ -0,0 +1,118 @@
+# reportes.py - Reportes sobre la metadata descargada, servidos desde los agregados de
+# reportes.db (utils/reportes.py): totales por cliente, mes, contraparte, efecto y estatus
+# sin volver a leer los zips, y el feed de cambios (nuevos, cancelados, faltantes).
+# Uso: python reportes.py [--actualizar] [--rfc RFC] [--periodo 2026-01 | --desde 2026-01 --hasta 2026-06]
+#                         [--por periodo,efecto] [--rol recibido] [--efecto I] [--estatus cancelado]
+#                         [--contraparte RFC] [--top 20] [--csv reporte.csv]
+#        python reportes.py --cambios [--rfc RFC] [--tipo cancelado,faltante] [--desde-cambio N] [--csv cambios.csv]
+import argparse
+import csv
+import sys
+import time
+from utils.config import listar_clientes, load_config
+from utils.reportes import DIMENSIONES, TIPOS_CAMBIO, actualizar, get_reportes, resumen_cambios
+
+
+def imprimir(filas, columnas):
+    anchos = {c: max([len(c)] + [len(str(f[c])) for f in filas]) for c in columnas}
+    print("  ".join(f"{c:<{anchos[c]}}" for c in columnas) + f"  {'cfdi':>9}  {'monto':>20}")
+    for f in filas:
+        print("  ".join(f"{f[c]:<{anchos[c]}}" for c in columnas) + f"  {f['cfdi']:>9,}  {f['monto']:>20,.2f}")
+    if len(filas) > 1:
+        total = sum(f["monto"] for f in filas)
+        print(f"{'total':<{sum(anchos.values()) + 2 * (len(columnas) - 1)}}  "
+              f"{sum(f['cfdi'] for f in filas):>9,}  {total:>20,.2f}")
+
+
+def mostrar_cambios(args):
+    tipos = [t.strip() for t in args.tipo.split(",") if t.strip()] if args.tipo else None
+    invalidos = [t for t in tipos or () if t not in TIPOS_CAMBIO]
+    if invalidos:
+        print(f"✗ Tipos no válidos: {', '.join(invalidos)} (usa {', '.join(TIPOS_CAMBIO)})")
+        sys.exit(1)
+    filas = get_reportes(load_config(args.rfc)).cambios(
+        rfc=args.rfc.upper() if args.rfc else None, tipos=tipos, desde_id=args.desde_cambio, limite=args.top)
+    if not filas:
+        print("Sin cambios con esos filtros.")
+        return
+    if args.csv:
+        with open(args.csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(filas[0]))
+            writer.writeheader()
+            writer.writerows(filas)
+        print(f"✓ {len(filas)} cambios → {args.csv}")
+    else:
+        for f in filas:
+            anterior = f"{f['estatus_anterior']} → " if f["estatus_anterior"] else ""
+            cancelacion = f" ({f['fecha_cancelacion']})" if f["fecha_cancelacion"] else ""
+            print(f"{f['id']:>8}  {f['rfc']:<13}  {f['uuid']}  {f['tipo']:<11}  "
+                  f"{anterior}{f['estatus']}{cancelacion}  {f['monto']:>16,.2f}")
+    # Para pedir solo lo siguiente la próxima vez
+    print(f"\n(último cambio: {filas[-1]['id']}; siguiente consulta con --desde-cambio {filas[-1]['id']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reportes de la metadata descargada (todos los clientes)")
+    parser.add_argument("--actualizar", action="store_true",
+                        help="Antes de consultar, aplica los paquetes de metadata nuevos")
+    parser.add_argument("--reconstruir", action="store_true", help="Rehace los agregados desde los zips")
+    parser.add_argument("--rfc", help="Solo este cliente (por defecto todos)")
+    parser.add_argument("--periodo", help="Un mes (AAAA-MM)")
+    parser.add_argument("--desde", help="Primer mes (AAAA-MM)")
+    parser.add_argument("--hasta", help="Último mes (AAAA-MM)")
+    parser.add_argument("--por", default="rfc,periodo",
+                        help=f"Dimensiones a agrupar, separadas por coma ({', '.join(DIMENSIONES)})")
+    parser.add_argument("--rol", choices=["emitido", "recibido", "tercero"])
+    parser.add_argument("--efecto", help="I, E, T, N o P")
+    parser.add_argument("--estatus", choices=["vigente", "cancelado"])
+    parser.add_argument("--contraparte", help="RFC del emisor o receptor del otro lado")
+    parser.add_argument("--top", type=int, metavar="N", help="Los N grupos de mayor monto")
+    parser.add_argument("--csv", metavar="ARCHIVO", help="Guarda el resultado en CSV")
+    parser.add_argument("--cambios", action="store_true",
+                        help="Muestra el feed de cambios en vez de los totales (con --top, los primeros N)")
+    parser.add_argument("--tipo", help=f"Con --cambios, separados por coma ({', '.join(TIPOS_CAMBIO)})")
+    parser.add_argument("--desde-cambio", type=int, default=0, metavar="N",
+                        help="Con --cambios, solo los posteriores al cambio N")
+    args = parser.parse_args()
+
+    if args.actualizar or args.reconstruir:
+        for rfc in [args.rfc] if args.rfc else (listar_clientes() or [None]):
+            config = load_config(rfc)
+            resumen = actualizar(config, args.reconstruir)
+            for id_solicitud, r in resumen.items():
+                print(f"✓ {config['rfc']} {id_solicitud}: {r['renglones']} renglones, {resumen_cambios(r)}")
+        print()
+
+    if args.cambios:
+        mostrar_cambios(args)
+        return
+
+    agrupar = [d.strip() for d in args.por.split(",") if d.strip()]
+    inicio = time.perf_counter()
+    try:
+        filas = get_reportes(load_config(args.rfc)).consultar(
+            agrupar, desde=args.periodo or args.desde, hasta=args.periodo or args.hasta,
+            orden="monto" if args.top else None, limite=args.top,
+            rfc=args.rfc.upper() if args.rfc else None, rol=args.rol, efecto=args.efecto,
+            estatus=args.estatus, contraparte=args.contraparte.upper() if args.contraparte else None)
+    except ValueError as e:
+        print(f"✗ {e}")
+        sys.exit(1)
+    milisegundos = (time.perf_counter() - inicio) * 1000
+
+    if not filas:
+        print("Sin datos con esos filtros (¿falta python reportes.py --actualizar?).")
+        return
+    if args.csv:
+        with open(args.csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=agrupar + ["cfdi", "monto"])
+            writer.writeheader()
+            writer.writerows(filas)
+        print(f"✓ {len(filas)} renglones → {args.csv}")
+    else:
+        imprimir(filas, agrupar)
+    print(f"\n({len(filas)} renglones en {milisegundos:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+from sat.cli import main
+
+main()
@@ -0,0 +1,88 @@
+# cli.py - Punto de entrada único: sat [--dir DIR] [--rfc RFC] <comando> [opciones del comando]
+# Cada comando importa su script solo cuando se usa, para que las corridas de cron
+# sin trabajo no paguen la carga de lxml, xmlsec, requests ni yaml.
+import argparse
+import importlib
+import os
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# comando: (módulo, descripción)
+COMANDOS = {
+    "pem": ("0_pem", "Convierte la FIEL (.cer/.key) a cert.pem y fiel.pem"),
+    "auth": ("1_auth", "Obtiene (o reutiliza) el token de autenticación"),
+    "request": ("2_req", "Envía la solicitud configurada en config.yml"),
+    "verify": ("3_verify", "Verifica las solicitudes pendientes"),
+    "download": ("4_dwnld", "Descarga los paquetes pendientes"),
+    "status": (None, "Resumen de solicitudes, paquetes y token por cliente"),
+    "sync": ("sync", "Solicita solo los días que faltan"),
+    "plan": ("planificador", "Divide un rango de fechas según los límites del SAT"),
+    "ingest": ("ingesta", "Carga los CFDI descargados a cfdi.db"),
+    "validate": ("validar", "Verifica sello y timbre de los CFDI descargados"),
+    "report": ("reportes", "Totales de la metadata por cliente, mes, contraparte, efecto y estatus"),
+    "run": ("orquestador", "Ejecuta los pasos para todos los clientes"),
+    "motor": ("motor", "Pipeline asíncrono: solicitud a ingesta en un solo proceso"),
+    "audit": ("auditoria", "Consulta y extrae las peticiones y respuestas archivadas"),
+}
+
+
+def status(argv):
+    from utils.config import listar_clientes, load_config
+    from utils.historial_db import get_historial
+    from utils.token_manager import get_token_provider
+
+    parser = argparse.ArgumentParser(prog="sat status", description=COMANDOS["status"][1])
+    parser.add_argument("--todos", action="store_true", help="Todos los clientes de clientes/")
+    args = parser.parse_args(argv)
+
+    rfcs = listar_clientes() if args.todos else [None]
+    for rfc in rfcs:
+        config = load_config(rfc)
+        db = get_historial(config)
+        solicitudes, paquetes = {}, {}
+        for s in db.solicitudes(config["rfc"]):
+            solicitudes[s["estado"]] = solicitudes.get(s["estado"], 0) + 1
+        for p in db.paquetes(config["rfc"]):
+            paquetes[p["estado"]] = paquetes.get(p["estado"], 0) + 1
+        vigencia = get_token_provider(config).expires_in()
+
+        print(f"=== {config['rfc']} ===")
+        print("  Solicitudes: " + (", ".join(f"{e} {n}" for e, n in sorted(solicitudes.items())) or "ninguna"))
+        print("  Paquetes:    " + (", ".join(f"{e} {n}" for e, n in sorted(paquetes.items())) or "ninguno"))
+        print(f"  Token:       {'vigente ' + str(int(vigencia)) + 's' if vigencia else 'vencido'}")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    ayuda = "\n".join(f"  {c:<9} {d}" for c, (_, d) in COMANDOS.items())
+    parser = argparse.ArgumentParser(
+        prog="sat", description="Descarga masiva de CFDI del SAT",
+        formatter_class=argparse.RawDescriptionHelpFormatter, epilog=f"comandos:\n{ayuda}")
+    parser.add_argument("--dir", help="Carpeta con config.yml y clientes/ (por defecto la actual)")
+    parser.add_argument("--rfc", help="Cliente (por defecto cliente_rfc de config.yml)")
+    parser.add_argument("comando", choices=COMANDOS, metavar="comando")
+    parser.add_argument("opciones", nargs=argparse.REMAINDER, help="Opciones del comando (--help para verlas)")
+    args = parser.parse_args(argv)
+
+    if args.dir:
+        os.chdir(args.dir)
+    if RAIZ not in sys.path:
+        # Los scripts (1_auth.py, ...) viven junto a sat/: instalación editable o repo clonado
+        sys.path.insert(0, RAIZ)
+    if args.rfc:
+        # load_config() toma SAT_RFC cuando no se le pasa un RFC
+        os.environ["SAT_RFC"] = args.rfc
+
+    modulo, _ = COMANDOS[args.comando]
+    if modulo is None:
+        return status(args.opciones)
+    if not os.path.exists(os.path.join(RAIZ, f"{modulo}.py")):
+        parser.exit(1, f"✗ No se encontró {modulo}.py en {RAIZ}; instala con pip install -e .\n")
+    # Los scripts leen sus opciones de sys.argv
+    sys.argv = [f"sat {args.comando}"] + args.opciones
+    return importlib.import_module(modulo).main()
+
+
+if __name__ == "__main__":
+    main()
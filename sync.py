@@ -0,0 +1,81 @@
+# sync.py - Sincronización incremental: solicita solo los días que aún no se tienen
+# para el RFC y los filtros de config.yml (descarga), en vez del bloque fechas completo
+import argparse
+from datetime import date, timedelta
+import planificador
+from utils.cobertura import MARGEN_CERTIFICACION, calcular_cobertura, partir_por_anio, restar
+from utils import metricas
+from utils.config import load_config
+
+
+def planear_sync(config, inicio, fin, margen=MARGEN_CERTIFICACION):
+    # Ventanas a solicitar: huecos de [inicio, fin] sin cobertura ni solicitudes en curso,
+    # partidos por año y por el límite de comprobantes por solicitud
+    cubiertos, en_curso = calcular_cobertura(config, margen)
+    huecos = list(partir_por_anio(restar(inicio, fin, cubiertos + en_curso)))
+
+    tipo = config["descarga"].get("tipo_solicitud", "CFDI")
+    limite = planificador.limite_por_solicitud(config, tipo)
+    ventanas = []
+    if huecos:
+        conteo, _ = planificador.conteo_diario(config, huecos[0][0], huecos[-1][1])
+        for desde, hasta in huecos:
+            ventanas.extend(planificador.planear_ventanas(conteo, desde, hasta, limite))
+    return cubiertos, en_curso, ventanas
+
+
+def rango_sync(config, inicio=None, fin=None, margen=None):
+    # (inicio, fin, margen) con los valores por omisión de sync en config.yml
+    opciones = config.get("sync") or {}
+    if margen is None:
+        margen = int(opciones.get("margen_certificacion_dias", MARGEN_CERTIFICACION))
+    fin = fin or date.today() - timedelta(days=1)
+    inicio = inicio or date.fromisoformat(str(opciones.get("desde") or config["fechas"]["inicio"]))
+    return inicio, fin, margen
+
+
+def sync(config, inicio=None, fin=None, workers=4, dry_run=False, margen=None):
+    inicio, fin, margen = rango_sync(config, inicio, fin, margen)
+    tipo = config["descarga"].get("tipo_solicitud", "CFDI")
+
+    print(f"=== Sync {config['rfc']}: {tipo} {inicio} → {fin} ===")
+    cubiertos, en_curso, ventanas = planear_sync(config, inicio, fin, margen)
+    for desde, hasta in cubiertos:
+        print(f"  ✓ cubierto  {desde} → {hasta}")
+    for desde, hasta in en_curso:
+        print(f"  … en curso  {desde} → {hasta}")
+    if not ventanas:
+        print("✓ Todo el rango está cubierto o en curso.")
+        return {}
+
+    print(f"Por solicitar: {len(ventanas)} ventanas")
+    for desde, hasta, n in ventanas:
+        print(f"  → {desde} → {hasta}" + (f": ~{n}" if n else ""))
+    if dry_run:
+        return {}
+
+    resultados = planificador.enviar_ventanas(config, ventanas, workers)
+    enviadas = sum(1 for r in resultados.values() if r)
+    print(f"\n✓ Solicitudes enviadas: {enviadas} de {len(ventanas)}")
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sincronización incremental de descargas")
+    parser.add_argument("--rfc", help="Cliente (por defecto cliente_rfc de config.yml)")
+    parser.add_argument("--desde", help="Primer día a cubrir YYYY-MM-DD (por defecto sync.desde o fechas.inicio)")
+    parser.add_argument("--hasta", help="Último día a cubrir YYYY-MM-DD (por defecto ayer)")
+    parser.add_argument("--margen", type=int, help="Días que se esperan certificaciones tardías")
+    parser.add_argument("--dry-run", action="store_true", help="Solo mostrar las ventanas")
+    parser.add_argument("--workers", type=int, default=4, help="Solicitudes enviadas en paralelo")
+    args = parser.parse_args()
+    metricas.iniciar("sync")
+
+    sync(load_config(args.rfc),
+         date.fromisoformat(args.desde) if args.desde else None,
+         date.fromisoformat(args.hasta) if args.hasta else None,
+         args.workers, args.dry_run, args.margen)
+
+
+if __name__ == "__main__":
+    main()
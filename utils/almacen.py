@@ -0,0 +1,439 @@
+# almacen.py - Almacén de CFDI por UUID: cada XML se guarda una sola vez, comprimido con un
+# diccionario zstd entrenado con los propios CFDI del cliente, en segmentos de solo-agregar
+# (clientes/<RFC>/almacen/NNNNNN.seg). indice.idx es un arreglo ordenado de registros fijos
+# UUID → (segmento, posición, largo) que se lee con mmap y búsqueda binaria; lo agregado desde
+# la última compactación está en indice.log. paquetes.txt guarda qué rango de qué segmento
+# escribió cada paquete, para ingestarlo o recorrerlo sin el zip.
+# Uso: python -m utils.almacen importar|compactar|entrenar|info [RFC]
+#      python -m utils.almacen xml <UUID> [RFC]
+import itertools
+import mmap
+import os
+import struct
+import sys
+import threading
+import uuid as uuidlib
+import zipfile
+from utils import archivos
+from utils.dedup import uuid_de_miembro
+from utils.lazy import lazy_import
+from utils.token_manager import file_lock
+
+zstd = lazy_import("zstandard")
+
+NIVEL = 6
+SEGMENTO_MB = 256
+DICCIONARIO_KB = 112
+# CFDI para entrenar el diccionario: con menos se guardan sin diccionario hasta juntar más
+MUESTRAS_MIN = 64
+MUESTRAS_MAX = 2000
+# Registros en indice.log antes de mezclarlos en indice.idx
+COMPACTAR = 50_000
+
+MAGIA = b"CFDI"
+_CABECERA = struct.Struct("<4s16sHI")   # magia, uuid, largo del nombre, largo del frame zstd
+_REGISTRO = struct.Struct("<16sIQI")    # uuid, segmento, posición, largo (cabecera + nombre + frame)
+
+
+def uuid_bytes(uuid):
+    return uuid if isinstance(uuid, bytes) else uuidlib.UUID(str(uuid)).bytes
+
+
+class _Indice:
+    # indice.idx en memoria (mmap); se cambia completo cuando otro proceso compacta
+
+    def __init__(self, path):
+        self.ino = None
+        self.datos = b""
+        try:
+            with open(path, "rb") as f:
+                st = os.fstat(f.fileno())
+                self.ino = st.st_ino
+                if st.st_size:
+                    self.datos = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+        self.n = len(self.datos) // _REGISTRO.size
+
+    def posicion(self, uuid):
+        # Primer registro con UUID >= uuid (búsqueda binaria)
+        datos, tam = self.datos, _REGISTRO.size
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if datos[mid * tam:mid * tam + 16] < uuid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def buscar(self, uuid):
+        i = self.posicion(uuid)
+        if i < self.n and self.datos[i * _REGISTRO.size:i * _REGISTRO.size + 16] == uuid:
+            return _REGISTRO.unpack_from(self.datos, i * _REGISTRO.size)[1:]
+        return None
+
+
+class Almacen:
+
+    def __init__(self, directorio, nivel=NIVEL, segmento_mb=SEGMENTO_MB):
+        self.directorio = directorio
+        self.nivel = nivel
+        self.max_segmento = int(segmento_mb * (1 << 20))
+        self.idx_path = os.path.join(directorio, "indice.idx")
+        self.log_path = os.path.join(directorio, "indice.log")
+        self.paquetes_path = os.path.join(directorio, "paquetes.txt")
+        self.dic_dir = os.path.join(directorio, "diccionarios")
+        self.lock_path = os.path.join(directorio, "almacen.lock")
+        os.makedirs(self.dic_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._local = threading.local()       # descompresores por hilo (no son seguros entre hilos)
+        self._diccionarios = {}               # dict_id → ZstdCompressionDict
+        self._fds = {}                        # segmento → descriptor para os.pread
+        self._indice = _Indice(self.idx_path)
+        self._nuevos = {}                     # lo de indice.log: uuid → (segmento, posición, largo)
+        self._log_ino = None
+        self._log_leido = 0
+        self._refrescar()
+
+    # --- índice -------------------------------------------------------------
+
+    def _refrescar(self):
+        # Lo que otro proceso agregó (indice.log creció) o compactó (archivos nuevos)
+        with self._lock:
+            try:
+                ino = os.stat(self.idx_path).st_ino
+            except FileNotFoundError:
+                ino = None
+            if ino != self._indice.ino:
+                self._indice = _Indice(self.idx_path)
+
+            try:
+                st = os.stat(self.log_path)
+            except FileNotFoundError:
+                st = None
+            if st is None or st.st_ino != self._log_ino or st.st_size < self._log_leido:
+                self._nuevos, self._log_ino, self._log_leido = {}, st and st.st_ino, 0
+            if st is None or st.st_size == self._log_leido:
+                return
+            with open(self.log_path, "rb") as f:
+                f.seek(self._log_leido)
+                datos = f.read(st.st_size - self._log_leido)
+            completos = len(datos) - len(datos) % _REGISTRO.size
+            for uuid, *ubicacion in _REGISTRO.iter_unpack(datos[:completos]):
+                self._nuevos[uuid] = tuple(ubicacion)
+            self._log_leido += completos
+
+    def _ubicar(self, uuid):
+        return self._nuevos.get(uuid) or self._indice.buscar(uuid)
+
+    def ubicar(self, uuid):
+        # (segmento, posición, largo) o None; si no está se revisa lo que agregaron otros procesos
+        uuid = uuid_bytes(uuid)
+        ubicacion = self._ubicar(uuid)
+        if ubicacion is None:
+            self._refrescar()
+            ubicacion = self._ubicar(uuid)
+        return ubicacion
+
+    def __contains__(self, uuid):
+        return self.ubicar(uuid) is not None
+
+    def __len__(self):
+        return self._indice.n + len(self._nuevos)
+
+    def compactar(self):
+        # Mezcla indice.log en indice.idx (ordenado) y deja el log vacío
+        with self._lock, file_lock(self.lock_path):
+            self._refrescar()
+            self._compactar()
+
+    def _compactar(self):
+        if not self._nuevos:
+            return
+        indice, tam = self._indice, _REGISTRO.size
+        tmp = self.idx_path + ".tmp"
+        with open(tmp, "wb") as out:
+            i = 0
+            for uuid, ubicacion in sorted(self._nuevos.items()):
+                # Los registros del índice menores que uuid se copian en bloque
+                j = indice.posicion(uuid)
+                out.write(indice.datos[i * tam:j * tam])
+                i = j + 1 if j < indice.n and indice.datos[j * tam:j * tam + 16] == uuid else j
+                out.write(_REGISTRO.pack(uuid, *ubicacion))
+            out.write(indice.datos[i * tam:indice.n * tam])
+            out.flush()
+            os.fsync(out.fileno())
+        archivos.reemplazar(tmp, self.idx_path)
+        archivos.escribir_atomico(self.log_path, b"")
+        self._refrescar()
+
+    # --- diccionarios -------------------------------------------------------
+
+    def _diccionario(self, dict_id):
+        dic = self._diccionarios.get(dict_id)
+        if dic is None:
+            with open(os.path.join(self.dic_dir, f"{dict_id}.zdict"), "rb") as f:
+                dic = self._diccionarios[dict_id] = zstd.ZstdCompressionDict(f.read())
+        return dic
+
+    def diccionario_actual(self):
+        try:
+            with open(os.path.join(self.dic_dir, "actual"), encoding="utf-8") as f:
+                return self._diccionario(int(f.read().strip()))
+        except FileNotFoundError:
+            return None
+
+    def entrenar(self, muestras):
+        # Diccionario nuevo para lo que se escriba de aquí en adelante; los frames ya
+        # escritos guardan el id del suyo y se siguen leyendo con él
+        with self._lock, file_lock(self.lock_path):
+            return self._entrenar(muestras)
+
+    def _entrenar(self, muestras):
+        muestras = [m for _, m in zip(range(MUESTRAS_MAX), muestras)]
+        if len(muestras) < MUESTRAS_MIN:
+            return None
+        try:
+            dic = zstd.train_dictionary(DICCIONARIO_KB * 1024, muestras, level=self.nivel)
+        except zstd.ZstdError as e:
+            print(f"(⚠) No se pudo entrenar el diccionario del almacén: {e}")
+            return None
+        archivos.escribir_atomico(os.path.join(self.dic_dir, f"{dic.dict_id()}.zdict"), dic.as_bytes())
+        archivos.escribir_atomico(os.path.join(self.dic_dir, "actual"), str(dic.dict_id()))
+        self._diccionarios[dic.dict_id()] = dic
+        return dic
+
+    # --- escritura ----------------------------------------------------------
+
+    def _segmentos(self):
+        return sorted(int(n[:-4]) for n in os.listdir(self.directorio) if n.endswith(".seg") and n[:-4].isdigit())
+
+    def _ruta_segmento(self, segmento):
+        return os.path.join(self.directorio, f"{segmento:06d}.seg")
+
+    def _segmento_para_escribir(self):
+        segmentos = self._segmentos()
+        segmento = segmentos[-1] if segmentos else 1
+        if segmentos and os.path.getsize(self._ruta_segmento(segmento)) >= self.max_segmento:
+            segmento += 1
+        return segmento, open(self._ruta_segmento(segmento), "ab")
+
+    def agregar_paquete(self, zip_path, id_paquete):
+        # Guarda los CFDI del zip que no estén ya; regresa {"nuevos", "existentes", "bytes", "comprimidos"}
+        resumen = {"nuevos": 0, "existentes": 0, "bytes": 0, "comprimidos": 0}
+        registros = []
+        with zipfile.ZipFile(zip_path) as z, self._lock, file_lock(self.lock_path):
+            self._refrescar()
+            miembros = [i for i in z.infolist() if not i.is_dir() and i.filename.lower().endswith(".xml")]
+            dic = self.diccionario_actual()
+            if dic is None:
+                # Se entrena en cuanto hay suficientes CFDI, contando los que ya se guardaron sin él
+                dic = self._entrenar(itertools.chain((z.read(i) for i in miembros),
+                                                     (xml for _, _, xml in self.recorrer())))
+            compresor = zstd.ZstdCompressor(level=self.nivel, dict_data=dic) if dic else \
+                zstd.ZstdCompressor(level=self.nivel)
+
+            segmento, salida = self._segmento_para_escribir()
+            with salida:
+                inicio = salida.tell()
+                en_paquete = set()
+                for info in miembros:
+                    contenido = z.read(info)
+                    uuid = uuid_de_miembro(info.filename, contenido)
+                    if uuid is None:
+                        continue
+                    if uuid in en_paquete or self._ubicar(uuid) is not None:
+                        resumen["existentes"] += 1
+                        continue
+                    en_paquete.add(uuid)
+                    frame = compresor.compress(contenido)
+                    nombre = info.filename.encode("utf-8")
+                    posicion = salida.tell()
+                    salida.write(_CABECERA.pack(MAGIA, uuid, len(nombre), len(frame)))
+                    salida.write(nombre)
+                    salida.write(frame)
+                    registros.append((uuid, (segmento, posicion, salida.tell() - posicion)))
+                    resumen["nuevos"] += 1
+                    resumen["bytes"] += len(contenido)
+                    resumen["comprimidos"] += len(frame)
+                salida.flush()
+                os.fsync(salida.fileno())
+                fin = salida.tell()
+
+            # Primero el rango del paquete y luego el índice: si se cae en medio, el paquete se
+            # vuelve a guardar en otro rango (los UUID aún no están en el índice)
+            self._anotar_paquete(id_paquete, segmento, inicio, fin, bool(registros))
+            if registros:
+                with open(self.log_path, "ab") as log:
+                    log.write(b"".join(_REGISTRO.pack(u, *ubicacion) for u, ubicacion in registros))
+                    log.flush()
+                    os.fsync(log.fileno())
+                self._refrescar()
+                if len(self._nuevos) >= COMPACTAR:
+                    self._compactar()
+        return resumen
+
+    def _anotar_paquete(self, id_paquete, segmento, inicio, fin, escribio):
+        lineas = archivos.leer_lineas(self.paquetes_path)
+        previas = [l for l in lineas if l.split("\t", 1)[0] != id_paquete]
+        if not escribio and len(previas) != len(lineas):
+            # Repetido sin CFDI nuevos: se conserva el rango donde quedaron la primera vez
+            return
+        archivos.escribir_lineas(self.paquetes_path, previas + [f"{id_paquete}\t{segmento}\t{inicio}\t{fin}"])
+
+    # --- lectura ------------------------------------------------------------
+
+    def paquetes(self):
+        # id_paquete → (segmento, inicio, fin)
+        rangos = {}
+        for linea in archivos.leer_lineas(self.paquetes_path):
+            id_paquete, segmento, inicio, fin = linea.split("\t")
+            rangos[id_paquete] = (int(segmento), int(inicio), int(fin))
+        return rangos
+
+    def _fd(self, segmento):
+        fd = self._fds.get(segmento)
+        if fd is None:
+            with self._lock:
+                fd = self._fds.get(segmento)
+                if fd is None:
+                    fd = self._fds[segmento] = os.open(self._ruta_segmento(segmento), os.O_RDONLY)
+        return fd
+
+    def _descomprimir(self, frame):
+        dict_id = zstd.get_frame_parameters(frame).dict_id
+        descompresores = getattr(self._local, "descompresores", None)
+        if descompresores is None:
+            descompresores = self._local.descompresores = {}
+        descompresor = descompresores.get(dict_id)
+        if descompresor is None:
+            descompresor = descompresores[dict_id] = zstd.ZstdDecompressor(
+                dict_data=self._diccionario(dict_id)) if dict_id else zstd.ZstdDecompressor()
+        return descompresor.decompress(frame)
+
+    def _registro(self, datos):
+        magia, uuid, largo_nombre, largo_frame = _CABECERA.unpack_from(datos)
+        if magia != MAGIA:
+            raise RuntimeError("Registro inválido en el almacén (índice y segmento no coinciden)")
+        inicio = _CABECERA.size + largo_nombre
+        return uuid, datos[_CABECERA.size:inicio].decode("utf-8"), datos[inicio:inicio + largo_frame]
+
+    def obtener(self, uuid):
+        # XML del CFDI o None
+        ubicacion = self.ubicar(uuid)
+        if ubicacion is None:
+            return None
+        segmento, posicion, largo = ubicacion
+        _, _, frame = self._registro(os.pread(self._fd(segmento), largo, posicion))
+        return self._descomprimir(frame)
+
+    def _recorrer_rango(self, segmento, inicio=0, fin=None, leer=True):
+        # (uuid, nombre, xml) en el orden en que se escribieron; con leer=False xml es None
+        with open(self._ruta_segmento(segmento), "rb", buffering=1 << 20) as f:
+            f.seek(inicio)
+            fin = os.fstat(f.fileno()).st_size if fin is None else fin
+            while f.tell() < fin:
+                cabecera = f.read(_CABECERA.size)
+                if len(cabecera) < _CABECERA.size:
+                    break
+                magia, uuid, largo_nombre, largo_frame = _CABECERA.unpack(cabecera)
+                if magia != MAGIA:
+                    raise RuntimeError(f"Segmento {segmento:06d} dañado en {f.tell() - _CABECERA.size}")
+                nombre = f.read(largo_nombre).decode("utf-8")
+                if leer:
+                    yield uuid, nombre, self._descomprimir(f.read(largo_frame))
+                else:
+                    f.seek(largo_frame, os.SEEK_CUR)
+                    yield uuid, nombre, None
+
+    def iter_paquete(self, id_paquete, leer=True):
+        rango = self.paquetes().get(id_paquete)
+        if rango is None:
+            raise KeyError(f"{id_paquete} no está en el almacén")
+        yield from self._recorrer_rango(*rango, leer=leer)
+
+    def nombres(self, id_paquete):
+        return [nombre for _, nombre, _ in self.iter_paquete(id_paquete, leer=False)]
+
+    def recorrer(self):
+        # Todo el almacén, segmento por segmento (lectura secuencial)
+        for segmento in self._segmentos():
+            yield from self._recorrer_rango(segmento)
+
+    def info(self):
+        segmentos = self._segmentos()
+        dic = self.diccionario_actual()
+        return {"cfdi": len(self), "segmentos": len(segmentos),
+                "bytes": sum(os.path.getsize(self._ruta_segmento(s)) for s in segmentos),
+                "paquetes": len(self.paquetes()), "diccionario": dic.dict_id() if dic else None}
+
+
+_almacenes = {}
+_almacenes_lock = threading.Lock()
+
+
+def get_almacen(config):
+    # Almacén del cliente (None con almacen.activo: false)
+    opciones = config.get("almacen") or {}
+    if not opciones.get("activo", True):
+        return None
+    path = os.path.abspath(opciones.get("dir") or os.path.join(config["base_path"], "almacen"))
+    with _almacenes_lock:
+        almacen = _almacenes.get(path)
+        if almacen is None:
+            almacen = _almacenes[path] = Almacen(path, opciones.get("nivel", NIVEL),
+                                                 opciones.get("segmento_mb", SEGMENTO_MB))
+        return almacen
+
+
+def conservar_zips(config):
+    return (config.get("almacen") or {}).get("conservar_zips", True)
+
+
+def importar(config):
+    # Agrega al almacén los zips de CFDI ya descargados
+    from utils.cfdi import paquetes_cfdi
+
+    almacen = get_almacen(config)
+    for zip_path in paquetes_cfdi(config["base_path"]):
+        id_paquete = os.path.splitext(os.path.basename(zip_path))[0]
+        resumen = almacen.agregar_paquete(zip_path, id_paquete)
+        print(f"✓ {id_paquete}: {resumen['nuevos']} nuevos, {resumen['existentes']} ya estaban")
+    almacen.compactar()
+
+
+if __name__ == "__main__":
+    from utils.config import load_config
+
+    comando = sys.argv[1] if len(sys.argv) > 1 else "info"
+    argumentos = sys.argv[2:]
+    uuid = argumentos.pop(0) if comando == "xml" and argumentos else None
+    config = load_config(argumentos[0] if argumentos else None)
+    almacen = get_almacen(config)
+    if almacen is None:
+        print("✗ El almacén está desactivado (almacen.activo: false)")
+        sys.exit(1)
+
+    if comando == "importar":
+        importar(config)
+    elif comando == "compactar":
+        almacen.compactar()
+        print(f"✓ Índice compactado: {len(almacen)} CFDI")
+    elif comando == "entrenar":
+        dic = almacen.entrenar(xml for _, _, xml in almacen.recorrer())
+        print(f"✓ Diccionario {dic.dict_id()}" if dic else f"✗ Se necesitan al menos {MUESTRAS_MIN} CFDI")
+    elif comando == "xml" and uuid:
+        xml = almacen.obtener(uuid)
+        if xml is None:
+            print(f"✗ {uuid} no está en el almacén")
+            sys.exit(1)
+        sys.stdout.buffer.write(xml)
+    elif comando == "info":
+        for clave, valor in almacen.info().items():
+            print(f"{clave:<12} {valor}")
+    else:
+        print("Uso: python -m utils.almacen importar|compactar|entrenar|info [RFC]\n"
+              "     python -m utils.almacen xml <UUID> [RFC]")
+        sys.exit(1)
@@ -0,0 +1,92 @@
+# archivos.py - Escrituras que sobreviven a una caída: todo se escribe a un temporal en la
+# misma carpeta, se hace fsync y se renombra; quien lee ve el archivo anterior o el nuevo
+# completo, nunca uno a medias.
+import hashlib
+import os
+import zipfile
+import zlib
+
+BLOQUE = 1 << 20
+
+
+def _fsync_carpeta(carpeta):
+    # El rename queda en disco hasta que se sincroniza la carpeta (no aplica en Windows)
+    if os.name != "posix":
+        return
+    fd = os.open(carpeta or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def reemplazar(tmp, destino):
+    os.replace(tmp, destino)
+    _fsync_carpeta(os.path.dirname(os.path.abspath(destino)))
+
+
+def escribir_atomico(path, datos):
+    carpeta = os.path.dirname(os.path.abspath(path))
+    os.makedirs(carpeta, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(datos.encode("utf-8") if isinstance(datos, str) else datos)
+            f.flush()
+            os.fsync(f.fileno())
+        reemplazar(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def leer_lineas(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [l.strip() for l in f if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def escribir_lineas(path, lineas):
+    escribir_atomico(path, "".join(f"{l}\n" for l in lineas))
+
+
+def agregar_lineas(path, nuevas):
+    # Agrega al final las que no estén ya, sin perder las existentes; regresa las agregadas
+    actuales = leer_lineas(path)
+    vistas = set(actuales)
+    agregadas = [l for l in dict.fromkeys(nuevas) if l not in vistas]
+    if agregadas:
+        escribir_lineas(path, actuales + agregadas)
+    return agregadas
+
+
+def quitar_lineas(path, quitar):
+    # Reescribe sin las líneas de `quitar`; regresa cuántas quedan
+    quitar = set(quitar)
+    actuales = leer_lineas(path)
+    restantes = [l for l in actuales if l not in quitar]
+    if len(restantes) != len(actuales):
+        escribir_lineas(path, restantes)
+    return len(restantes)
+
+
+def verificar_zip(path):
+    # CRC de cada miembro; regresa (bytes, sha256 hex).
+    # RuntimeError si el archivo no está completo o no es un zip válido.
+    real = os.path.getsize(path)
+    try:
+        with zipfile.ZipFile(path) as z:
+            malo = z.testzip()
+    except (zipfile.BadZipFile, EOFError, zlib.error) as e:
+        raise RuntimeError(f"{os.path.basename(path)} no es un zip válido: {e}") from e
+    if malo is not None:
+        raise RuntimeError(f"{os.path.basename(path)}: CRC incorrecto en {malo}")
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(BLOQUE), b""):
+            sha.update(bloque)
+    return real, sha.hexdigest()
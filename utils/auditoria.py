@@ -0,0 +1,377 @@
+# auditoria.py - Archivo de auditoría: cada petición firmada al SAT y su respuesta, comprimidas
+# con zstd en segmentos de solo-agregar (<dir>/AAAAMMDD-<pid>-<n>.zst, uno por proceso) e
+# indexadas en <dir>/indice.db por RFC, servicio, IdSolicitud/IdPaquete y fecha. Registrar solo
+# encola los bytes: un hilo en segundo plano comprime, escribe y actualiza el índice.
+# Consulta y extracción: python auditoria.py (sat audit)
+import atexit
+import hashlib
+import itertools
+import logging
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+from datetime import date, datetime, timedelta
+from utils import bitacora
+from utils.lazy import lazy_import
+
+zstd = lazy_import("zstandard")
+
+NIVEL = 3
+SEGMENTO_MB = 64
+# Bloques de respuestas en streaming en cola; si el escritor se atrasa, quien los pasa espera.
+# Las peticiones y respuestas completas nunca esperan (el motor las registra desde el event loop)
+PENDIENTES = 256
+# Registros por fsync / transacción del índice
+LOTE = 1000
+SEGMENTO = re.compile(r"^(\d{8})-\d+-\d+\.zst$")
+ID_SOLICITUD = re.compile(rb'IdSolicitud="([^"]+)"')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registros (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    fecha       TEXT NOT NULL,
+    rfc         TEXT NOT NULL,
+    servicio    TEXT NOT NULL,
+    tipo        TEXT NOT NULL,
+    intercambio TEXT NOT NULL,
+    id_ref      TEXT,
+    status      TEXT,
+    completo    INTEGER NOT NULL DEFAULT 1,
+    segmento    TEXT NOT NULL,
+    posicion    INTEGER NOT NULL,
+    largo       INTEGER NOT NULL,
+    bytes       INTEGER NOT NULL,
+    sha256      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_registros_servicio ON registros (rfc, servicio, fecha);
+CREATE INDEX IF NOT EXISTS ix_registros_id ON registros (id_ref);
+CREATE INDEX IF NOT EXISTS ix_registros_intercambio ON registros (intercambio);
+CREATE INDEX IF NOT EXISTS ix_registros_segmento ON registros (segmento);
+"""
+
+COLUMNAS = ("fecha", "rfc", "servicio", "tipo", "intercambio", "id_ref", "status", "completo",
+            "segmento", "posicion", "largo", "bytes", "sha256")
+INSERTAR = f"INSERT INTO registros ({', '.join(COLUMNAS)}) VALUES ({', '.join('?' * len(COLUMNAS))})"
+
+
+def _ahora():
+    return datetime.now().isoformat(timespec="milliseconds")
+
+
+class Archivo:
+    # Segmentos + índice de una carpeta. Los registros de este proceso van a sus propios
+    # segmentos; el índice (SQLite en WAL) lo comparten todos los procesos.
+
+    def __init__(self, directorio, nivel=NIVEL, segmento_mb=SEGMENTO_MB, retencion_dias=None):
+        self.directorio = directorio
+        self.nivel = nivel
+        self.max_segmento = int(segmento_mb * (1 << 20))
+        self.retencion_dias = retencion_dias
+        self._cola = queue.Queue()
+        self._bloques = threading.Semaphore(PENDIENTES)
+        self._hilo = None
+        self._lock = threading.Lock()
+        self._flujos = itertools.count(1)
+        self._segmentos = itertools.count(1)
+        # Solo el hilo escritor toca estos
+        self._segmento = self._salida = self._dia = None
+        self._abiertos = {}
+        os.makedirs(directorio, exist_ok=True)
+        with self._conectar() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conectar(self):
+        conn = sqlite3.connect(os.path.join(self.directorio, "indice.db"), timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # --- camino de la petición (solo encola) --------------------------------
+
+    def _encolar(self, item):
+        if self._hilo is None:
+            with self._lock:
+                if self._hilo is None:
+                    self._hilo = threading.Thread(target=self._escribir, name="auditoria", daemon=True)
+                    self._hilo.start()
+        self._cola.put(item)
+
+    def registrar(self, meta, datos):
+        self._encolar(("registro", meta, datos))
+
+    def abrir_flujo(self, meta):
+        n = next(self._flujos)
+        self._encolar(("abrir", n, meta))
+        return n
+
+    def bloque(self, n, datos):
+        self._bloques.acquire()
+        self._encolar(("bloque", n, datos))
+
+    def cerrar_flujo(self, n, completo):
+        self._encolar(("cerrar", n, completo))
+
+    def cerrar(self):
+        # Vacía la cola y espera al escritor (atexit)
+        with self._lock:
+            hilo, self._hilo = self._hilo, None
+        if hilo is not None:
+            self._cola.put(None)
+            hilo.join()
+
+    # --- hilo escritor ------------------------------------------------------
+
+    def _escribir(self):
+        conn = self._conectar()
+        compresor = zstd.ZstdCompressor(level=self.nivel)
+        try:
+            self.purgar(conn)
+        except Exception as e:
+            bitacora.evento("auditoria_error", logging.WARNING, operacion="purgar", error=str(e))
+
+        fin = False
+        while not fin:
+            lote = [self._cola.get()]
+            # Lo que ya está en cola va en el mismo fsync y la misma transacción del índice
+            while lote[-1] is not None and len(lote) < LOTE:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+            fin = lote[-1] is None
+            filas, asociar = [], []
+            for item in lote[:-1] if fin else lote:
+                try:
+                    fila = self._procesar(item, compresor)
+                except Exception as e:
+                    print(f"(⚠) Auditoría: no se pudo archivar un registro: {e}")
+                    bitacora.evento("auditoria_error", logging.WARNING, operacion=item[0], error=str(e))
+                    continue
+                if fila:
+                    filas.append(fila)
+                    if fila["id_ref"] and fila["tipo"] == "respuesta":
+                        asociar.append((fila["id_ref"], fila["intercambio"]))
+            if filas:
+                try:
+                    self._salida.flush()
+                    os.fsync(self._salida.fileno())
+                    with conn:
+                        conn.executemany(INSERTAR, [tuple(f[c] for c in COLUMNAS) for f in filas])
+                        # La petición de una solicitud no lleva IdSolicitud: toma el de su respuesta
+                        conn.executemany("UPDATE registros SET id_ref = ? WHERE intercambio = ? AND id_ref IS NULL",
+                                         asociar)
+                except Exception as e:
+                    print(f"(⚠) Auditoría: no se pudo actualizar el índice: {e}")
+                    bitacora.evento("auditoria_error", logging.WARNING, operacion="indice", error=str(e))
+        if self._salida is not None:
+            self._salida.close()
+            self._salida = None
+        conn.close()
+
+    def _procesar(self, item, compresor):
+        tipo = item[0]
+        if tipo == "registro":
+            _, meta, datos = item
+            if meta["servicio"] == "solicitud" and meta["tipo"] == "respuesta" and not meta["id_ref"]:
+                encontrado = ID_SOLICITUD.search(datos)
+                meta["id_ref"] = encontrado.group(1).decode() if encontrado else None
+            comprimido = compresor.compress(datos)
+            segmento, posicion = self._agregar(comprimido)
+            return dict(meta, segmento=segmento, posicion=posicion, largo=len(comprimido),
+                        bytes=len(datos), sha256=hashlib.sha256(datos).hexdigest())
+
+        if tipo == "abrir":
+            # El cuerpo se comprime a un temporal conforme llega y se copia al segmento al cerrar
+            _, n, meta = item
+            temporal = tempfile.TemporaryFile(dir=self.directorio)
+            self._abiertos[n] = {"meta": meta, "temporal": temporal, "bytes": 0, "sha": hashlib.sha256(),
+                                 # Varios flujos abiertos a la vez: cada uno con su propio contexto de zstd
+                                 "escritor": zstd.ZstdCompressor(level=self.nivel).stream_writer(temporal, closefd=False)}
+            return None
+
+        if tipo == "bloque":
+            self._bloques.release()
+        estado = self._abiertos.get(item[1])
+        if estado is None:
+            return None
+        if tipo == "bloque":
+            estado["escritor"].write(item[2])
+            estado["sha"].update(item[2])
+            estado["bytes"] += len(item[2])
+            return None
+
+        # cerrar
+        del self._abiertos[item[1]]
+        with estado["temporal"] as temporal:
+            estado["escritor"].flush(zstd.FLUSH_FRAME)
+            largo = temporal.tell()
+            temporal.seek(0)
+            segmento, posicion = self._agregar(temporal)
+        return dict(estado["meta"], completo=int(item[2]), segmento=segmento, posicion=posicion,
+                    largo=largo, bytes=estado["bytes"], sha256=estado["sha"].hexdigest())
+
+    def _agregar(self, datos):
+        # Agrega al segmento actual (bytes o archivo); uno nuevo por día o al llegar al tamaño máximo
+        hoy = date.today()
+        if self._salida is None or self._dia != hoy or self._salida.tell() >= self.max_segmento:
+            if self._salida is not None:
+                self._salida.close()
+            self._segmento = f"{hoy:%Y%m%d}-{os.getpid()}-{next(self._segmentos):04d}.zst"
+            self._salida = open(os.path.join(self.directorio, self._segmento), "ab")
+            self._dia = hoy
+        posicion = self._salida.tell()
+        if isinstance(datos, bytes):
+            self._salida.write(datos)
+        else:
+            shutil.copyfileobj(datos, self._salida)
+        return self._segmento, posicion
+
+    # --- retención y consulta -----------------------------------------------
+
+    def purgar(self, conn=None):
+        # Borra los segmentos de hace más de retencion_dias y sus filas del índice
+        if not self.retencion_dias:
+            return []
+        limite = (date.today() - timedelta(days=int(self.retencion_dias))).strftime("%Y%m%d")
+        borrados = []
+        propia = conn is None
+        conn = conn or self._conectar()
+        try:
+            for nombre in sorted(os.listdir(self.directorio)):
+                encontrado = SEGMENTO.match(nombre)
+                if not encontrado or encontrado.group(1) >= limite or nombre == self._segmento:
+                    continue
+                with conn:
+                    conn.execute("DELETE FROM registros WHERE segmento = ?", (nombre,))
+                try:
+                    os.remove(os.path.join(self.directorio, nombre))
+                except FileNotFoundError:
+                    pass
+                borrados.append(nombre)
+        finally:
+            if propia:
+                conn.close()
+        if borrados:
+            bitacora.evento("auditoria_purga", segmentos=len(borrados), retencion_dias=self.retencion_dias)
+        return borrados
+
+    def registro(self, id_registro):
+        with self._conectar() as conn:
+            fila = conn.execute("SELECT * FROM registros WHERE id = ?", (id_registro,)).fetchone()
+        return dict(fila) if fila else None
+
+    def buscar(self, rfc=None, servicio=None, id_ref=None, desde=None, hasta=None, limite=None):
+        condiciones, parametros = [], []
+        if rfc:
+            condiciones.append("rfc = ?")
+            parametros.append(rfc)
+        if servicio:
+            condiciones.append("servicio = ?")
+            parametros.append(servicio)
+        if id_ref:
+            condiciones.append("id_ref = ?")
+            parametros.append(id_ref)
+        if desde:
+            condiciones.append("fecha >= ?")
+            parametros.append(str(desde))
+        if hasta:
+            # Una fecha sin hora incluye todo ese día
+            condiciones.append("fecha < ?" if "T" in str(hasta) else "substr(fecha, 1, 10) <= ?")
+            parametros.append(str(hasta))
+        sql = "SELECT * FROM registros"
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        sql += " ORDER BY id DESC"
+        if limite:
+            sql += f" LIMIT {int(limite)}"
+        with self._conectar() as conn:
+            return [dict(r) for r in conn.execute(sql, parametros)][::-1]
+
+    def leer(self, registro):
+        with open(os.path.join(self.directorio, registro["segmento"]), "rb") as f:
+            f.seek(registro["posicion"])
+            comprimido = f.read(registro["largo"])
+        # decompressobj: los flujos se escriben sin tamaño de contenido en el encabezado
+        datos = zstd.ZstdDecompressor().decompressobj().decompress(comprimido)
+        if hashlib.sha256(datos).hexdigest() != registro["sha256"]:
+            raise RuntimeError(f"Registro {registro['id']}: sha256 no coincide con el índice")
+        return datos
+
+
+class Intercambio:
+    # Una petición al SAT y su respuesta (comparten `clave` en el índice). Sin archivo
+    # configurado (auditoria.dir) no hace nada y flujo() solo deja pasar los bloques.
+
+    def __init__(self, archivo, config, servicio, id_ref=None):
+        self.archivo = archivo
+        self.servicio = servicio
+        self.id_ref = id_ref
+        self.rfc = config.get("rfc") or config.get("cliente_rfc") or ""
+        self.clave = uuid.uuid4().hex if archivo is not None else None
+
+    def _meta(self, tipo, status=None):
+        return {"fecha": _ahora(), "rfc": self.rfc, "servicio": self.servicio, "tipo": tipo,
+                "intercambio": self.clave, "id_ref": self.id_ref,
+                "status": None if status is None else str(status), "completo": 1}
+
+    def peticion(self, datos):
+        if self.archivo is not None and datos:
+            self.archivo.registrar(self._meta("peticion"), datos.encode("utf-8") if isinstance(datos, str) else datos)
+
+    def respuesta(self, datos, status=None):
+        if self.archivo is not None and datos is not None:
+            self.archivo.registrar(self._meta("respuesta", status), datos)
+
+    def flujo(self, bloques, status=None):
+        # Deja pasar los bloques de una respuesta en streaming y los archiva conforme pasan;
+        # si quien lee se detiene o falla, queda registrado como incompleto
+        if self.archivo is None:
+            yield from bloques
+            return
+        n = self.archivo.abrir_flujo(self._meta("respuesta", status))
+        completo = False
+        try:
+            for bloque in bloques:
+                self.archivo.bloque(n, bloque)
+                yield bloque
+            completo = True
+        finally:
+            self.archivo.cerrar_flujo(n, completo)
+
+
+_archivos = {}
+_archivos_lock = threading.Lock()
+
+
+def get_archivo(config):
+    # Archivo de auditoria.dir (None si no está configurado), uno por carpeta y proceso
+    opciones = config.get("auditoria") or {}
+    if not opciones.get("dir"):
+        return None
+    path = os.path.abspath(opciones["dir"])
+    with _archivos_lock:
+        archivo = _archivos.get(path)
+        if archivo is None:
+            if not _archivos:
+                atexit.register(cerrar)
+            archivo = Archivo(path, opciones.get("nivel", NIVEL), opciones.get("segmento_mb", SEGMENTO_MB),
+                              opciones.get("retencion_dias"))
+            _archivos[path] = archivo
+        return archivo
+
+
+def intercambio(config, servicio, id_ref=None):
+    return Intercambio(get_archivo(config), config, servicio, id_ref)
+
+
+def cerrar():
+    with _archivos_lock:
+        archivos = list(_archivos.values())
+    for archivo in archivos:
+        archivo.cerrar()
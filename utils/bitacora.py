@@ -0,0 +1,74 @@
+# bitacora.py - Log estructurado del pipeline: un evento por línea, en JSON o texto clave=valor,
+# con rfc, servicio, fase, etc. como campos. Lleva lo mismo que los print de los scripts
+# para poder filtrarlo y agregarlo sin parsear texto libre.
+import json
+import logging
+import logging.handlers
+import os
+import threading
+
+log = logging.getLogger("sat")
+# Sin configurar (uso como librería) no se escribe nada
+log.addHandler(logging.NullHandler())
+
+# Rotación del archivo de log
+MAX_BYTES = 10 * 1024 * 1024
+RESPALDOS = 5
+
+_configurado = False
+_lock = threading.Lock()
+
+
+class FormatoJSON(logging.Formatter):
+
+    def format(self, record):
+        datos = {"ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+                 "nivel": record.levelname, "evento": record.getMessage()}
+        datos.update(getattr(record, "campos", {}))
+        if record.exc_info:
+            datos["error"] = self.formatException(record.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class FormatoTexto(logging.Formatter):
+
+    def format(self, record):
+        campos = " ".join(f"{k}={_valor_texto(v)}" for k, v in getattr(record, "campos", {}).items())
+        linea = f"{self.formatTime(record, '%Y-%m-%d %H:%M:%S')} {record.levelname:<7} {record.getMessage()}"
+        return f"{linea} {campos}" if campos else linea
+
+
+def _valor_texto(valor):
+    texto = str(valor)
+    return json.dumps(texto, ensure_ascii=False) if not texto or any(c in texto for c in ' "=') else texto
+
+
+def configurar(config=None):
+    # Una vez por proceso: log.formato / log.nivel / log.archivo de config.yml, o las variables
+    # SAT_LOG_FORMATO, SAT_LOG_NIVEL y SAT_LOG_ARCHIVO (archivo vacío = stderr)
+    global _configurado
+    opciones = (config or {}).get("log") or {}
+    formato = os.environ.get("SAT_LOG_FORMATO") or opciones.get("formato") or "json"
+    nivel = os.environ.get("SAT_LOG_NIVEL") or opciones.get("nivel") or "INFO"
+    archivo = os.environ.get("SAT_LOG_ARCHIVO", opciones.get("archivo"))
+
+    with _lock:
+        if _configurado:
+            return log
+        if archivo:
+            os.makedirs(os.path.dirname(os.path.abspath(archivo)), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(archivo, maxBytes=MAX_BYTES,
+                                                           backupCount=RESPALDOS, encoding="utf-8")
+        else:
+            handler = logging.StreamHandler()
+        handler.setFormatter(FormatoTexto() if formato == "texto" else FormatoJSON())
+        log.addHandler(handler)
+        log.setLevel(str(nivel).upper())
+        log.propagate = False
+        _configurado = True
+    return log
+
+
+def evento(nombre, nivel=logging.INFO, **campos):
+    if log.isEnabledFor(nivel):
+        log.log(nivel, nombre, extra={"campos": campos})
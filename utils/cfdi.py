@@ -0,0 +1,204 @@
+import glob
+import io
+import os
+import re
+import sqlite3
+import threading
+import zipfile
+from datetime import datetime
+from utils.lazy import lazy_import
+from utils.metadata import es_paquete_metadata
+
+etree = lazy_import("lxml.etree")
+
+# Campos que se extraen de cada CFDI: (columna, elemento, atributo)
+CAMPOS = [
+    ("uuid", "TimbreFiscalDigital", "UUID"),
+    ("version", "Comprobante", "Version"),
+    ("serie", "Comprobante", "Serie"),
+    ("folio", "Comprobante", "Folio"),
+    ("fecha", "Comprobante", "Fecha"),
+    ("tipo_comprobante", "Comprobante", "TipoDeComprobante"),
+    ("forma_pago", "Comprobante", "FormaPago"),
+    ("metodo_pago", "Comprobante", "MetodoPago"),
+    ("moneda", "Comprobante", "Moneda"),
+    ("tipo_cambio", "Comprobante", "TipoCambio"),
+    ("subtotal", "Comprobante", "SubTotal"),
+    ("descuento", "Comprobante", "Descuento"),
+    ("total", "Comprobante", "Total"),
+    ("lugar_expedicion", "Comprobante", "LugarExpedicion"),
+    ("no_certificado", "Comprobante", "NoCertificado"),
+    ("rfc_emisor", "Emisor", "Rfc"),
+    ("nombre_emisor", "Emisor", "Nombre"),
+    ("regimen_fiscal_emisor", "Emisor", "RegimenFiscal"),
+    ("rfc_receptor", "Receptor", "Rfc"),
+    ("nombre_receptor", "Receptor", "Nombre"),
+    ("uso_cfdi", "Receptor", "UsoCFDI"),
+    ("total_impuestos_trasladados", "Impuestos", "TotalImpuestosTrasladados"),
+    ("total_impuestos_retenidos", "Impuestos", "TotalImpuestosRetenidos"),
+    ("fecha_timbrado", "TimbreFiscalDigital", "FechaTimbrado"),
+    ("rfc_prov_certif", "TimbreFiscalDigital", "RfcProvCertif"),
+    ("no_certificado_sat", "TimbreFiscalDigital", "NoCertificadoSAT"),
+]
+COLUMNAS = [c for c, _, _ in CAMPOS] + ["id_paquete", "archivo"]
+
+_UUID = re.compile(r"[0-9A-F]{8}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{4}-[0-9A-F]{12}")
+
+# Elementos de interés y la profundidad a la que aparecen (Impuestos solo el global)
+_PROFUNDIDAD = {"Comprobante": 0, "Emisor": 1, "Receptor": 1, "Impuestos": 1}
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+def extraer_campos(fileobj):
+    # Lee un CFDI con iterparse y regresa {columna: valor}; los nodos ya vistos
+    # se liberan conforme avanza, así que la memoria no depende del tamaño del XML
+    attrs = {}
+    profundidad = -1
+    for evento, elem in etree.iterparse(fileobj, events=("start", "end"), resolve_entities=False,
+                                        huge_tree=True):
+        if evento == "start":
+            profundidad += 1
+            nombre = _local(elem.tag)
+            if nombre == "TimbreFiscalDigital" or _PROFUNDIDAD.get(nombre) == profundidad:
+                attrs.setdefault(nombre, dict(elem.attrib))
+        else:
+            profundidad -= 1
+            if profundidad >= 0:
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    return {col: attrs.get(elemento, {}).get(attr) for col, elemento, attr in CAMPOS}
+
+
+def iter_miembros_xml(zip_path, omitir=()):
+    # (nombre, archivo abierto) de cada XML del paquete, sin extraer a disco
+    with zipfile.ZipFile(zip_path) as z:
+        for info in z.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(".xml") or info.filename in omitir:
+                continue
+            with z.open(info) as f:
+                yield info.filename, f
+
+
+def uuid_de_nombre(nombre):
+    # Los XML del SAT se llaman <UUID>.xml
+    base = os.path.splitext(os.path.basename(nombre))[0].upper()
+    return base if _UUID.fullmatch(base) else None
+
+
+def iter_miembros_almacen(directorio, id_paquete, omitir=()):
+    # Lo mismo que iter_miembros_xml para un paquete guardado en el almacén (utils/almacen.py)
+    from utils.almacen import Almacen
+
+    for _, nombre, xml in Almacen(directorio).iter_paquete(id_paquete):
+        if nombre not in omitir:
+            yield nombre, io.BytesIO(xml)
+
+
+def leer_paquete(zip_path, omitir=()):
+    # Pensada para correr en un proceso aparte: regresa (id_paquete, filas, errores).
+    # `omitir`: miembros que no hace falta parsear (UUID ya en la base)
+    id_paquete = os.path.splitext(os.path.basename(zip_path))[0]
+    return _leer_miembros(id_paquete, iter_miembros_xml(zip_path, omitir))
+
+
+def leer_paquete_almacen(directorio, id_paquete, omitir=()):
+    return _leer_miembros(id_paquete, iter_miembros_almacen(directorio, id_paquete, omitir))
+
+
+def _leer_miembros(id_paquete, miembros):
+    filas, errores = [], []
+    for nombre, f in miembros:
+        try:
+            campos = extraer_campos(f)
+        except etree.XMLSyntaxError as e:
+            errores.append((nombre, str(e)))
+            continue
+        if not campos["uuid"]:
+            errores.append((nombre, "sin TimbreFiscalDigital"))
+            continue
+        campos["uuid"] = campos["uuid"].upper()
+        campos["id_paquete"] = id_paquete
+        campos["archivo"] = nombre
+        filas.append(tuple(campos[c] for c in COLUMNAS))
+    return id_paquete, filas, errores
+
+
+def paquetes_cfdi(base_path):
+    # Zips de CFDI (no metadata) descargados para un cliente, todos los años
+    rutas = glob.glob(os.path.join(base_path, "*", "paquetes", "**", "*.zip"), recursive=True)
+    return sorted(p for p in rutas if not es_paquete_metadata(p))
+
+
+class CfdiDB:
+    # Tabla de comprobantes por UUID en SQLite (WAL), alimentada por lotes
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        columnas = ",\n    ".join(f"{c} TEXT" for c in COLUMNAS[1:])
+        self.conn.executescript(f"""
+CREATE TABLE IF NOT EXISTS comprobantes (
+    uuid TEXT PRIMARY KEY,
+    {columnas}
+);
+CREATE INDEX IF NOT EXISTS ix_comprobantes_fecha ON comprobantes (fecha);
+CREATE INDEX IF NOT EXISTS ix_comprobantes_receptor ON comprobantes (rfc_receptor);
+CREATE TABLE IF NOT EXISTS paquetes_ingestados (
+    id_paquete TEXT PRIMARY KEY,
+    comprobantes INTEGER NOT NULL,
+    errores INTEGER NOT NULL,
+    fecha TEXT NOT NULL
+);
+""")
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def uuids_existentes(self, uuids, lote=500):
+        # Cuáles de `uuids` ya están en comprobantes (consultas por lotes)
+        uuids = list(uuids)
+        existentes = set()
+        for i in range(0, len(uuids), lote):
+            parte = uuids[i:i + lote]
+            existentes.update(f[0] for f in self.conn.execute(
+                f"SELECT uuid FROM comprobantes WHERE uuid IN ({', '.join('?' * len(parte))})", parte))
+        return existentes
+
+    def ingestados(self):
+        return {f[0] for f in self.conn.execute("SELECT id_paquete FROM paquetes_ingestados")}
+
+    def agregar_paquete(self, id_paquete, filas, errores=0):
+        # Inserta el lote del paquete en una transacción; regresa cuántos UUID eran nuevos
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            antes = conn.total_changes
+            conn.executemany(
+                f"INSERT OR IGNORE INTO comprobantes ({', '.join(COLUMNAS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNAS))})", filas)
+            nuevos = conn.total_changes - antes
+            conn.execute("INSERT OR REPLACE INTO paquetes_ingestados (id_paquete, comprobantes, errores, fecha) "
+                         "VALUES (?, ?, ?, ?)",
+                         (id_paquete, len(filas), errores, datetime.now().isoformat(timespec="seconds")))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return nuevos
+
+
+def get_cfdi_db(config):
+    return CfdiDB(config.get("cfdi_db_path") or os.path.join(config["base_path"], "cfdi.db"))
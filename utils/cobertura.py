@@ -0,0 +1,195 @@
+import os
+import sqlite3
+from datetime import date, timedelta
+from utils.historial_db import get_historial, id_solicitud_de_paquete
+from utils.metadata import iter_metadata, paquetes_metadata
+
+# Un CFDI puede certificarse hasta 72 h después de emitido: los últimos días de una
+# solicitud no se dan por completos hasta que pase este margen
+MARGEN_CERTIFICACION = 3
+
+# El SAT conserva los paquetes de una solicitud lista 72 h; después ya no se pueden bajar
+VIGENCIA_PAQUETES = 3
+
+EN_CURSO = ("solicitado", "listo_para_descarga")
+
+
+def _dia(texto):
+    try:
+        return date.fromisoformat(str(texto)[:10]) if texto else None
+    except ValueError:
+        return None
+
+
+def fusionar(intervalos):
+    # Une intervalos [(inicio, fin)] que se traslapan o son contiguos
+    resultado = []
+    for inicio, fin in sorted(i for i in intervalos if i[0] <= i[1]):
+        if resultado and inicio <= resultado[-1][1] + timedelta(days=1):
+            resultado[-1] = (resultado[-1][0], max(resultado[-1][1], fin))
+        else:
+            resultado.append((inicio, fin))
+    return resultado
+
+
+def restar(inicio, fin, intervalos):
+    # Huecos de [inicio, fin] que no cubre ninguno de los intervalos
+    huecos, desde = [], inicio
+    for a, b in fusionar(intervalos):
+        if b < desde or a > fin:
+            continue
+        if a > desde:
+            huecos.append((desde, a - timedelta(days=1)))
+        desde = max(desde, b + timedelta(days=1))
+    if desde <= fin:
+        huecos.append((desde, fin))
+    return huecos
+
+
+def partir_por_anio(intervalos):
+    # Cada solicitud se guarda en la carpeta del año de su fecha inicial
+    for inicio, fin in intervalos:
+        while inicio.year < fin.year:
+            cierre = date(inicio.year, 12, 31)
+            yield inicio, cierre
+            inicio = cierre + timedelta(days=1)
+        yield inicio, fin
+
+
+def clave_descarga(descarga):
+    # (tipo_solicitud, tipo_comp, rfc_emisor) de config["descarga"], para comparar filtros
+    return (descarga.get("tipo_solicitud", "CFDI"), descarga.get("tipo_comp", "") or "",
+            descarga.get("rfc_emisor", "") or "")
+
+
+def clave_solicitud(s):
+    # La misma clave para una solicitud del historial
+    return (s["tipo_solicitud"] or "", s["tipo_comp"] or "", s["rfc_emisor"] or "")
+
+
+def _paquetes_perdidos(s, paquetes, hoy):
+    # Una solicitud lista con un paquete en error, o con paquetes que el SAT ya no conserva,
+    # no va a quedar descargada: su rango vuelve a ser un hueco
+    if any(p["estado"] == "error" for p in paquetes):
+        return True
+    lista = _dia(s["fecha_listo"]) or _dia(s["fecha_solicitud"])
+    return lista is not None and (hoy - lista).days > VIGENCIA_PAQUETES
+
+
+def cobertura_solicitudes(db, rfc, descarga, margen=MARGEN_CERTIFICACION):
+    # (cubiertos, en_curso) según el historial: descargadas (o listas sin paquetes)
+    # cubren su rango; las que siguen en proceso no deben pedirse otra vez
+    clave = clave_descarga(descarga)
+    hoy = date.today()
+    cubiertos, en_curso = [], []
+    for s in db.solicitudes(rfc, estados=("descargado",) + EN_CURSO):
+        inicio, fin = _dia(s["fecha_inicio"]), _dia(s["fecha_fin"])
+        if clave_solicitud(s) != clave or not inicio or not fin:
+            continue
+        paquetes = db.paquetes(rfc, id_solicitud=s["id_solicitud"]) if s["estado"] == "listo_para_descarga" else []
+        if paquetes and _paquetes_perdidos(s, paquetes, hoy):
+            continue
+        sin_paquetes = s["estado"] == "listo_para_descarga" and not paquetes
+        if s["estado"] == "descargado" or sin_paquetes:
+            solicitada = _dia(s["fecha_solicitud"])
+            if solicitada:
+                fin = min(fin, solicitada - timedelta(days=margen))
+            cubiertos.append((inicio, fin))
+        else:
+            en_curso.append((inicio, fin))
+    return fusionar(cubiertos), fusionar(en_curso)
+
+
+def coincide_rfc(fila, descarga):
+    # Para paquetes de origen desconocido solo se filtra por RFC: tipo_comp "E" pide
+    # los emitidos y el paquete trae EfectoComprobante I, N, P...
+    if descarga.get("rfc_emisor") and fila.get("RfcEmisor") != descarga["rfc_emisor"]:
+        return False
+    if descarga.get("rfc_receptor") and fila.get("RfcReceptor") != descarga["rfc_receptor"]:
+        return False
+    return True
+
+
+def _rango_datos(emision_min, emision_max, certificacion_max, margen):
+    # Días de emisión completos en un paquete: hasta la última emisión vista, y no
+    # más allá de la última certificación menos el margen
+    inicio, fin = _dia(emision_min), _dia(emision_max)
+    if not inicio or not fin:
+        return None
+    certificacion = _dia(certificacion_max)
+    if certificacion:
+        fin = min(fin, certificacion - timedelta(days=margen))
+    return (inicio, fin) if inicio <= fin else None
+
+
+def cobertura_datos(config, db, margen=MARGEN_CERTIFICACION):
+    # Rango de fechas de emisión de lo ya descargado: metadata (zips) o CFDI (cfdi.db).
+    # Un paquete cuenta si su solicitud tiene los mismos filtros y ya se bajaron todos sus
+    # paquetes (con uno solo no se sabe si faltan días); si no se sabe de qué solicitud
+    # viene, solo cuentan sus renglones con los mismos RFC.
+    descarga = config["descarga"]
+    clave = clave_descarga(descarga)
+    # None: la solicitud no cuenta (otros filtros o paquetes pendientes)
+    claves = {s["id_solicitud"]: clave_solicitud(s) if s["estado"] == "descargado" else None
+              for s in db.solicitudes(config["rfc"])}
+    intervalos = []
+
+    if clave[0] == "Metadata":
+        for zip_path in paquetes_metadata(config["base_path"]):
+            id_solicitud = id_solicitud_de_paquete(os.path.splitext(os.path.basename(zip_path))[0])
+            conocido = id_solicitud in claves
+            if conocido and claves[id_solicitud] != clave:
+                continue
+            emision, certificacion = [], []
+            for fila in iter_metadata(zip_path):
+                if not conocido and not coincide_rfc(fila, descarga):
+                    continue
+                emision.append(fila.get("FechaEmision", "")[:10])
+                certificacion.append(fila.get("FechaCertificacionSat", "")[:10])
+            if emision:
+                rango = _rango_datos(min(emision), max(emision), max(certificacion), margen)
+                if rango:
+                    intervalos.append(rango)
+        return fusionar(intervalos)
+
+    path = config.get("cfdi_db_path") or os.path.join(config["base_path"], "cfdi.db")
+    if not os.path.exists(path):
+        return []
+    filtros, params = [], []
+    if descarga.get("rfc_emisor"):
+        filtros.append("rfc_emisor = ?")
+        params.append(descarga["rfc_emisor"])
+    if descarga.get("rfc_receptor"):
+        filtros.append("rfc_receptor = ?")
+        params.append(descarga["rfc_receptor"])
+    sql = ("SELECT id_paquete, MIN(substr(fecha, 1, 10)), MAX(substr(fecha, 1, 10)), "
+           "MAX(substr(fecha_timbrado, 1, 10)) FROM comprobantes {} GROUP BY id_paquete")
+
+    conn = sqlite3.connect(path)
+    try:
+        todos = {f[0]: f[1:] for f in conn.execute(sql.format(""))}
+        filtrados = {f[0]: f[1:] for f in conn.execute(
+            sql.format("WHERE " + " AND ".join(filtros) if filtros else ""), params)}
+    finally:
+        conn.close()
+
+    for id_paquete, fechas in todos.items():
+        id_solicitud = id_solicitud_de_paquete(id_paquete)
+        if id_solicitud not in claves:
+            fechas = filtrados.get(id_paquete)
+        elif claves[id_solicitud] != clave:
+            continue
+        rango = _rango_datos(*fechas, margen) if fechas else None
+        if rango:
+            intervalos.append(rango)
+    return fusionar(intervalos)
+
+
+def calcular_cobertura(config, margen=MARGEN_CERTIFICACION):
+    # Cobertura del cliente para los filtros de config["descarga"]; se guarda en historial.db.
+    # Regresa (cubiertos, en_curso)
+    db = get_historial(config)
+    cubiertos, en_curso = cobertura_solicitudes(db, config["rfc"], config["descarga"], margen)
+    cubiertos = fusionar(cubiertos + cobertura_datos(config, db, margen))
+    db.guardar_cobertura(config["rfc"], *clave_descarga(config["descarga"]), cubiertos)
+    return cubiertos, en_curso
@@ -0,0 +1,134 @@
+import copy
+import json
+import os
+import string
+import threading
+from utils.lazy import lazy_import
+
+yaml = lazy_import("yaml")
+
+CONFIG_PATH = "config.yml"
+CLIENTES_DIR = "clientes"
+# Config ya resuelta por RFC, para no importar yaml ni parsear en cada corrida
+CACHE_DIR = ".cache"
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _leer_yaml(path):
+    loader = getattr(yaml, "CSafeLoader", None) or yaml.SafeLoader
+    with open(path, encoding="utf-8") as f:
+        return yaml.load(f, Loader=loader) or {}
+
+
+def _sustituir(valor, vars_dict):
+    # ${cliente_rfc} y ${base_path} en todos los textos del config (ya parseado)
+    if isinstance(valor, str):
+        return string.Template(valor).safe_substitute(vars_dict) if "$" in valor else valor
+    if isinstance(valor, dict):
+        return {k: _sustituir(v, vars_dict) for k, v in valor.items()}
+    if isinstance(valor, list):
+        return [_sustituir(v, vars_dict) for v in valor]
+    return valor
+
+
+def _merge(base, override):
+    resultado = dict(base)
+    for clave, valor in override.items():
+        if isinstance(valor, dict) and isinstance(resultado.get(clave), dict):
+            resultado[clave] = _merge(resultado[clave], valor)
+        else:
+            resultado[clave] = valor
+    return resultado
+
+
+def _firma(paths):
+    # mtime y tamaño de cada archivo (None si no existe): si cambia, se vuelve a resolver
+    firma = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            firma.append([st.st_mtime_ns, st.st_size])
+        except FileNotFoundError:
+            firma.append(None)
+    return firma
+
+
+def _vigente(guardado):
+    return guardado is not None and _firma(guardado["archivos"]) == guardado["firma"]
+
+
+def _leer_cache_disco(cache_path):
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            guardado = json.load(f)
+        return guardado if _vigente(guardado) else None
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _escribir_cache_disco(cache_path, guardado):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(guardado, f, ensure_ascii=False)
+        os.replace(tmp, cache_path)
+    except (OSError, TypeError, ValueError):
+        # Sin permisos o con valores que JSON no representa: solo queda la caché en memoria
+        pass
+
+
+def _resolver(rfc, path):
+    # Regresa el config y los archivos de los que depende
+    base = _leer_yaml(path)
+    rfc = rfc or base["cliente_rfc"]
+    vars_dict = {"cliente_rfc": rfc, "base_path": f"{CLIENTES_DIR}/{rfc}"}
+
+    config = _sustituir(base, vars_dict)
+    override_path = os.path.join(CLIENTES_DIR, rfc, "config.yml")
+    if os.path.exists(override_path):
+        config = _merge(config, _sustituir(_leer_yaml(override_path), vars_dict))
+
+    config["cliente_rfc"] = rfc
+    return config, [os.path.abspath(path), os.path.abspath(override_path)]
+
+
+def load_config(rfc=None, path=CONFIG_PATH):
+    # config.yml resuelto para un RFC (por defecto SAT_RFC o cliente_rfc), con los valores
+    # de clientes/<RFC>/config.yml encima si ese archivo existe. Se resuelve una vez y se
+    # guarda en memoria y en .cache/ mientras no cambien los archivos; cada llamada regresa
+    # una copia porque los scripts le agregan sus rutas.
+    rfc = rfc or os.environ.get("SAT_RFC") or None
+    nombre = rfc or "_default"
+    clave = (os.path.abspath(path), os.getcwd(), nombre)
+
+    with _cache_lock:
+        guardado = _cache.get(clave)
+        if not _vigente(guardado):
+            cache_path = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR, f"config-{nombre}.json")
+            guardado = _leer_cache_disco(cache_path)
+            if guardado is None:
+                config, archivos = _resolver(rfc, path)
+                guardado = {"archivos": archivos, "firma": _firma(archivos), "config": config}
+                _escribir_cache_disco(cache_path, guardado)
+            _cache[clave] = guardado
+        return copy.deepcopy(guardado["config"])
+
+
+def listar_clientes(clientes_dir=CLIENTES_DIR):
+    # RFCs con FIEL convertida (certificados/cert.pem y fiel.pem)
+    if not os.path.isdir(clientes_dir):
+        return []
+
+    rfcs = []
+    for nombre in sorted(os.listdir(clientes_dir)):
+        cert_dir = os.path.join(clientes_dir, nombre, "certificados")
+        if not os.path.isdir(cert_dir):
+            continue
+        if not all(os.path.exists(os.path.join(cert_dir, f)) for f in ("cert.pem", "fiel.pem")):
+            print(f"(⚠) {nombre}: sin cert.pem/fiel.pem, ejecuta 0_pem.py para ese cliente")
+            continue
+        rfcs.append(nombre)
+    return rfcs
@@ -0,0 +1,342 @@
+# control.py - Control adaptativo de las peticiones al SAT. Cada RFC y servicio tiene una
+# ventana de peticiones en vuelo, y cada servicio otra para todos los RFC (el endpoint es el
+# mismo). Las ventanas se ajustan con AIMD: crecen en 1 por cada ventana de respuestas
+# buenas y se recortan a la mitad con HTTP 5xx, timeouts o errores de red (servicio
+# saturado), o con CodEstatus de límite del SAT (solo la del RFC). Con latencia muy por
+# encima de la normal el recorte es menor.
+# También decide qué se reintenta y cuánto esperar (exponencial con jitter). Una solicitud
+# solo se reintenta si es seguro que el SAT no la registró.
+# Se configura en limites.control; sin ese bloque no hay ventanas ni reintentos.
+import logging
+import random
+import threading
+import time
+from collections import deque
+from utils import bitacora, metricas
+from utils.lazy import lazy_import
+
+asyncio = lazy_import("asyncio")   # solo lo usa motor.py
+
+# Señales con las que se ajusta la ventana
+OK = "ok"
+LENTO = "lento"             # respondió, pero muy por encima de la latencia normal
+SATURADO = "saturado"       # HTTP 429/5xx, timeout o error de red: se recorta y se reintenta
+CUOTA = "cuota"             # CodEstatus de límite del SAT para el RFC: se recorta, no se reintenta
+FALLA = "falla"             # SOAP Fault: se reintenta sin recortar
+DEFINITIVO = "definitivo"   # no cambia con reintentar (HTTP 4xx, CodEstatus de la propia petición)
+
+# Factor de recorte de la ventana por señal
+RECORTE = {SATURADO: 0.5, CUOTA: 0.5, LENTO: 0.8}
+# Segundos mínimos entre recortes de una ventana (las que ya iban en vuelo no recortan otra vez)
+ESPACIO_RECORTE = 0.5
+# Suavizado de la latencia reciente y cuánto sube por muestra la latencia base (para seguir
+# un cambio permanente de la latencia del servicio)
+SUAVIZADO = 0.2
+DERIVA_BASE = 1.01
+
+# SolicitaDescarga no es idempotente: cada envío que el SAT registra es una solicitud nueva
+NO_IDEMPOTENTES = {"solicitud"}
+# CodEstatus con los que el SAT limita al RFC: 5002 solicitudes de por vida agotadas,
+# 5011 límite de descargas por folio por día
+CODIGOS_CUOTA = {"5002", "5011"}
+# Errores de red en los que la petición no alcanzó a salir (conexión rechazada o sin conectar)
+_SIN_ENVIAR = {"ConnectTimeout", "NewConnectionError", "ClientConnectorError", "ConnectionRefusedError"}
+_RED = {"RequestException", "ClientError", "TimeoutError", "OSError"}
+
+DEFAULTS = {
+    "inicial": 4,
+    "minimo": 1,
+    "maximo": 32,
+    "maximo_servicio": 64,
+    "tolerancia_latencia": 3.0,
+    "intentos": 4,
+    "espera_base": 1.0,
+    "espera_max": 60.0,
+}
+
+
+class Ventana:
+    # Peticiones en vuelo de una llave (RFC y servicio, o servicio). Se comparte entre hilos y
+    # event loops: quien no cabe espera en una cola y el cupo se le entrega al liberarse uno.
+
+    def __init__(self, nombre, inicial, minimo, maximo, tolerancia):
+        self.nombre = nombre
+        self.minimo = max(1, int(minimo))
+        self.maximo = max(self.minimo, int(maximo))
+        self.limite = float(min(max(inicial, self.minimo), self.maximo))
+        self.tolerancia = float(tolerancia)
+        self.en_vuelo = 0
+        self.base = self.reciente = None
+        self._recorte = 0.0
+        self._lock = threading.Lock()
+        self._esperando = deque()   # threading.Event o (loop, futuro)
+
+    def cupo(self):
+        return max(self.minimo, int(self.limite))
+
+    def _tomar(self):
+        # Con el lock tomado
+        if not self._esperando and self.en_vuelo < self.cupo():
+            self.en_vuelo += 1
+            return True
+        return False
+
+    def entrar(self):
+        with self._lock:
+            if self._tomar():
+                return
+            evento = threading.Event()
+            self._esperando.append(evento)
+        evento.wait()
+
+    async def entrar_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._tomar():
+                return
+            futuro = loop.create_future()
+            self._esperando.append((loop, futuro))
+        try:
+            await futuro
+        except asyncio.CancelledError:
+            with self._lock:
+                pendiente = (loop, futuro) in self._esperando
+                if pendiente:
+                    self._esperando.remove((loop, futuro))
+            # Si ya se le había entregado el cupo, se devuelve
+            if not pendiente and futuro.done() and not futuro.cancelled():
+                self.salir()
+            raise
+
+    def salir(self):
+        with self._lock:
+            self.en_vuelo -= 1
+            self._despertar()
+
+    def _despertar(self):
+        # Con el lock tomado: entrega los cupos libres en orden de llegada
+        while self._esperando and self.en_vuelo < self.cupo():
+            esperando = self._esperando.popleft()
+            self.en_vuelo += 1
+            if isinstance(esperando, threading.Event):
+                esperando.set()
+            else:
+                loop, futuro = esperando
+                loop.call_soon_threadsafe(self._entregar, futuro)
+
+    def _entregar(self, futuro):
+        # En el loop de quien espera; si ya canceló, el cupo se libera
+        if futuro.cancelled():
+            self.salir()
+        else:
+            futuro.set_result(None)
+
+    def senal(self, senal, segundos=None):
+        # Ajusta el límite; regresa el nuevo límite si hubo recorte
+        with self._lock:
+            if senal == OK and segundos is not None:
+                if self.base is None:
+                    self.base = self.reciente = segundos
+                else:
+                    self.reciente += (segundos - self.reciente) * SUAVIZADO
+                    self.base = min(segundos, self.base * DERIVA_BASE)
+                if self.reciente > self.base * self.tolerancia:
+                    senal = LENTO
+            recorte = None
+            if senal == OK:
+                # Solo crece si la ventana se está usando (si no, crecería sin medir nada)
+                if self.en_vuelo * 2 >= self.limite:
+                    self.limite = min(self.maximo, self.limite + 1 / self.limite)
+            elif senal in RECORTE:
+                ahora = time.monotonic()
+                if ahora - self._recorte >= max(ESPACIO_RECORTE, self.reciente or 0):
+                    self._recorte = ahora
+                    self.limite = max(self.minimo, self.limite * RECORTE[senal])
+                    recorte = self.limite
+            self._despertar()
+            return recorte
+
+
+class Permiso:
+    # Lugar en las ventanas del RFC y del servicio para una petición
+
+    def __init__(self, config, servicio, ventanas):
+        self.config = config
+        self.servicio = servicio
+        self.ventanas = ventanas    # (del RFC, del servicio)
+        self._liberado = False
+
+    def senal(self, senal, segundos=None):
+        _ajustar(self.config, self.servicio, self.ventanas, senal, segundos)
+
+    def liberar(self):
+        if self._liberado:
+            return
+        self._liberado = True
+        for ventana in self.ventanas:
+            ventana.salir()
+
+    def terminar(self, senal, segundos=None):
+        self.senal(senal, segundos)
+        self.liberar()
+
+
+class _SinControl:
+    # Permiso cuando limites.control no está configurado
+
+    def senal(self, senal, segundos=None):
+        pass
+
+    def liberar(self):
+        pass
+
+    def terminar(self, senal, segundos=None):
+        pass
+
+
+SIN_CONTROL = _SinControl()
+
+_ventanas = {}
+_ventanas_lock = threading.Lock()
+
+
+def opciones(config):
+    # limites.control con los valores por defecto, o None si no está configurado
+    control = (config.get("limites") or {}).get("control")
+    if not control:
+        return None
+    return dict(DEFAULTS, **{k: v for k, v in control.items() if v is not None})
+
+
+def _ventana(clave, nombre, inicial, minimo, maximo, tolerancia):
+    with _ventanas_lock:
+        ventana = _ventanas.get(clave)
+        if ventana is None:
+            ventana = _ventanas[clave] = Ventana(nombre, inicial, minimo, maximo, tolerancia)
+        return ventana
+
+
+def _ventanas_de(config, servicio, o):
+    rfc = config.get("rfc") or ""
+    return (_ventana(("rfc", rfc, servicio), f"{rfc}/{servicio}", o["inicial"], o["minimo"], o["maximo"],
+                     o["tolerancia_latencia"]),
+            _ventana(("servicio", servicio), servicio, o["inicial"], o["minimo"], o["maximo_servicio"],
+                     o["tolerancia_latencia"]))
+
+
+def _ajustar(config, servicio, ventanas, senal, segundos=None):
+    # CUOTA es del RFC; lo demás habla del servicio y cuenta para las dos ventanas
+    for ventana in ventanas[:1] if senal == CUOTA else ventanas:
+        limite = ventana.senal(senal, segundos)
+        if limite is not None:
+            metricas.recorte(config, servicio, senal)
+            bitacora.evento("ventana", logging.WARNING, rfc=config.get("rfc"), servicio=servicio,
+                            ventana=ventana.nombre, senal=senal, limite=round(limite, 2))
+
+
+def entrar(config, servicio):
+    # Espera lugar en la ventana del RFC y luego en la del servicio (siempre en ese orden)
+    o = opciones(config)
+    if o is None:
+        return SIN_CONTROL
+    ventanas = _ventanas_de(config, servicio, o)
+    ventanas[0].entrar()
+    ventanas[1].entrar()
+    return Permiso(config, servicio, ventanas)
+
+
+async def entrar_async(config, servicio):
+    o = opciones(config)
+    if o is None:
+        return SIN_CONTROL
+    ventanas = _ventanas_de(config, servicio, o)
+    await ventanas[0].entrar_async()
+    try:
+        await ventanas[1].entrar_async()
+    except BaseException:
+        ventanas[0].salir()
+        raise
+    return Permiso(config, servicio, ventanas)
+
+
+def limites():
+    # {nombre de ventana: (en vuelo, límite)} de las ventanas creadas en este proceso
+    with _ventanas_lock:
+        ventanas = list(_ventanas.values())
+    return {v.nombre: (v.en_vuelo, round(v.limite, 2)) for v in ventanas}
+
+
+# --- clasificación ------------------------------------------------------------
+
+def por_http(status, cuerpo=b""):
+    # (señal, ¿el SAT pudo haberla procesado?) de una respuesta HTTP
+    if status == 200:
+        return OK, True
+    if status in (429, 503):
+        # Rechazo explícito por carga: no llegó a procesarse
+        return SATURADO, False
+    if status >= 500 and b"Fault>" in (cuerpo or b""):
+        # El SAT contesta los SOAP Fault (p. ej. seguridad) con 500 antes de procesar
+        return FALLA, False
+    if status >= 500:
+        return SATURADO, True
+    return DEFINITIVO, False
+
+
+def por_excepcion(error):
+    # (señal, ¿el SAT pudo haberla procesado?) de una excepción al hacer la petición
+    nombres = _nombres(error)
+    if nombres & _SIN_ENVIAR:
+        return SATURADO, False
+    if nombres & _RED:
+        return SATURADO, True
+    return DEFINITIVO, False
+
+
+def _nombres(error):
+    # Clases de la excepción y de su causa (requests envuelve la de urllib3 en args[0].reason)
+    nombres = {c.__name__ for c in type(error).__mro__}
+    causa = getattr(error.args[0], "reason", None) if error.args else None
+    for otra in (causa, error.__cause__, error.__context__):
+        if isinstance(otra, BaseException):
+            nombres |= {c.__name__ for c in type(otra).__mro__}
+    return nombres
+
+
+def por_codigo(codigo):
+    if codigo in (None, "5000"):
+        return OK
+    return CUOTA if codigo in CODIGOS_CUOTA else DEFINITIVO
+
+
+def cod_estatus(config, servicio, codigo):
+    # CodEstatus de límite del SAT: recorta la ventana del RFC para ese servicio
+    if por_codigo(codigo) != CUOTA:
+        return
+    o = opciones(config)
+    if o is not None:
+        _ajustar(config, servicio, _ventanas_de(config, servicio, o), CUOTA)
+
+
+# --- reintentos ---------------------------------------------------------------
+
+def espera(config, intento, retry_after=None):
+    # Segundos antes del intento `intento + 1`: exponencial con jitter completo, o Retry-After
+    o = opciones(config) or DEFAULTS
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), o["espera_max"])
+    except ValueError:
+        pass
+    return random.uniform(0, min(o["espera_max"], o["espera_base"] * 2 ** (intento - 1)))
+
+
+def reintento(config, servicio, intento, senal, procesada, retry_after=None):
+    # Segundos a esperar antes de reintentar, o None si no se reintenta
+    o = opciones(config)
+    if o is None or intento >= o["intentos"] or senal not in (SATURADO, FALLA):
+        return None
+    if servicio in NO_IDEMPOTENTES and procesada:
+        # Pudo quedar registrada: reenviarla gastaría otra solicitud (o daría 5005)
+        return None
+    return espera(config, intento, retry_after)
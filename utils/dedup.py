@@ -0,0 +1,225 @@
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import struct
+import threading
+import uuid as uuidlib
+import zipfile
+from datetime import datetime
+
+_UUID_TFD = re.compile(rb'TimbreFiscalDigital[^>]*?\sUUID="([0-9A-Fa-f-]{36})"', re.S)
+_CABECERA = struct.Struct("<QQQQ")   # bits, hashes, elementos, generación
+
+
+class BloomFilter:
+    # Conjunto aproximado en un bytearray: ~1.2 MB por millón de UUID con 1% de falsos positivos
+
+    def __init__(self, capacidad, fp=0.01, bits=None, hashes=None, datos=None, elementos=0, generacion=0):
+        self.capacidad = capacidad
+        self.bits = bits or max(8, int(-capacidad * math.log(fp) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, round(self.bits / capacidad * math.log(2)))
+        self.datos = datos if datos is not None else bytearray((self.bits + 7) // 8)
+        self.elementos = elementos
+        self.generacion = generacion
+
+    def _posiciones(self, clave):
+        digest = hashlib.blake2b(clave, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, clave):
+        for p in self._posiciones(clave):
+            self.datos[p >> 3] |= 1 << (p & 7)
+        self.elementos += 1
+
+    def __contains__(self, clave):
+        return all(self.datos[p >> 3] & (1 << (p & 7)) for p in self._posiciones(clave))
+
+    def guardar(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_CABECERA.pack(self.bits, self.hashes, self.elementos, self.generacion))
+            f.write(self.datos)
+        os.replace(tmp, path)
+
+    @classmethod
+    def cargar(cls, path, capacidad):
+        with open(path, "rb") as f:
+            bits, hashes, elementos, generacion = _CABECERA.unpack(f.read(_CABECERA.size))
+            datos = bytearray(f.read())
+        return cls(capacidad, bits=bits, hashes=hashes, datos=datos, elementos=elementos,
+                   generacion=generacion)
+
+
+class UuidVistos:
+    # UUID (16 bytes) + SHA-256 de cada CFDI ya guardado. El Bloom filter en memoria
+    # descarta rápido los nuevos; los "tal vez" se confirman en el índice exacto (SQLite).
+
+    def __init__(self, db_path, capacidad=5_000_000):
+        self.db_path = db_path
+        self.bloom_path = os.path.splitext(db_path)[0] + ".bloom"
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS vistos ("
+                          "uuid BLOB PRIMARY KEY, sha256 BLOB NOT NULL, id_paquete TEXT, fecha TEXT"
+                          ") WITHOUT ROWID")
+
+        # user_version cuenta las escrituras; el .bloom solo sirve si es de la misma generación
+        generacion = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        self.nuevo = generacion == 0
+        self.bloom = None
+        if os.path.exists(self.bloom_path):
+            bloom = BloomFilter.cargar(self.bloom_path, capacidad)
+            if bloom.generacion == generacion:
+                self.bloom = bloom
+        if self.bloom is None:
+            total = self.conn.execute("SELECT COUNT(*) FROM vistos").fetchone()[0]
+            self._reconstruir(max(capacidad, total * 2), generacion)
+
+    def _reconstruir(self, capacidad, generacion):
+        self.bloom = BloomFilter(capacidad, generacion=generacion)
+        for (uuid,) in self.conn.execute("SELECT uuid FROM vistos"):
+            self.bloom.add(uuid)
+        self.bloom.guardar(self.bloom_path)
+
+    def estado(self, uuid, sha, id_paquete=None):
+        # "nuevo", "duplicado" (mismo contenido) o "conflicto" (mismo UUID, otro contenido).
+        # Lo registrado por el mismo paquete cuenta como nuevo: es una descarga que se
+        # repite porque la anterior se cayó antes de guardar el zip.
+        if uuid not in self.bloom:
+            return "nuevo"
+        fila = self.conn.execute("SELECT sha256, id_paquete FROM vistos WHERE uuid = ?", (uuid,)).fetchone()
+        if fila is None:
+            return "nuevo"
+        if fila[0] != sha:
+            return "conflicto"
+        return "nuevo" if id_paquete is not None and fila[1] == id_paquete else "duplicado"
+
+    def agregar(self, registros):
+        # registros: [(uuid, sha256, id_paquete)] en una transacción
+        if not registros:
+            return
+        fecha = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO vistos (uuid, sha256, id_paquete, fecha) "
+                                      "VALUES (?, ?, ?, ?)", [(u, s, p, fecha) for u, s, p in registros])
+                generacion = self.conn.execute("PRAGMA user_version").fetchone()[0] + 1
+                self.conn.execute(f"PRAGMA user_version = {generacion}")
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            for uuid, _, _ in registros:
+                if uuid not in self.bloom:
+                    self.bloom.add(uuid)
+            self.bloom.generacion = generacion
+            if self.bloom.elementos > self.bloom.capacidad:
+                self._reconstruir(self.bloom.capacidad * 2, generacion)
+            else:
+                self.bloom.guardar(self.bloom_path)
+
+
+def uuid_de_miembro(nombre, contenido):
+    # Los XML del SAT se llaman <UUID>.xml; si no, se toma del TimbreFiscalDigital
+    base = os.path.splitext(os.path.basename(nombre))[0]
+    try:
+        return uuidlib.UUID(base).bytes
+    except ValueError:
+        pass
+    m = _UUID_TFD.search(contenido)
+    return uuidlib.UUID(m.group(1).decode()).bytes if m else None
+
+
+def es_paquete_cfdi(zip_path):
+    with zipfile.ZipFile(zip_path) as z:
+        return any(n.lower().endswith(".xml") for n in z.namelist())
+
+
+def filtrar_paquete(zip_path, id_paquete, vistos):
+    # Reescribe el zip solo con los CFDI no vistos antes y los registra.
+    # Regresa {"nuevos", "duplicados", "conflictos"}.
+    resumen = {"nuevos": 0, "duplicados": 0, "conflictos": 0}
+    registros, en_paquete = [], set()
+    tmp = zip_path + ".dedup"
+    # Revisar y registrar bajo el mismo candado: dos paquetes con los mismos UUID
+    # descargados en paralelo no deben contar ambos como nuevos
+    with vistos._lock:
+        try:
+            with zipfile.ZipFile(zip_path) as zin, zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zout:
+                for info in zin.infolist():
+                    if info.is_dir():
+                        continue
+                    contenido = zin.read(info)
+                    uuid = uuid_de_miembro(info.filename, contenido) if info.filename.lower().endswith(".xml") else None
+                    if uuid is None:
+                        zout.writestr(info, contenido)
+                        continue
+
+                    sha = hashlib.sha256(contenido).digest()
+                    estado = "duplicado" if (uuid, sha) in en_paquete else vistos.estado(uuid, sha, id_paquete)
+                    if estado == "duplicado":
+                        resumen["duplicados"] += 1
+                        continue
+                    if estado == "conflicto":
+                        print(f"(⚠) {id_paquete}: {info.filename} repite un UUID con contenido distinto")
+                        resumen["conflictos"] += 1
+                    else:
+                        resumen["nuevos"] += 1
+                    en_paquete.add((uuid, sha))
+                    registros.append((uuid, sha, id_paquete))
+                    zout.writestr(info, contenido)
+            os.replace(tmp, zip_path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        vistos.agregar(registros)
+    return resumen
+
+
+def registrar_existentes(vistos, zip_paths):
+    # Carga inicial: registra los CFDI de zips ya descargados sin modificarlos
+    vistos_aqui = set()
+    for zip_path in zip_paths:
+        id_paquete = os.path.splitext(os.path.basename(zip_path))[0]
+        registros = []
+        with zipfile.ZipFile(zip_path) as z:
+            for info in z.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(".xml"):
+                    continue
+                contenido = z.read(info)
+                uuid = uuid_de_miembro(info.filename, contenido)
+                if uuid is None or uuid in vistos_aqui:
+                    continue
+                sha = hashlib.sha256(contenido).digest()
+                if vistos.estado(uuid, sha) == "nuevo":
+                    vistos_aqui.add(uuid)
+                    registros.append((uuid, sha, id_paquete))
+        vistos.agregar(registros)
+
+
+_vistos = {}
+_vistos_lock = threading.Lock()
+
+
+def get_vistos(config):
+    # Conjunto de UUID del cliente; la primera vez registra los paquetes ya descargados
+    from utils.cfdi import paquetes_cfdi
+
+    path = os.path.abspath(config.get("vistos_path") or os.path.join(config["base_path"], "vistos.db"))
+    with _vistos_lock:
+        vistos = _vistos.get(path)
+        if vistos is None:
+            vistos = UuidVistos(path)
+            if vistos.nuevo:
+                registrar_existentes(vistos, paquetes_cfdi(config["base_path"]))
+            _vistos[path] = vistos
+        return vistos
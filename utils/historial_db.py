@@ -0,0 +1,436 @@
+# historial_db.py - Historial de solicitudes y paquetes en SQLite (reemplaza historial.csv)
+# Uso: python -m utils.historial_db importar|exportar [RFC]
+import csv
+import glob
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from utils import metricas
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS solicitudes (
+    id_solicitud    TEXT PRIMARY KEY,
+    rfc             TEXT NOT NULL,
+    tipo_solicitud  TEXT,
+    fecha_inicio    TEXT,
+    fecha_fin       TEXT,
+    tipo_comp       TEXT,
+    rfc_emisor      TEXT,
+    fecha_solicitud TEXT,
+    estado          TEXT NOT NULL,
+    fecha_listo     TEXT,
+    fecha_descarga  TEXT,
+    rfc_receptor    TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_solicitudes_parametros
+    ON solicitudes (rfc, tipo_solicitud, fecha_inicio, fecha_fin, tipo_comp, rfc_emisor);
+CREATE INDEX IF NOT EXISTS ix_solicitudes_estado ON solicitudes (rfc, estado);
+
+CREATE TABLE IF NOT EXISTS paquetes (
+    id_paquete      TEXT PRIMARY KEY,
+    id_solicitud    TEXT,
+    rfc             TEXT NOT NULL,
+    estado          TEXT NOT NULL,
+    fecha_registro  TEXT,
+    fecha_descarga  TEXT,
+    bytes           INTEGER,
+    sha256          TEXT,
+    intentos        INTEGER NOT NULL DEFAULT 0,
+    error           TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_paquetes_solicitud ON paquetes (id_solicitud);
+CREATE INDEX IF NOT EXISTS ix_paquetes_estado ON paquetes (rfc, estado);
+
+CREATE TABLE IF NOT EXISTS transiciones (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    entidad         TEXT NOT NULL,
+    id_entidad      TEXT NOT NULL,
+    estado_anterior TEXT,
+    estado_nuevo    TEXT NOT NULL,
+    fecha           TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_transiciones_entidad ON transiciones (id_entidad);
+
+CREATE TABLE IF NOT EXISTS cobertura (
+    rfc             TEXT NOT NULL,
+    tipo_solicitud  TEXT NOT NULL,
+    tipo_comp       TEXT NOT NULL,
+    rfc_emisor      TEXT NOT NULL,
+    inicio          TEXT NOT NULL,
+    fin             TEXT NOT NULL,
+    fecha_calculo   TEXT NOT NULL,
+    PRIMARY KEY (rfc, tipo_solicitud, tipo_comp, rfc_emisor, inicio)
+);
+"""
+
+# Columnas agregadas después de la primera versión del esquema (bases ya existentes)
+COLUMNAS_NUEVAS = {
+    "solicitudes": [("rfc_receptor", "TEXT")],
+    "paquetes": [("bytes", "INTEGER"), ("sha256", "TEXT"), ("intentos", "INTEGER NOT NULL DEFAULT 0"),
+                 ("error", "TEXT")],
+}
+
+# Paquetes que faltan por descargar: registrados, a medias (caída durante la descarga) o con error
+PAQUETES_POR_DESCARGAR = ("pendiente", "descargando", "error")
+
+CAMPOS_HISTORIAL = ["id_solicitud", "tipo_solicitud", "fecha_inicio", "fecha_fin", "tipo_comp",
+                    "rfc_emisor", "fecha_solicitud", "estado", "fecha_descarga"]
+
+
+def normalizar_fecha(texto):
+    # historial.csv mezcla 2024-02-01 y 02/01/2024 (día/mes/año); todo se guarda ISO
+    if texto is None:
+        return None
+    texto = str(texto).strip()
+    if not texto:
+        return None
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(texto, formato).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"Fecha no reconocida: {texto}")
+
+
+def _ahora():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _hoy():
+    return datetime.now().date().isoformat()
+
+
+def id_solicitud_de_paquete(id_paquete):
+    # Los paquetes se llaman <IdSolicitud en mayúsculas>_NN
+    if "_" not in id_paquete:
+        return None
+    return id_paquete.rsplit("_", 1)[0].lower()
+
+
+class HistorialDB:
+    # Una conexión por hilo; WAL permite lectores concurrentes con un escritor
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn.executescript(SCHEMA)
+        self._migrar()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaccion(self):
+        return _Transaccion(self.conn)
+
+    def _migrar(self):
+        for tabla, columnas in COLUMNAS_NUEVAS.items():
+            existentes = {f["name"] for f in self.conn.execute(f"PRAGMA table_info({tabla})")}
+            for nombre, tipo in columnas:
+                if nombre not in existentes:
+                    self.conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {nombre} {tipo}")
+
+    # --- solicitudes -------------------------------------------------------
+
+    def buscar_solicitud(self, rfc, tipo_solicitud, fecha_inicio, fecha_fin, tipo_comp, rfc_emisor):
+        fila = self.conn.execute(
+            "SELECT id_solicitud FROM solicitudes WHERE rfc = ? AND tipo_solicitud = ? "
+            "AND fecha_inicio = ? AND fecha_fin = ? AND tipo_comp = ? AND rfc_emisor = ? LIMIT 1",
+            (rfc, tipo_solicitud, normalizar_fecha(fecha_inicio), normalizar_fecha(fecha_fin),
+             tipo_comp, rfc_emisor)).fetchone()
+        return fila["id_solicitud"] if fila else None
+
+    def registrar_solicitud(self, id_solicitud, rfc, tipo_solicitud, fecha_inicio, fecha_fin,
+                            tipo_comp, rfc_emisor, fecha_solicitud=None, estado="solicitado", rfc_receptor=None):
+        with self._transaccion() as conn:
+            self._insertar_solicitud(conn, {
+                "id_solicitud": id_solicitud, "rfc": rfc, "tipo_solicitud": tipo_solicitud,
+                "fecha_inicio": fecha_inicio, "fecha_fin": fecha_fin, "tipo_comp": tipo_comp,
+                "rfc_emisor": rfc_emisor, "fecha_solicitud": fecha_solicitud or _hoy(), "estado": estado,
+                "rfc_receptor": rfc_receptor,
+            })
+
+    def _insertar_solicitud(self, conn, fila):
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO solicitudes (id_solicitud, rfc, tipo_solicitud, fecha_inicio, fecha_fin, "
+            "tipo_comp, rfc_emisor, fecha_solicitud, estado, fecha_listo, fecha_descarga, rfc_receptor) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (fila["id_solicitud"], fila["rfc"], fila.get("tipo_solicitud"),
+             normalizar_fecha(fila.get("fecha_inicio")), normalizar_fecha(fila.get("fecha_fin")),
+             fila.get("tipo_comp"), fila.get("rfc_emisor"), normalizar_fecha(fila.get("fecha_solicitud")),
+             fila["estado"], normalizar_fecha(fila.get("fecha_listo")),
+             normalizar_fecha(fila.get("fecha_descarga")), fila.get("rfc_receptor") or None))
+        if cur.rowcount:
+            conn.execute("INSERT INTO transiciones (entidad, id_entidad, estado_anterior, estado_nuevo, fecha) "
+                         "VALUES ('solicitud', ?, NULL, ?, ?)", (fila["id_solicitud"], fila["estado"], _ahora()))
+
+    def actualizar_solicitudes(self, cambios):
+        # cambios: [(id_solicitud, nuevo_estado)], en una sola transacción
+        with self._transaccion() as conn:
+            for id_solicitud, estado in cambios:
+                self._cambiar_estado(conn, "solicitudes", "id_solicitud", "solicitud", id_solicitud, estado)
+                if estado == "listo_para_descarga":
+                    conn.execute("UPDATE solicitudes SET fecha_listo = ? WHERE id_solicitud = ?",
+                                 (_hoy(), id_solicitud))
+                elif estado == "descargado":
+                    conn.execute("UPDATE solicitudes SET fecha_descarga = ? WHERE id_solicitud = ?",
+                                 (_hoy(), id_solicitud))
+
+    def solicitudes(self, rfc=None, estados=None):
+        sql, params = "SELECT * FROM solicitudes WHERE 1 = 1", []
+        if rfc:
+            sql += " AND rfc = ?"
+            params.append(rfc)
+        if estados:
+            sql += f" AND estado IN ({','.join('?' * len(estados))})"
+            params.extend(estados)
+        return [dict(f) for f in self.conn.execute(sql + " ORDER BY fecha_solicitud", params)]
+
+    def momentos_solicitudes(self, rfc):
+        # id_solicitud → {"solicitado": ..., "listo_para_descarga": ...}, fecha y hora (ISO) de la
+        # tabla transiciones. Las importadas de historial.csv no tienen la hora del registro
+        # (su transición es del día de la importación) y no aparecen como "solicitado".
+        momentos = {}
+        for id_solicitud, estado, fecha in self.conn.execute(
+                "SELECT t.id_entidad, t.estado_nuevo, MIN(t.fecha) FROM solicitudes s "
+                "JOIN transiciones t ON t.id_entidad = s.id_solicitud AND t.entidad = 'solicitud' "
+                "WHERE s.rfc = ? AND (t.estado_nuevo = 'listo_para_descarga' OR (t.estado_nuevo = 'solicitado' "
+                "AND t.estado_anterior IS NULL AND substr(t.fecha, 1, 10) = s.fecha_solicitud)) "
+                "GROUP BY t.id_entidad, t.estado_nuevo", (rfc,)):
+            momentos.setdefault(id_solicitud, {})[estado] = fecha
+        return momentos
+
+    def solicitud(self, id_solicitud):
+        fila = self.conn.execute("SELECT * FROM solicitudes WHERE id_solicitud = ?", (id_solicitud,)).fetchone()
+        return dict(fila) if fila else None
+
+    # --- paquetes ----------------------------------------------------------
+
+    def registrar_paquetes(self, rfc, id_solicitud, paquetes, estado="pendiente"):
+        with self._transaccion() as conn:
+            for id_paquete in paquetes:
+                self._insertar_paquete(conn, id_paquete, id_solicitud, rfc, estado)
+
+    def _insertar_paquete(self, conn, id_paquete, id_solicitud, rfc, estado, fecha_descarga=None):
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO paquetes (id_paquete, id_solicitud, rfc, estado, fecha_registro, fecha_descarga) "
+            "VALUES (?, ?, ?, ?, ?, ?)", (id_paquete, id_solicitud, rfc, estado, _hoy(), fecha_descarga))
+        if cur.rowcount:
+            conn.execute("INSERT INTO transiciones (entidad, id_entidad, estado_anterior, estado_nuevo, fecha) "
+                         "VALUES ('paquete', ?, NULL, ?, ?)", (id_paquete, estado, _ahora()))
+
+    def marcar_paquetes(self, cambios):
+        # cambios: [(id_paquete, nuevo_estado)]. Cuando todos los paquetes de una
+        # solicitud quedan descargados, la solicitud también pasa a "descargado".
+        with self._transaccion() as conn:
+            self._marcar_paquetes(conn, cambios)
+
+    def _marcar_paquetes(self, conn, cambios):
+        solicitudes = set()
+        for id_paquete, estado in cambios:
+            self._cambiar_estado(conn, "paquetes", "id_paquete", "paquete", id_paquete, estado)
+            if estado == "descargado":
+                conn.execute("UPDATE paquetes SET fecha_descarga = ? WHERE id_paquete = ?",
+                             (_hoy(), id_paquete))
+            fila = conn.execute("SELECT id_solicitud FROM paquetes WHERE id_paquete = ?",
+                                (id_paquete,)).fetchone()
+            if fila and fila["id_solicitud"]:
+                solicitudes.add(fila["id_solicitud"])
+
+        for id_solicitud in solicitudes:
+            faltan = conn.execute("SELECT COUNT(*) FROM paquetes WHERE id_solicitud = ? AND estado != 'descargado'",
+                                  (id_solicitud,)).fetchone()[0]
+            if not faltan:
+                self._cambiar_estado(conn, "solicitudes", "id_solicitud", "solicitud", id_solicitud, "descargado")
+                conn.execute("UPDATE solicitudes SET fecha_descarga = ? WHERE id_solicitud = ?",
+                             (_hoy(), id_solicitud))
+
+    # Bitácora de descarga por paquete: cada cambio se confirma en cuanto ocurre, así
+    # después de una caída se sabe exactamente qué paquetes faltan
+
+    def iniciar_descarga(self, rfc, id_paquete):
+        with self._transaccion() as conn:
+            self._insertar_paquete(conn, id_paquete, id_solicitud_de_paquete(id_paquete), rfc, "pendiente")
+            self._cambiar_estado(conn, "paquetes", "id_paquete", "paquete", id_paquete, "descargando")
+            conn.execute("UPDATE paquetes SET intentos = intentos + 1, error = NULL WHERE id_paquete = ?",
+                         (id_paquete,))
+
+    def terminar_descarga(self, rfc, id_paquete, tamano, sha256):
+        with self._transaccion() as conn:
+            self._insertar_paquete(conn, id_paquete, id_solicitud_de_paquete(id_paquete), rfc, "pendiente")
+            conn.execute("UPDATE paquetes SET bytes = ?, sha256 = ?, error = NULL WHERE id_paquete = ?",
+                         (tamano, sha256, id_paquete))
+            self._marcar_paquetes(conn, [(id_paquete, "descargado")])
+
+    def fallo_descarga(self, id_paquete, error):
+        with self._transaccion() as conn:
+            self._cambiar_estado(conn, "paquetes", "id_paquete", "paquete", id_paquete, "error")
+            conn.execute("UPDATE paquetes SET error = ? WHERE id_paquete = ?", (str(error)[:500], id_paquete))
+
+    def paquetes(self, rfc=None, estados=None, id_solicitud=None):
+        sql, params = "SELECT * FROM paquetes WHERE 1 = 1", []
+        if rfc:
+            sql += " AND rfc = ?"
+            params.append(rfc)
+        if id_solicitud:
+            sql += " AND id_solicitud = ?"
+            params.append(id_solicitud)
+        if estados:
+            sql += f" AND estado IN ({','.join('?' * len(estados))})"
+            params.extend(estados)
+        return [dict(f) for f in self.conn.execute(sql + " ORDER BY id_paquete", params)]
+
+    # --- cobertura ---------------------------------------------------------
+
+    def guardar_cobertura(self, rfc, tipo_solicitud, tipo_comp, rfc_emisor, intervalos):
+        # Reemplaza los intervalos [(inicio, fin)] ya descargados de esa combinación
+        clave = (rfc, tipo_solicitud or "", tipo_comp or "", rfc_emisor or "")
+        with self._transaccion() as conn:
+            conn.execute("DELETE FROM cobertura WHERE rfc = ? AND tipo_solicitud = ? AND tipo_comp = ? "
+                         "AND rfc_emisor = ?", clave)
+            conn.executemany("INSERT INTO cobertura VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [clave + (str(inicio), str(fin), _ahora()) for inicio, fin in intervalos])
+
+    def cobertura(self, rfc, tipo_solicitud, tipo_comp, rfc_emisor):
+        filas = self.conn.execute(
+            "SELECT inicio, fin FROM cobertura WHERE rfc = ? AND tipo_solicitud = ? AND tipo_comp = ? "
+            "AND rfc_emisor = ? ORDER BY inicio", (rfc, tipo_solicitud or "", tipo_comp or "", rfc_emisor or ""))
+        return [(f["inicio"], f["fin"]) for f in filas]
+
+    # --- común -------------------------------------------------------------
+
+    def _cambiar_estado(self, conn, tabla, llave, entidad, id_entidad, estado):
+        fila = conn.execute(f"SELECT estado, rfc FROM {tabla} WHERE {llave} = ?", (id_entidad,)).fetchone()
+        if fila is None:
+            print(f"(⚠) No se encontró {id_entidad} en el historial")
+            return False
+        if fila["estado"] == estado:
+            return False
+        conn.execute(f"UPDATE {tabla} SET estado = ? WHERE {llave} = ?", (estado, id_entidad))
+        conn.execute("INSERT INTO transiciones (entidad, id_entidad, estado_anterior, estado_nuevo, fecha) "
+                     "VALUES (?, ?, ?, ?, ?)", (entidad, id_entidad, fila["estado"], estado, _ahora()))
+        metricas.transicion(fila["rfc"], entidad, id_entidad, fila["estado"], estado)
+        return True
+
+    # --- importación / exportación -----------------------------------------
+
+    def importar_archivos(self, rfc, base_path):
+        # Importa una sola vez historial.csv, id_solicitud.txt, paquetes.txt y los zips
+        # ya descargados de todos los años del cliente; lo ya registrado se respeta
+        resumen = {"solicitudes": 0, "paquetes": 0}
+        with self._transaccion() as conn:
+            for path in sorted(glob.glob(os.path.join(base_path, "*", "solicitudes", "historial.csv"))):
+                with open(path, encoding="utf-8-sig", newline="") as f:
+                    for fila in csv.DictReader(f):
+                        if not fila.get("id_solicitud"):
+                            continue
+                        estado = fila.get("estado") or "solicitado"
+                        self._insertar_solicitud(conn, {
+                            **fila, "rfc": rfc, "estado": estado,
+                            # historial.csv guardaba en fecha_descarga la fecha en que quedó lista
+                            "fecha_listo": fila.get("fecha_descarga") if estado == "listo_para_descarga" else None,
+                            "fecha_descarga": fila.get("fecha_descarga") if estado == "descargado" else None,
+                        })
+                        resumen["solicitudes"] += 1
+
+            for path in sorted(glob.glob(os.path.join(base_path, "*", "solicitudes", "id_solicitud.txt"))):
+                with open(path, encoding="utf-8") as f:
+                    for linea in f:
+                        if linea.strip():
+                            self._insertar_solicitud(conn, {"id_solicitud": linea.strip(), "rfc": rfc,
+                                                            "estado": "solicitado"})
+
+            for path in sorted(glob.glob(os.path.join(base_path, "*", "solicitudes", "paquetes.txt"))):
+                with open(path, encoding="utf-8") as f:
+                    for linea in f:
+                        if linea.strip():
+                            id_paquete = linea.strip()
+                            self._insertar_paquete(conn, id_paquete, id_solicitud_de_paquete(id_paquete),
+                                                   rfc, "pendiente")
+                            resumen["paquetes"] += 1
+
+            for path in sorted(glob.glob(os.path.join(base_path, "*", "paquetes", "**", "*.zip"), recursive=True)):
+                id_paquete = os.path.splitext(os.path.basename(path))[0]
+                fecha = datetime.fromtimestamp(os.path.getmtime(path)).date().isoformat()
+                self._insertar_paquete(conn, id_paquete, id_solicitud_de_paquete(id_paquete),
+                                       rfc, "descargado", fecha)
+                resumen["paquetes"] += 1
+
+            conn.execute("PRAGMA user_version = 1")
+        return resumen
+
+    def importado(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0] >= 1
+
+    def exportar_csv(self, path, rfc=None):
+        # historial.csv con las columnas de siempre, para quien lo siga usando
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(CAMPOS_HISTORIAL)
+            for fila in self.solicitudes(rfc):
+                fecha = fila["fecha_descarga"] or fila["fecha_listo"] or ""
+                writer.writerow([fila[c] or "" for c in CAMPOS_HISTORIAL[:-1]] + [fecha])
+
+
+class _Transaccion:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+_dbs = {}
+_dbs_lock = threading.Lock()
+
+
+def get_historial(config):
+    # Base del cliente (historial_db_path); la primera vez importa los archivos existentes
+    path = os.path.abspath(config.get("historial_db_path") or os.path.join(config["base_path"], "historial.db"))
+    with _dbs_lock:
+        db = _dbs.get(path)
+        if db is None:
+            db = HistorialDB(path)
+            if not db.importado():
+                resumen = db.importar_archivos(config["rfc"], config["base_path"])
+                print(f"✓ Historial importado a {path}: {resumen['solicitudes']} solicitudes, "
+                      f"{resumen['paquetes']} paquetes")
+            _dbs[path] = db
+        return db
+
+
+def main():
+    from utils.config import load_config
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("importar", "exportar"):
+        print("Uso: python -m utils.historial_db importar|exportar [RFC]")
+        return
+    config = load_config(sys.argv[2] if len(sys.argv) > 2 else None)
+    db = get_historial(config)
+
+    if sys.argv[1] == "importar":
+        resumen = db.importar_archivos(config["rfc"], config["base_path"])
+        print(f"✓ Importados: {resumen['solicitudes']} solicitudes, {resumen['paquetes']} paquetes")
+    else:
+        path = os.path.join(config["base_path"], "historial.csv")
+        db.exportar_csv(path, config["rfc"])
+        print(f"✓ Historial exportado → {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import threading
+import time
+from utils import auditoria, control, metricas
+from utils.lazy import lazy_import
+
+asyncio = lazy_import("asyncio")   # solo lo usa motor.py
+requests = lazy_import("requests")
+
+_local = threading.local()
+
+
+def get_session():
+    # requests.Session no es seguro entre hilos: una sesión (y su pool de
+    # conexiones TLS) por hilo, reutilizada entre llamadas al SAT
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _local.session = session
+    return session
+
+
+class RateLimiter:
+    # Token bucket: como máximo `rate` peticiones por segundo con ráfagas de `burst`
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self._tokens = self.burst
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _tomar(self):
+        # 0 si se tomó un token; si no, segundos a esperar antes de reintentar
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (ahora - self._ultimo) * self.rate)
+            self._ultimo = ahora
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            espera = self._tomar()
+            if not espera:
+                return
+            time.sleep(espera)
+
+    async def acquire_async(self):
+        # Mismo bucket que acquire(): hilos y event loop comparten el límite del RFC
+        while True:
+            espera = self._tomar()
+            if not espera:
+                return
+            await asyncio.sleep(espera)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(config):
+    # Límite por RFC tomado de limites.peticiones_por_segundo (sin límite si no existe)
+    limites = config.get("limites") or {}
+    rate = limites.get("peticiones_por_segundo")
+    if not rate:
+        return None
+
+    with _limiters_lock:
+        limiter = _limiters.get(config["rfc"])
+        if limiter is None or limiter.rate != float(rate):
+            limiter = RateLimiter(rate, limites.get("rafaga"))
+            _limiters[config["rfc"]] = limiter
+        return limiter
+
+
+def post_sat(config, url, id_auditoria=None, **kwargs):
+    # POST al SAT respetando la ventana de peticiones en vuelo (utils/control.py) y el límite
+    # de peticiones del RFC; lo que control.reintento permite se reintenta aquí mismo. Cada
+    # intento queda en el archivo de auditoría con id_auditoria (IdSolicitud / IdPaquete).
+    # Con stream=True quien lee el cuerpo lo pasa por resp.auditoria.flujo(...) y al terminar
+    # llama resp.permiso.liberar().
+    servicio = metricas.servicio_de_url(config, url)
+    limiter = get_rate_limiter(config)
+    intento = 0
+    while True:
+        intento += 1
+        registro = auditoria.intercambio(config, servicio, id_auditoria)
+        registro.peticion(kwargs.get("data"))
+        with metricas.cronometro(config, servicio, "espera"):
+            permiso = control.entrar(config, servicio)
+            if limiter is not None:
+                limiter.acquire()
+        inicio = time.monotonic()
+        try:
+            with metricas.cronometro(config, servicio, "http"):
+                resp = get_session().post(url, **kwargs)
+        except Exception as e:
+            metricas.respuesta_http(config, servicio, "error")
+            senal, procesada = control.por_excepcion(e)
+            permiso.terminar(senal)
+            espera = control.reintento(config, servicio, intento, senal, procesada)
+            if espera is None:
+                raise
+            metricas.reintento(config, servicio, str(e), id=id_auditoria, intento=intento)
+            time.sleep(espera)
+            continue
+        except BaseException:
+            permiso.liberar()
+            raise
+        segundos = time.monotonic() - inicio
+        metricas.respuesta_http(config, servicio, resp.status_code)
+        resp.auditoria = registro
+        resp.permiso = permiso
+        if resp.status_code == 200:
+            if kwargs.get("stream"):
+                permiso.senal(control.OK, segundos)
+            else:
+                registro.respuesta(resp.content, resp.status_code)
+                permiso.terminar(control.OK, segundos)
+            return resp
+
+        registro.respuesta(resp.content, resp.status_code)
+        senal, procesada = control.por_http(resp.status_code, resp.content)
+        permiso.terminar(senal, segundos)
+        espera = control.reintento(config, servicio, intento, senal, procesada, resp.headers.get("Retry-After"))
+        if espera is None:
+            return resp
+        resp.close()
+        metricas.reintento(config, servicio, f"HTTP {resp.status_code}", id=id_auditoria, intento=intento)
+        time.sleep(espera)
+
+
+async def post_sat_async(session, config, url, id_auditoria=None, **kwargs):
+    # Igual que post_sat con una sesión asíncrona (aiohttp.ClientSession) compartida. Con
+    # HTTP 200 quien llama lee el cuerpo, lo pasa a resp.auditoria, libera la respuesta y,
+    # si fue con stream=True, llama resp.permiso.liberar(); con otro código el cuerpo ya
+    # está leído y archivado.
+    servicio = metricas.servicio_de_url(config, url)
+    limiter = get_rate_limiter(config)
+    stream = kwargs.pop("stream", False)
+    intento = 0
+    while True:
+        intento += 1
+        registro = auditoria.intercambio(config, servicio, id_auditoria)
+        registro.peticion(kwargs.get("data"))
+        with metricas.cronometro(config, servicio, "espera"):
+            permiso = await control.entrar_async(config, servicio)
+            if limiter is not None:
+                await limiter.acquire_async()
+        inicio = time.monotonic()
+        try:
+            with metricas.cronometro(config, servicio, "http"):
+                resp = await session.post(url, **kwargs)
+            if resp.status != 200:
+                async with resp:
+                    cuerpo = await resp.read()
+        except Exception as e:
+            metricas.respuesta_http(config, servicio, "error")
+            senal, procesada = control.por_excepcion(e)
+            permiso.terminar(senal)
+            espera = control.reintento(config, servicio, intento, senal, procesada)
+            if espera is None:
+                raise
+            metricas.reintento(config, servicio, str(e) or type(e).__name__, id=id_auditoria, intento=intento)
+            await asyncio.sleep(espera)
+            continue
+        except BaseException:
+            permiso.liberar()
+            raise
+        segundos = time.monotonic() - inicio
+        metricas.respuesta_http(config, servicio, resp.status)
+        resp.auditoria = registro
+        resp.permiso = permiso
+        if resp.status == 200:
+            if stream:
+                permiso.senal(control.OK, segundos)
+            else:
+                permiso.terminar(control.OK, segundos)
+            return resp
+
+        registro.respuesta(cuerpo, resp.status)
+        senal, procesada = control.por_http(resp.status, cuerpo)
+        permiso.terminar(senal, segundos)
+        espera = control.reintento(config, servicio, intento, senal, procesada, resp.headers.get("Retry-After"))
+        if espera is None:
+            return resp
+        metricas.reintento(config, servicio, f"HTTP {resp.status}", id=id_auditoria, intento=intento)
+        await asyncio.sleep(espera)
@@ -0,0 +1,30 @@
+import importlib
+import threading
+
+
+class LazyModule:
+    # Módulo que se importa hasta que se usa por primera vez. lxml, xmlsec, requests y yaml
+    # tardan ~200 ms en cargar y una corrida sin trabajo (cron) no los necesita.
+
+    def __init__(self, nombre):
+        self.__dict__["_nombre"] = nombre
+        self.__dict__["_modulo"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _cargar(self):
+        with self._lock:
+            if self._modulo is None:
+                self.__dict__["_modulo"] = importlib.import_module(self._nombre)
+        return self._modulo
+
+    def __getattr__(self, attr):
+        modulo = self._modulo or self._cargar()
+        return getattr(modulo, attr)
+
+    def __repr__(self):
+        estado = "cargado" if self._modulo is not None else "sin cargar"
+        return f"<LazyModule {self._nombre} ({estado})>"
+
+
+def lazy_import(nombre):
+    return LazyModule(nombre)
@@ -0,0 +1,48 @@
+import glob
+import io
+import os
+import zipfile
+
+COLUMNAS = ["Uuid", "RfcEmisor", "NombreEmisor", "RfcReceptor", "NombreReceptor", "RfcPac",
+            "FechaEmision", "FechaCertificacionSat", "Monto", "EfectoComprobante", "Estatus",
+            "FechaCancelacion"]
+SEPARADOR = "~"
+
+
+def es_paquete_metadata(zip_path):
+    # Los paquetes de metadata traen un .txt con el encabezado Uuid~RfcEmisor~...
+    try:
+        with zipfile.ZipFile(zip_path) as z:
+            for nombre in z.namelist():
+                if nombre.lower().endswith(".txt"):
+                    with z.open(nombre) as f:
+                        return f.readline().decode("utf-8-sig").startswith("Uuid" + SEPARADOR)
+    except zipfile.BadZipFile:
+        return False
+    return False
+
+
+def paquetes_metadata(base_path):
+    # Zips de metadata descargados para un cliente (todos los años)
+    rutas = glob.glob(os.path.join(base_path, "*", "paquetes", "**", "*.zip"), recursive=True)
+    return sorted(p for p in rutas if es_paquete_metadata(p))
+
+
+def iter_metadata(zip_path):
+    # Renglones del paquete como dict {columna: texto}, leídos directo del zip
+    with zipfile.ZipFile(zip_path) as z:
+        for nombre in z.namelist():
+            if not nombre.lower().endswith(".txt"):
+                continue
+            with z.open(nombre) as raw:
+                texto = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+                encabezado = texto.readline().rstrip("\r\n").split(SEPARADOR)
+                for linea in texto:
+                    linea = linea.rstrip("\r\n")
+                    if not linea:
+                        continue
+                    valores = linea.split(SEPARADOR)
+                    if len(valores) < len(encabezado):
+                        valores += [""] * (len(encabezado) - len(valores))
+                    yield dict(zip(encabezado, valores))
+
@@ -0,0 +1,124 @@
+# metadata_loader.py - Carga tipada y por bloques de los paquetes de Metadata a Parquet
+# Uso: python -m utils.metadata_loader [RFC]
+import csv
+import os
+import sys
+import zipfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.metadata import COLUMNAS, SEPARADOR, paquetes_metadata
+
+# Renglones por bloque: la memoria queda acotada sin importar el tamaño del paquete
+CHUNK_ROWS = 250_000
+
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+CATEGORICAS = ["RfcEmisor", "NombreEmisor", "RfcReceptor", "NombreReceptor", "RfcPac", "EfectoComprobante"]
+FECHAS = ["FechaEmision", "FechaCertificacionSat", "FechaCancelacion"]
+
+_CATEGORIA = pa.dictionary(pa.int32(), pa.string())
+SCHEMA = pa.schema([
+    ("Uuid", pa.string()),
+    ("RfcEmisor", _CATEGORIA),
+    ("NombreEmisor", _CATEGORIA),
+    ("RfcReceptor", _CATEGORIA),
+    ("NombreReceptor", _CATEGORIA),
+    ("RfcPac", _CATEGORIA),
+    ("FechaEmision", pa.timestamp("s")),
+    ("FechaCertificacionSat", pa.timestamp("s")),
+    ("Monto", pa.decimal128(24, 6)),
+    ("EfectoComprobante", _CATEGORIA),
+    ("Estatus", pa.int8()),
+    ("FechaCancelacion", pa.timestamp("s")),
+])
+
+
+def _tipar(df):
+    columnas = {"Uuid": pa.array(df["Uuid"].str.upper(), pa.string())}
+    for col in CATEGORICAS:
+        columnas[col] = pa.array(df[col], pa.string()).dictionary_encode()
+    for col in FECHAS:
+        fechas = pd.to_datetime(df[col], format=FORMATO_FECHA, errors="coerce")
+        columnas[col] = pa.array(fechas, pa.timestamp("s"))
+    monto = df["Monto"].where(df["Monto"] != "", None)
+    columnas["Monto"] = pa.array(monto, pa.string()).cast(pa.decimal128(24, 6))
+    estatus = pd.to_numeric(df["Estatus"], errors="coerce").astype("Int8")
+    columnas["Estatus"] = pa.array(estatus, pa.int8())
+    return pa.table([columnas[f.name] for f in SCHEMA], schema=SCHEMA)
+
+
+def iter_tablas(zip_path, chunk_rows=CHUNK_ROWS):
+    # Bloques tipados (pyarrow.Table) leídos directo del .txt dentro del zip
+    with zipfile.ZipFile(zip_path) as z:
+        for nombre in z.namelist():
+            if not nombre.lower().endswith(".txt"):
+                continue
+            with z.open(nombre) as f:
+                lector = pd.read_csv(f, sep=SEPARADOR, encoding="utf-8-sig", dtype=str,
+                                     keep_default_na=False, quoting=csv.QUOTE_NONE,
+                                     usecols=COLUMNAS, chunksize=chunk_rows, on_bad_lines="warn")
+                for df in lector:
+                    yield _tipar(df)
+
+
+def iter_chunks(zip_path, chunk_rows=CHUNK_ROWS):
+    # Igual que iter_tablas pero como DataFrames (RFCs y códigos como category)
+    for tabla in iter_tablas(zip_path, chunk_rows):
+        yield tabla.to_pandas()
+
+
+def a_parquet(zip_path, destino, chunk_rows=CHUNK_ROWS):
+    # Escribe el paquete completo a Parquet bloque por bloque; regresa el número de renglones
+    os.makedirs(os.path.dirname(destino) or ".", exist_ok=True)
+    parcial = destino + ".part"
+    renglones = 0
+    try:
+        with pq.ParquetWriter(parcial, SCHEMA, compression="zstd") as writer:
+            for tabla in iter_tablas(zip_path, chunk_rows):
+                writer.write_table(tabla)
+                renglones += tabla.num_rows
+        os.replace(parcial, destino)
+    except BaseException:
+        if os.path.exists(parcial):
+            os.remove(parcial)
+        raise
+    return renglones
+
+
+def metadata_dir(config):
+    return config.get("metadata_dir") or os.path.join(config["base_path"], "metadata")
+
+
+def convertir_paquetes(config, forzar=False):
+    # Convierte los zips de metadata que no tengan Parquet o cuyo Parquet sea más viejo
+    resumen = {}
+    for zip_path in paquetes_metadata(config["base_path"]):
+        id_paquete = os.path.splitext(os.path.basename(zip_path))[0]
+        destino = os.path.join(metadata_dir(config), f"{id_paquete}.parquet")
+        if not forzar and os.path.exists(destino) and os.path.getmtime(destino) >= os.path.getmtime(zip_path):
+            continue
+        resumen[id_paquete] = a_parquet(zip_path, destino)
+        print(f"✓ {id_paquete}: {resumen[id_paquete]} renglones → {destino}")
+    return resumen
+
+
+def cargar(config, columnas=None):
+    # Toda la metadata convertida del cliente en un DataFrame
+    rutas = sorted(os.path.join(metadata_dir(config), f) for f in os.listdir(metadata_dir(config))
+                   if f.endswith(".parquet")) if os.path.isdir(metadata_dir(config)) else []
+    if not rutas:
+        return pd.DataFrame(columns=columnas or [f.name for f in SCHEMA])
+    return pq.ParquetDataset(rutas).read(columns=columnas).to_pandas()
+
+
+def main():
+    from utils.config import load_config
+
+    config = load_config(sys.argv[1] if len(sys.argv) > 1 else None)
+    resumen = convertir_paquetes(config)
+    if not resumen:
+        print("No hay paquetes de metadata nuevos.")
+
+
+if __name__ == "__main__":
+    main()
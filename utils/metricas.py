@@ -0,0 +1,247 @@
+# metricas.py - Tiempos por fase (espera, armado, firma, http, parseo, escritura, dedup) y
+# contadores (CodEstatus, EstadoSolicitud, transiciones del historial, bytes descargados,
+# reintentos, recortes de la ventana, respuestas HTTP) por RFC y servicio, compartidos por todos los scripts.
+# Al terminar un script que llamó iniciar() se escriben <metricas.dir>/sat_<programa>.prom
+# (textfile collector de Prometheus) y una línea por corrida en <metricas.dir>/corridas.jsonl.
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from utils import bitacora
+
+# Límites (segundos) de los buckets del histograma de Prometheus
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Muestras por serie para los percentiles del resumen JSON
+MAX_MUESTRAS = 10000
+
+AYUDA = {
+    "sat_fase_segundos": ("histogram", "Duración de cada fase por RFC y servicio"),
+    "sat_respuestas_http_total": ("counter", "Respuestas HTTP del SAT por código"),
+    "sat_cod_estatus_total": ("counter", "CodEstatus devuelto por el SAT"),
+    "sat_estado_solicitud_total": ("counter", "EstadoSolicitud recibido al verificar"),
+    "sat_transiciones_total": ("counter", "Cambios de estado en historial.db"),
+    "sat_bytes_descargados_total": ("counter", "Bytes de paquetes guardados"),
+    "sat_reintentos_total": ("counter", "Operaciones que se vuelven a intentar"),
+    "sat_recortes_total": ("counter", "Recortes de la ventana de peticiones en vuelo (utils/control.py)"),
+}
+
+
+class Metricas:
+    # Registro en memoria de un proceso; seguro entre hilos
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contadores = {}     # (nombre, etiquetas) → valor
+        self.fases = {}          # etiquetas → {"n", "suma", "max", "buckets", "muestras"}
+        self.inicio = time.time()
+        self.programa = None
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        clave = (nombre, tuple(etiquetas.items()))
+        with self._lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def observar(self, segundos, **etiquetas):
+        clave = tuple(etiquetas.items())
+        with self._lock:
+            serie = self.fases.get(clave)
+            if serie is None:
+                serie = self.fases[clave] = {"n": 0, "suma": 0.0, "max": 0.0,
+                                             "buckets": [0] * len(BUCKETS), "muestras": []}
+            serie["n"] += 1
+            serie["suma"] += segundos
+            serie["max"] = max(serie["max"], segundos)
+            for i, limite in enumerate(BUCKETS):
+                if segundos <= limite:
+                    serie["buckets"][i] += 1
+            if len(serie["muestras"]) < MAX_MUESTRAS:
+                serie["muestras"].append(segundos)
+
+    # --- exportación --------------------------------------------------------
+
+    def prometheus(self):
+        base = {"programa": self.programa or "sat"}
+        with self._lock:
+            contadores = dict(self.contadores)
+            fases = {k: dict(v, buckets=list(v["buckets"])) for k, v in self.fases.items()}
+
+        lineas = []
+        tipo, ayuda = AYUDA["sat_fase_segundos"]
+        lineas += [f"# HELP sat_fase_segundos {ayuda}", f"# TYPE sat_fase_segundos {tipo}"]
+        for etiquetas, serie in sorted(fases.items()):
+            etiquetas = dict(base, **dict(etiquetas))
+            for limite, acumulado in zip(BUCKETS, serie["buckets"]):
+                lineas.append(f"sat_fase_segundos_bucket{_etiquetas(etiquetas, le=limite)} {acumulado}")
+            lineas.append(f"sat_fase_segundos_bucket{_etiquetas(etiquetas, le='+Inf')} {serie['n']}")
+            lineas.append(f"sat_fase_segundos_sum{_etiquetas(etiquetas)} {serie['suma']:.6f}")
+            lineas.append(f"sat_fase_segundos_count{_etiquetas(etiquetas)} {serie['n']}")
+
+        for nombre in sorted({n for n, _ in contadores}):
+            tipo, ayuda = AYUDA.get(nombre, ("counter", nombre))
+            lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"]
+            for (n, etiquetas), valor in sorted(contadores.items()):
+                if n == nombre:
+                    lineas.append(f"{nombre}{_etiquetas(dict(base, **dict(etiquetas)))} {valor}")
+
+        lineas += ["# HELP sat_corrida_inicio_segundos Inicio de la corrida (epoch)",
+                   "# TYPE sat_corrida_inicio_segundos gauge",
+                   f"sat_corrida_inicio_segundos{_etiquetas(base)} {self.inicio:.0f}",
+                   "# HELP sat_corrida_duracion_segundos Duración de la corrida",
+                   "# TYPE sat_corrida_duracion_segundos gauge",
+                   f"sat_corrida_duracion_segundos{_etiquetas(base)} {time.time() - self.inicio:.3f}"]
+        return "\n".join(lineas) + "\n"
+
+    def resumen(self):
+        with self._lock:
+            contadores = dict(self.contadores)
+            fases = {k: dict(v, muestras=sorted(v["muestras"])) for k, v in self.fases.items()}
+        fin = time.time()
+        return {
+            "programa": self.programa,
+            "inicio": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.inicio)),
+            "fin": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(fin)),
+            "segundos": round(fin - self.inicio, 3),
+            "fases": [dict(etiquetas, n=serie["n"], total_s=round(serie["suma"], 3),
+                           p50_ms=_percentil_ms(serie["muestras"], 50),
+                           p95_ms=_percentil_ms(serie["muestras"], 95),
+                           max_ms=round(serie["max"] * 1000, 1))
+                      for etiquetas, serie in sorted(fases.items())],
+            "contadores": [dict(etiquetas, nombre=nombre, valor=valor)
+                           for (nombre, etiquetas), valor in sorted(contadores.items())],
+        }
+
+
+def _etiquetas(etiquetas, **extra):
+    todas = dict(etiquetas, **extra)
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in todas.items()) + "}"
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _percentil_ms(ordenadas, p):
+    if not ordenadas:
+        return None
+    return round(ordenadas[min(len(ordenadas) - 1, int(round(p / 100 * (len(ordenadas) - 1))))] * 1000, 1)
+
+
+_metricas = Metricas()
+_iniciado = False
+_iniciar_lock = threading.Lock()
+
+
+def get_metricas():
+    return _metricas
+
+
+def _rfc(config):
+    return (config or {}).get("rfc") or (config or {}).get("cliente_rfc") or ""
+
+
+def servicio_de_url(config, url):
+    # autenticacion / solicitud / verificacion / descarga según endpoints de config.yml
+    for servicio in ("autenticacion", "solicitud", "verificacion", "descarga"):
+        if (config.get("endpoints") or {}).get(servicio) == url:
+            return servicio
+    return "otro"
+
+
+# --- registro -----------------------------------------------------------------
+
+@contextmanager
+def cronometro(config, servicio, fase):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        _metricas.observar(segundos, rfc=_rfc(config), servicio=servicio, fase=fase)
+        bitacora.evento("fase", logging.DEBUG, rfc=_rfc(config), servicio=servicio, fase=fase,
+                        ms=round(segundos * 1000, 1))
+
+
+def respuesta_http(config, servicio, status):
+    _metricas.contar("sat_respuestas_http_total", rfc=_rfc(config), servicio=servicio, status=str(status))
+    if status != 200:
+        bitacora.evento("respuesta_http", logging.WARNING, rfc=_rfc(config), servicio=servicio, status=status)
+
+
+def cod_estatus(config, servicio, codigo, mensaje=None, **campos):
+    codigo = codigo or "sin_codigo"
+    _metricas.contar("sat_cod_estatus_total", rfc=_rfc(config), servicio=servicio, codigo=codigo)
+    bitacora.evento("cod_estatus", logging.INFO if codigo == "5000" else logging.WARNING,
+                    rfc=_rfc(config), servicio=servicio, codigo=codigo, mensaje=mensaje, **campos)
+
+
+def estado_solicitud(config, id_solicitud, estado):
+    _metricas.contar("sat_estado_solicitud_total", rfc=_rfc(config), estado=str(estado))
+    bitacora.evento("estado_solicitud", rfc=_rfc(config), id_solicitud=id_solicitud, estado=estado)
+
+
+def transicion(rfc, entidad, id_entidad, desde, hacia):
+    _metricas.contar("sat_transiciones_total", rfc=rfc or "", entidad=entidad, desde=desde or "", hacia=hacia)
+    bitacora.evento("transicion", rfc=rfc, entidad=entidad, id=id_entidad, desde=desde, hacia=hacia)
+
+
+def bytes_descargados(config, id_paquete, n):
+    _metricas.contar("sat_bytes_descargados_total", n, rfc=_rfc(config), servicio="descarga")
+    bitacora.evento("paquete_guardado", rfc=_rfc(config), id_paquete=id_paquete, bytes=n)
+
+
+def reintento(config, servicio, motivo=None, **campos):
+    _metricas.contar("sat_reintentos_total", rfc=_rfc(config), servicio=servicio)
+    bitacora.evento("reintento", logging.WARNING, rfc=_rfc(config), servicio=servicio, motivo=motivo, **campos)
+
+
+def recorte(config, servicio, senal):
+    _metricas.contar("sat_recortes_total", rfc=_rfc(config), servicio=servicio, senal=senal)
+
+
+# --- corrida ------------------------------------------------------------------
+
+def iniciar(programa):
+    # Lo llama el main() de cada script: configura la bitácora y guarda las métricas al salir
+    global _iniciado
+    with _iniciar_lock:
+        if _iniciado:
+            return
+        _iniciado = True
+    _metricas.programa = programa
+    bitacora.configurar(_config())
+    bitacora.evento("inicio", programa=programa, pid=os.getpid())
+    atexit.register(guardar)
+
+
+def _config():
+    from utils.config import load_config
+    try:
+        return load_config()
+    except Exception:
+        return {}
+
+
+def guardar(directorio=None):
+    # Textfile de Prometheus (reemplazo atómico) y una línea en corridas.jsonl
+    directorio = directorio or (_config().get("metricas") or {}).get("dir")
+    resumen = _metricas.resumen()
+    bitacora.evento("fin", programa=resumen["programa"], segundos=resumen["segundos"])
+    if not directorio:
+        return None
+
+    try:
+        os.makedirs(directorio, exist_ok=True)
+        prom = os.path.join(directorio, f"sat_{_metricas.programa or 'sat'}.prom")
+        tmp = f"{prom}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(_metricas.prometheus())
+        os.replace(tmp, prom)
+        with open(os.path.join(directorio, "corridas.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(resumen, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"(⚠) No se pudieron guardar las métricas en {directorio}: {e}")
+        return None
+    return prom
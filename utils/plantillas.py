@@ -0,0 +1,226 @@
+# plantillas.py - Sobres SOAP prearmados por RFC
+# El esqueleto de cada servicio (namespaces, nodos fijos y plantilla de firma xmlsec) se arma
+# una sola vez; por llamada solo se clona y se llenan los valores que cambian
+# (IdSolicitud, IdPaquete, fechas, MessageID, Timestamp).
+import copy
+import datetime
+import threading
+import uuid
+from utils.lazy import lazy_import
+from utils.signer import get_signer, plantilla_enveloped
+
+etree = lazy_import("lxml.etree")
+xmlsec = lazy_import("xmlsec")
+
+NS_SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
+NS_DES = "http://DescargaMasivaTerceros.sat.gob.mx"
+NS_AUTH = "http://DescargaMasivaTerceros.gob.mx"
+NS_WSA = "http://www.w3.org/2005/08/addressing"
+NS_DS = "http://www.w3.org/2000/09/xmldsig#"
+NS_U = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd"
+NS_O = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd"
+X509V3 = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3"
+BASE64 = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-soap-message-security-1.0#Base64Binary"
+
+_plantillas = {}
+_plantillas_lock = threading.Lock()
+
+
+def _ruta(nodo):
+    # Índices de hijo desde la raíz hasta nodo; sirven igual en cualquier copia del esqueleto
+    ruta = []
+    padre = nodo.getparent()
+    while padre is not None:
+        ruta.append(padre.index(nodo))
+        nodo, padre = padre, padre.getparent()
+    return tuple(reversed(ruta))
+
+
+class Plantilla:
+    # Esqueleto listo para clonar y la ruta a cada nodo que se llena por llamada
+
+    def __init__(self, env, **nodos):
+        self.env = env
+        self.rutas = {nombre: _ruta(nodo) for nombre, nodo in nodos.items()}
+
+    def clonar(self):
+        env = copy.deepcopy(self.env)
+        nodos = {}
+        for nombre, ruta in self.rutas.items():
+            nodo = env
+            for i in ruta:
+                nodo = nodo[i]
+            nodos[nombre] = nodo
+        return env, nodos
+
+
+def _obtener(clave, armar):
+    with _plantillas_lock:
+        plantilla = _plantillas.get(clave)
+        if plantilla is None:
+            plantilla = _plantillas[clave] = armar()
+        return plantilla
+
+
+def serializar(env):
+    # Sin pretty_print: el SAT no lo necesita y el espacio extra solo agranda la petición
+    return etree.tostring(env, encoding="utf-8", xml_declaration=True)
+
+
+# --------------------------------------------------
+# Solicitud
+def operacion_solicitud(descarga):
+    if "folio" in descarga:
+        return "SolicitaDescargaFolio"
+    if descarga.get("tipo_comp", "").upper() == "E" or "rfc_emisor" in descarga:
+        return "SolicitaDescargaEmitidos"
+    return "SolicitaDescargaRecibidos"
+
+
+def _filtros_solicitud(descarga):
+    # Filtros que aplican cuando la solicitud es CFDI o Metadata, en el orden de los atributos
+    if descarga.get("tipo_solicitud") not in ("CFDI", "Metadata"):
+        return ()
+    return tuple((attr, descarga[clave]) for clave, attr in (
+        ("tipo_comp", "TipoComp"), ("rfc_emisor", "RfcEmisor"),
+        ("rfc_receptor", "RfcReceptor"), ("folio", "Folio")) if clave in descarga)
+
+
+def _armar_solicitud(rfc, op, soap_action, url, tipo_solicitud, filtros):
+    env = etree.Element(f"{{{NS_SOAP}}}Envelope", nsmap={
+        "s": NS_SOAP, "wsa": NS_WSA, "ds": NS_DS, "ns0": NS_DES
+    })
+    hdr = etree.SubElement(env, f"{{{NS_SOAP}}}Header")
+    etree.SubElement(hdr, f"{{{NS_WSA}}}Action").text = soap_action   # sin mustUnderstand
+    etree.SubElement(hdr, f"{{{NS_WSA}}}To").text = url
+    mid = etree.SubElement(hdr, f"{{{NS_WSA}}}MessageID")
+
+    body = etree.SubElement(env, f"{{{NS_SOAP}}}Body")
+    opnode = etree.SubElement(body, f"{{{NS_DES}}}{op}")
+    sol = etree.SubElement(opnode, f"{{{NS_DES}}}solicitud", nsmap={"ds": NS_DS})
+    sol.set("Id", "Solicitud")
+    sol.set("RfcSolicitante", rfc)
+    sol.set("FechaInicial", "")
+    sol.set("FechaFinal", "")
+    sol.set("TipoSolicitud", tipo_solicitud)
+    for attr, valor in filtros:
+        sol.set(attr, valor)
+
+    plantilla_enveloped(sol, "#Solicitud")
+    return Plantilla(env, mid=mid, sol=sol)
+
+
+def solicitud(config):
+    # (env, soap_action) con la plantilla de firma ya puesta en <solicitud>
+    d = config["descarga"]
+    op = operacion_solicitud(d)
+    soap_action = f"http://DescargaMasivaTerceros.sat.gob.mx/ISolicitaDescargaService/{op}"
+    tipo_solicitud = d.get("tipo_solicitud", "CFDI")
+    filtros = _filtros_solicitud(d)
+    url = config["endpoints"]["solicitud"]
+
+    plantilla = _obtener(("solicitud", config["rfc"], op, url, tipo_solicitud, filtros),
+                         lambda: _armar_solicitud(config["rfc"], op, soap_action, url, tipo_solicitud, filtros))
+    env, nodos = plantilla.clonar()
+    nodos["mid"].text = f"uuid:{uuid.uuid4()}"
+    nodos["sol"].set("FechaInicial", config["fechas"]["inicio"] + "T00:00:00")
+    nodos["sol"].set("FechaFinal", config["fechas"]["fin"] + "T23:59:59")
+    return env, soap_action
+
+
+# --------------------------------------------------
+# Verificación
+def _armar_verificacion(rfc):
+    env = etree.Element(f"{{{NS_SOAP}}}Envelope", nsmap={"s": NS_SOAP, "ds": NS_DS})
+    etree.SubElement(env, f"{{{NS_SOAP}}}Header")
+    body = etree.SubElement(env, f"{{{NS_SOAP}}}Body")
+    verifica = etree.SubElement(body, f"{{{NS_DES}}}VerificaSolicitudDescarga")
+    sol = etree.SubElement(verifica, f"{{{NS_DES}}}solicitud")
+    sol.set("IdSolicitud", "")
+    sol.set("RfcSolicitante", rfc)
+
+    plantilla_enveloped(sol, "")
+    return Plantilla(env, sol=sol)
+
+
+def verificacion(config, id_solicitud):
+    plantilla = _obtener(("verificacion", config["rfc"]), lambda: _armar_verificacion(config["rfc"]))
+    env, nodos = plantilla.clonar()
+    nodos["sol"].set("IdSolicitud", id_solicitud)
+    return env
+
+
+# --------------------------------------------------
+# Descarga
+def _armar_descarga(rfc):
+    env = etree.Element(f"{{{NS_SOAP}}}Envelope", nsmap={"s": NS_SOAP, "des": NS_DES, "ds": NS_DS})
+    body = etree.SubElement(env, f"{{{NS_SOAP}}}Body")
+    entrada = etree.SubElement(body, f"{{{NS_DES}}}PeticionDescargaMasivaTercerosEntrada")
+    pet = etree.SubElement(entrada, f"{{{NS_DES}}}peticionDescarga",
+                           Id="_0", RfcSolicitante=rfc, IdPaquete="")
+
+    plantilla_enveloped(pet, "#_0")
+    return Plantilla(env, pet=pet)
+
+
+def descarga(config, paquete_id):
+    # (env, peticionDescarga) con la plantilla de firma ya puesta en la petición
+    plantilla = _obtener(("descarga", config["rfc"]), lambda: _armar_descarga(config["rfc"]))
+    env, nodos = plantilla.clonar()
+    nodos["pet"].set("IdPaquete", paquete_id)
+    return env, nodos["pet"]
+
+
+# --------------------------------------------------
+# Autenticación
+def _armar_autenticacion(cert_b64):
+    nsmap = {"s": NS_SOAP, "u": NS_U, "o": NS_O}
+    env = etree.Element(f"{{{NS_SOAP}}}Envelope", nsmap=nsmap)
+    header = etree.SubElement(env, f"{{{NS_SOAP}}}Header")
+    body = etree.SubElement(env, f"{{{NS_SOAP}}}Body")
+
+    security = etree.SubElement(header, f"{{{NS_O}}}Security", nsmap=nsmap)
+    security.set(f"{{{NS_SOAP}}}mustUnderstand", "1")
+
+    ts = etree.SubElement(security, f"{{{NS_U}}}Timestamp")
+    ts.set(f"{{{NS_U}}}Id", "TS")
+    created = etree.SubElement(ts, f"{{{NS_U}}}Created")
+    expires = etree.SubElement(ts, f"{{{NS_U}}}Expires")
+
+    bst = etree.SubElement(security, f"{{{NS_O}}}BinarySecurityToken")
+    bst.set(f"{{{NS_U}}}Id", "")
+    bst.set("ValueType", X509V3)
+    bst.set("EncodingType", BASE64)
+    bst.text = cert_b64
+
+    etree.SubElement(body, f"{{{NS_AUTH}}}Autentica")
+
+    sig = xmlsec.template.create(env, c14n_method=xmlsec.Transform.EXCL_C14N,
+                                 sign_method=xmlsec.Transform.RSA_SHA1, ns="ds")
+    security.append(sig)
+    ref = xmlsec.template.add_reference(sig, xmlsec.Transform.SHA1, uri="#TS")
+    xmlsec.template.add_transform(ref, xmlsec.Transform.EXCL_C14N)
+    key_info = xmlsec.template.ensure_key_info(sig)
+    str_el = etree.SubElement(key_info, f"{{{NS_O}}}SecurityTokenReference")
+    ref_bst = etree.SubElement(str_el, f"{{{NS_O}}}Reference")
+    ref_bst.set("URI", "")
+    ref_bst.set("ValueType", X509V3)
+
+    return Plantilla(env, ts=ts, created=created, expires=expires, security=security,
+                     bst=bst, ref_bst=ref_bst)
+
+
+def autenticacion(cert_path, key_path):
+    # (envelope, timestamp, security, bst_id) como build_soap_envelope, con la firma por llenar
+    signer = get_signer(key_path, cert_path)
+    # Clave por FielSigner: si la FIEL cambia, get_signer da otro y se arma de nuevo
+    plantilla = _obtener(("autenticacion", signer), lambda: _armar_autenticacion(signer.cert_b64))
+    env, nodos = plantilla.clonar()
+
+    creado = datetime.datetime.now(datetime.timezone.utc)
+    nodos["created"].text = creado.strftime('%Y-%m-%dT%H:%M:%SZ')
+    nodos["expires"].text = (creado + datetime.timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    bst_id = f"uuid-{uuid.uuid4()}"
+    nodos["bst"].set(f"{{{NS_U}}}Id", bst_id)
+    nodos["ref_bst"].set("URI", f"#{bst_id}")
+    return env, nodos["ts"], nodos["security"], bst_id
@@ -0,0 +1,480 @@
+# reportes.py - Agregados de la metadata descargada para reportes: número de CFDI y monto por
+# RFC del cliente, periodo (AAAA-MM de FechaEmision), rol (emitido/recibido), contraparte,
+# efecto y estatus (tabla agregados; totales es lo mismo sin contraparte), de todos los
+# clientes en una sola base SQLite (reportes.db).
+# Cada solicitud de metadata se concilia contra el estado guardado por UUID (hash join sobre
+# la ventana de fechas de la solicitud): solo los renglones que cambiaron (nuevos, cancelados,
+# faltantes) se aplican a los agregados y quedan en la tabla cambios, que se lee como feed.
+# La consulta es python reportes.py.
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from utils.metadata import es_paquete_metadata, iter_metadata, paquetes_metadata
+
+DIMENSIONES = ("rfc", "periodo", "rol", "contraparte", "efecto", "estatus")
+ESTATUS = {"1": "vigente", "0": "cancelado"}
+TIPOS_CAMBIO = ("nuevo", "cancelado", "faltante", "reaparecido", "modificado")
+CENTAVO = Decimal("0.01")
+# UUID por lote al aplicar cambios (una consulta de estado previo por lote)
+LOTE = 5000
+# Columnas del renglón que entran a la huella (si cambia alguna, el UUID se vuelve a evaluar)
+CAMPOS_HUELLA = ("RfcEmisor", "RfcReceptor", "FechaEmision", "Monto", "EfectoComprobante", "Estatus",
+                 "FechaCancelacion")
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS comprobantes (
+    rfc TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    periodo TEXT NOT NULL,
+    rol TEXT NOT NULL,
+    contraparte TEXT NOT NULL,
+    efecto TEXT NOT NULL,
+    estatus TEXT NOT NULL,
+    monto INTEGER NOT NULL,
+    fecha TEXT NOT NULL DEFAULT '',
+    fecha_cancelacion TEXT NOT NULL DEFAULT '',
+    huella BLOB,
+    PRIMARY KEY (rfc, uuid)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS agregados (
+    rfc TEXT NOT NULL,
+    periodo TEXT NOT NULL,
+    rol TEXT NOT NULL,
+    contraparte TEXT NOT NULL,
+    efecto TEXT NOT NULL,
+    estatus TEXT NOT NULL,
+    cfdi INTEGER NOT NULL,
+    monto INTEGER NOT NULL,
+    PRIMARY KEY (rfc, periodo, rol, contraparte, efecto, estatus)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_agregados_periodo ON agregados (periodo);
+CREATE TABLE IF NOT EXISTS totales (
+    rfc TEXT NOT NULL,
+    periodo TEXT NOT NULL,
+    rol TEXT NOT NULL,
+    efecto TEXT NOT NULL,
+    estatus TEXT NOT NULL,
+    cfdi INTEGER NOT NULL,
+    monto INTEGER NOT NULL,
+    PRIMARY KEY (periodo, rfc, rol, efecto, estatus)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS paquetes (
+    rfc TEXT NOT NULL,
+    id_paquete TEXT NOT NULL,
+    renglones INTEGER NOT NULL,
+    cambios INTEGER NOT NULL,
+    fecha TEXT NOT NULL,
+    PRIMARY KEY (rfc, id_paquete)
+);
+CREATE TABLE IF NOT EXISTS cambios (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rfc TEXT NOT NULL,
+    uuid TEXT NOT NULL,
+    tipo TEXT NOT NULL,
+    estatus_anterior TEXT,
+    estatus TEXT NOT NULL,
+    fecha_cancelacion TEXT,
+    monto INTEGER NOT NULL,
+    id_solicitud TEXT,
+    fecha TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_cambios_rfc ON cambios (rfc, id);
+"""
+
+# Columnas agregadas después de la primera versión del esquema (bases ya existentes)
+COLUMNAS_NUEVAS = {
+    "comprobantes": [("fecha", "TEXT NOT NULL DEFAULT ''"), ("fecha_cancelacion", "TEXT NOT NULL DEFAULT ''"),
+                     ("huella", "BLOB")],
+}
+# Cubre la carga de huellas de una ventana sin ir a la tabla (el uuid viene con la llave)
+_INDICES = "CREATE INDEX IF NOT EXISTS ix_comprobantes_ventana ON comprobantes (rfc, rol, fecha, efecto, huella);"
+
+# Estado de un UUID: (periodo, rol, contraparte, efecto, estatus, monto, fecha, fecha_cancelacion);
+# los cinco primeros son la llave de los agregados
+_ESTADO = "periodo, rol, contraparte, efecto, estatus, monto, fecha, fecha_cancelacion"
+
+
+def _ahora():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _centavos(monto):
+    # Los montos se suman como enteros (centavos) para no acumular error de punto flotante
+    try:
+        return int((Decimal(monto) * 100).to_integral_value())
+    except (InvalidOperation, TypeError):
+        return 0
+
+
+def _registro(rfc, fila):
+    # Estado (ver _ESTADO) de un renglón de metadata
+    emisor = (fila.get("RfcEmisor") or "").upper()
+    receptor = (fila.get("RfcReceptor") or "").upper()
+    if emisor == rfc:
+        rol, contraparte = "emitido", receptor
+    elif receptor == rfc:
+        rol, contraparte = "recibido", emisor
+    else:
+        rol, contraparte = "tercero", emisor
+    estatus = fila.get("Estatus") or ""
+    fecha = fila.get("FechaEmision") or ""
+    return (fecha[:7], rol, contraparte, fila.get("EfectoComprobante") or "", ESTATUS.get(estatus, estatus),
+            _centavos(fila.get("Monto")), fecha, fila.get("FechaCancelacion") or "")
+
+
+def _huella(fila):
+    # 8 bytes del renglón tal como viene; se guarda, así que no puede ser hash() (cambia por proceso)
+    return hashlib.blake2b("~".join([fila.get(c) or "" for c in CAMPOS_HUELLA]).encode(),
+                           digest_size=8).digest()
+
+
+def _prevalece(previo, nuevo):
+    # Una cancelación no se revierte: un paquete viejo que aún lo trae vigente no la pisa
+    return previo if previo is not None and previo[4] == "cancelado" and nuevo[4] != "cancelado" else nuevo
+
+
+def _tipo_cambio(previo, nuevo):
+    if previo is None:
+        return "nuevo"
+    if nuevo[4] == "cancelado" and previo[4] != "cancelado":
+        return "cancelado"
+    if nuevo[4] == "faltante":
+        return "faltante"
+    if previo[4] == "faltante":
+        return "reaparecido"
+    return "modificado"
+
+
+class ReportesDB:
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn.executescript(_ESQUEMA)
+        self._migrar()
+        self.conn.executescript(_INDICES)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _migrar(self):
+        for tabla, columnas in COLUMNAS_NUEVAS.items():
+            existentes = {f[1] for f in self.conn.execute(f"PRAGMA table_info({tabla})")}
+            for nombre, tipo in columnas:
+                if nombre not in existentes:
+                    self.conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {nombre} {tipo}")
+
+    def procesados(self, rfc):
+        return {f[0] for f in self.conn.execute("SELECT id_paquete FROM paquetes WHERE rfc = ?", (rfc,))}
+
+    def agregar_paquete(self, rfc, id_paquete, filas):
+        # Un paquete suelto, sin buscar faltantes
+        return self.conciliar(rfc, [(id_paquete, filas)])
+
+    def conciliar(self, rfc, paquetes, id_solicitud=None, ventana=None):
+        # Aplica los paquetes [(id_paquete, renglones)] de una solicitud en una transacción.
+        # Con `ventana` (desde, hasta, rol) los paquetes son la foto completa de esa
+        # ventana: las huellas guardadas se cargan una vez (uuid → huella) y solo los renglones
+        # cuya huella no coincide se evalúan; lo guardado que la foto ya no trae queda como faltante.
+        # Regresa {"renglones", "cambios", <tipo de cambio>: n} o None si no había nada nuevo.
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ya = {f[0] for f in conn.execute(
+                f"SELECT id_paquete FROM paquetes WHERE rfc = ? AND id_paquete IN ({', '.join('?' * len(paquetes))})",
+                [rfc] + [p for p, _ in paquetes])}
+            if all(p in ya for p, _ in paquetes):
+                conn.execute("ROLLBACK")
+                return None
+            huellas = self._huellas(conn, rfc, ventana) if ventana else {}
+            resumen = Counter()
+            for id_paquete, filas in paquetes:
+                renglones = 0
+                cambios_antes = resumen["cambios"]
+                lote = {}
+                for fila in filas:
+                    uuid = (fila.get("Uuid") or "").upper()
+                    if not uuid:
+                        continue
+                    renglones += 1
+                    huella = _huella(fila)
+                    # Hash join: lo que llega igual que la última vez no se toca
+                    if huellas.pop(uuid, None) == huella:
+                        continue
+                    previo = lote.get(uuid)
+                    lote[uuid] = (_prevalece(previo and previo[0], _registro(rfc, fila)), huella)
+                    if len(lote) >= LOTE:
+                        self._aplicar(conn, rfc, lote, id_solicitud, resumen)
+                        lote = {}
+                if lote:
+                    self._aplicar(conn, rfc, lote, id_solicitud, resumen)
+                resumen["renglones"] += renglones
+                if id_paquete not in ya:
+                    conn.execute("INSERT INTO paquetes (rfc, id_paquete, renglones, cambios, fecha) "
+                                 "VALUES (?, ?, ?, ?, ?)", (rfc, id_paquete, renglones,
+                                                            resumen["cambios"] - cambios_antes, _ahora()))
+            if ventana:
+                self._faltantes(conn, rfc, list(huellas), id_solicitud, resumen)
+            conn.execute("DELETE FROM agregados WHERE rfc = ? AND cfdi = 0", (rfc,))
+            conn.execute("DELETE FROM totales WHERE rfc = ? AND cfdi = 0", (rfc,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return dict(resumen, renglones=resumen["renglones"], cambios=resumen["cambios"])
+
+    def _huellas(self, conn, rfc, ventana):
+        # uuid → huella de lo guardado dentro de la ventana (un recorrido de ix_comprobantes_ventana)
+        return dict(conn.execute(
+            "SELECT uuid, huella FROM comprobantes WHERE rfc = ? AND rol = ? AND fecha >= ? AND fecha <= ?",
+            (rfc, ventana[2], ventana[0], ventana[1])))
+
+    def _previos(self, conn, rfc, uuids):
+        # uuid → (estado, huella)
+        return {f[0]: (tuple(f[1:-1]), f[-1]) for f in conn.execute(
+            f"SELECT uuid, {_ESTADO}, huella FROM comprobantes "
+            f"WHERE rfc = ? AND uuid IN ({', '.join('?' * len(uuids))})", [rfc] + uuids)}
+
+    def _faltantes(self, conn, rfc, uuids, id_solicitud, resumen):
+        # Sin huella: si vuelve a aparecer, igual que antes, se evalúa como reaparecido
+        for i in range(0, len(uuids), LOTE):
+            previos = self._previos(conn, rfc, uuids[i:i + LOTE])
+            lote = {u: (estado[:4] + ("faltante",) + estado[5:], None) for u, (estado, _) in previos.items()}
+            self._aplicar(conn, rfc, lote, id_solicitud, resumen, previos)
+
+    def _aplicar(self, conn, rfc, lote, id_solicitud, resumen, previos=None):
+        uuids = list(lote)
+        previos = previos if previos is not None else self._previos(conn, rfc, uuids)
+        deltas = defaultdict(lambda: [0, 0])
+        cambios, feed = [], []
+        ahora = _ahora()
+        for uuid, (nuevo, huella) in lote.items():
+            previo, huella_previa = previos.get(uuid, (None, None))
+            nuevo = _prevalece(previo, nuevo)
+            if nuevo == previo and huella == huella_previa:
+                continue
+            cambios.append((rfc, uuid) + nuevo + (huella,))
+            if nuevo == previo or (previo is not None and previo[:6] == nuevo[:6] and not previo[6]):
+                # Solo cambió la huella (p. ej. una cancelación que un paquete viejo trae vigente)
+                # o el renglón es de una base anterior a la columna fecha: se guarda sin más
+                continue
+            if previo is not None:
+                delta = deltas[previo[:5]]
+                delta[0] -= 1
+                delta[1] -= previo[5]
+            delta = deltas[nuevo[:5]]
+            delta[0] += 1
+            delta[1] += nuevo[5]
+            tipo = _tipo_cambio(previo, nuevo)
+            resumen[tipo] += 1
+            feed.append((rfc, uuid, tipo, previo[4] if previo else None, nuevo[4], nuevo[7] or None, nuevo[5],
+                         id_solicitud, ahora))
+        resumen["cambios"] += len(feed)
+        conn.executemany(f"INSERT OR REPLACE INTO comprobantes (rfc, uuid, {_ESTADO}, huella) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", cambios)
+        conn.executemany("INSERT INTO cambios (rfc, uuid, tipo, estatus_anterior, estatus, fecha_cancelacion, "
+                         "monto, id_solicitud, fecha) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", feed)
+        conn.executemany(
+            "INSERT INTO agregados (rfc, periodo, rol, contraparte, efecto, estatus, cfdi, monto) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (rfc, periodo, rol, contraparte, efecto, estatus) "
+            "DO UPDATE SET cfdi = cfdi + excluded.cfdi, monto = monto + excluded.monto",
+            [(rfc,) + clave + tuple(delta) for clave, delta in deltas.items() if delta != [0, 0]])
+        # Los mismos cambios sin contraparte, para los reportes por mes
+        sin_contraparte = defaultdict(lambda: [0, 0])
+        for (periodo, rol, _, efecto, estatus), (cfdi, monto) in deltas.items():
+            total = sin_contraparte[(periodo, rol, efecto, estatus)]
+            total[0] += cfdi
+            total[1] += monto
+        conn.executemany(
+            "INSERT INTO totales (rfc, periodo, rol, efecto, estatus, cfdi, monto) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (periodo, rfc, rol, efecto, estatus) "
+            "DO UPDATE SET cfdi = cfdi + excluded.cfdi, monto = monto + excluded.monto",
+            [(rfc,) + clave + tuple(total) for clave, total in sin_contraparte.items() if total != [0, 0]])
+
+    def cambios(self, rfc=None, tipos=None, desde_id=0, limite=None):
+        # Feed de cambios en orden; quien lo consume guarda el último id y pide desde ahí
+        sql, params = "SELECT * FROM cambios WHERE id > ?", [desde_id]
+        if rfc:
+            sql += " AND rfc = ?"
+            params.append(rfc)
+        if tipos:
+            sql += f" AND tipo IN ({', '.join('?' * len(tipos))})"
+            params += list(tipos)
+        sql += " ORDER BY id"
+        if limite:
+            sql += f" LIMIT {int(limite)}"
+        cursor = self.conn.execute(sql, params)
+        columnas = [c[0] for c in cursor.description]
+        filas = [dict(zip(columnas, f)) for f in cursor]
+        for fila in filas:
+            fila["monto"] = (Decimal(fila["monto"]) / 100).quantize(CENTAVO)
+        return filas
+
+    def borrar(self, rfc):
+        # Quita todo lo del cliente (para reconstruir desde los zips)
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for tabla in ("comprobantes", "agregados", "totales", "paquetes", "cambios"):
+                conn.execute(f"DELETE FROM {tabla} WHERE rfc = ?", (rfc,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def consultar(self, agrupar=("rfc", "periodo"), desde=None, hasta=None, orden=None, limite=None, **filtros):
+        # Lista de dicts {dimensión: valor, "cfdi": n, "monto": Decimal}. `filtros`: cualquier
+        # dimensión con un valor o una lista; desde/hasta: periodos AAAA-MM incluidos.
+        # orden: "monto" o "cfdi" (descendente); por defecto, las dimensiones agrupadas.
+        agrupar = list(agrupar)
+        invalidas = [d for d in agrupar + list(filtros) if d not in DIMENSIONES]
+        if invalidas:
+            raise ValueError(f"Dimensiones no válidas: {', '.join(invalidas)} (usa {', '.join(DIMENSIONES)})")
+        condiciones, params = [], []
+        for dimension, valor in filtros.items():
+            if valor is None:
+                continue
+            valores = [valor] if isinstance(valor, str) else list(valor)
+            condiciones.append(f"{dimension} IN ({', '.join('?' * len(valores))})")
+            params += valores
+        if desde:
+            condiciones.append("periodo >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append("periodo <= ?")
+            params.append(hasta)
+
+        # Sin contraparte alcanza la tabla de totales, que es mucho más chica
+        tabla = "agregados" if "contraparte" in agrupar or filtros.get("contraparte") else "totales"
+        columnas = ", ".join(agrupar)
+        sql = f"SELECT {columnas + ', ' if agrupar else ''}SUM(cfdi), SUM(monto) FROM {tabla}"
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        if agrupar:
+            sql += f" GROUP BY {columnas}"
+        if orden in ("monto", "cfdi"):
+            sql += f" ORDER BY SUM({orden}) DESC"
+        elif agrupar:
+            sql += f" ORDER BY {columnas}"
+        if limite:
+            sql += f" LIMIT {int(limite)}"
+
+        resultado = []
+        for fila in self.conn.execute(sql, params):
+            if fila[-2] is None:
+                continue
+            registro = dict(zip(agrupar, fila))
+            registro["cfdi"] = fila[-2]
+            registro["monto"] = (Decimal(fila[-1]) / 100).quantize(CENTAVO)
+            resultado.append(registro)
+        return resultado
+
+
+_dbs = {}
+_dbs_lock = threading.Lock()
+
+
+def get_reportes(config):
+    # Una sola base para todos los clientes (reportes.db junto a config.yml)
+    path = os.path.abspath((config.get("reportes") or {}).get("db") or "reportes.db")
+    with _dbs_lock:
+        db = _dbs.get(path)
+        if db is None:
+            db = _dbs[path] = ReportesDB(path)
+        return db
+
+
+def resumen_cambios(resultado):
+    # "3 nuevo, 1 cancelado" de lo que regresa conciliar
+    return ", ".join(f"{resultado[t]} {t}" for t in TIPOS_CAMBIO if resultado.get(t)) or "sin cambios"
+
+
+def _solicitud_de(id_paquete):
+    # Los paquetes se llaman <IdSolicitud>_NN
+    return id_paquete.rsplit("_", 1)[0]
+
+
+def ventana(solicitud, rfc):
+    # (desde, hasta, rol) que cubre completa una solicitud de metadata del historial,
+    # o None si no se puede saber (sin fechas, filtrada por contraparte)
+    from utils.plantillas import operacion_solicitud
+
+    if not solicitud or solicitud.get("tipo_solicitud") != "Metadata" or not solicitud.get("fecha_inicio"):
+        return None
+    descarga = {k: solicitud[k] for k in ("tipo_comp", "rfc_emisor", "rfc_receptor") if solicitud.get(k)}
+    if descarga.get("rfc_emisor", rfc).upper() != rfc:
+        return None
+    rol = "emitido" if operacion_solicitud(descarga) == "SolicitaDescargaEmitidos" else "recibido"
+    # Emitidos a un receptor, o recibidos para otro RFC: solo una parte de la ventana
+    if rol == "emitido" and descarga.get("rfc_receptor") or descarga.get("rfc_receptor", rfc).upper() != rfc:
+        return None
+    hasta = solicitud.get("fecha_fin") or solicitud["fecha_inicio"]
+    if len(hasta) == 10:
+        hasta += " 23:59:59"
+    # tipo_comp solo elige emitidos o recibidos (el SAT no filtra por EfectoComprobante)
+    return solicitud["fecha_inicio"], hasta, rol
+
+
+def conciliar_solicitud(config, id_solicitud, rutas):
+    # Concilia los zips de una solicitud. Si están todos los paquetes que registró el historial,
+    # se buscan también los faltantes; si no, solo se aplican los que no se habían aplicado.
+    from utils.historial_db import get_historial
+
+    db = get_reportes(config)
+    rfc = config["rfc"].upper()
+    rutas = {os.path.splitext(os.path.basename(r))[0]: r for r in rutas}
+    historial = get_historial(config)
+    esperados = {p["id_paquete"] for p in historial.paquetes(id_solicitud=id_solicitud)}
+    completa = bool(esperados) and esperados <= set(rutas)
+    rango = ventana(historial.solicitud(id_solicitud), rfc) if completa else None
+    if rango is None:
+        ya = db.procesados(rfc)
+        rutas = {p: r for p, r in rutas.items() if p not in ya}
+    if not rutas:
+        return None
+    return db.conciliar(rfc, [(p, iter_metadata(r)) for p, r in sorted(rutas.items())], id_solicitud, rango)
+
+
+def conciliar_zip(config, zip_path, id_paquete=None):
+    # Paquete de metadata recién descargado, junto con los demás de su solicitud que ya estén
+    # en la misma carpeta; None si no es metadata o no había nada nuevo
+    if not es_paquete_metadata(zip_path):
+        return None
+    id_paquete = id_paquete or os.path.splitext(os.path.basename(zip_path))[0]
+    id_solicitud = _solicitud_de(id_paquete)
+    carpeta = os.path.dirname(os.path.abspath(zip_path))
+    hermanos = [os.path.join(carpeta, n) for n in os.listdir(carpeta)
+                if n.endswith(".zip") and _solicitud_de(n[:-4]) == id_solicitud]
+    return conciliar_solicitud(config, id_solicitud, hermanos)
+
+
+def actualizar(config, reconstruir=False):
+    # Concilia las solicitudes de metadata del cliente con paquetes que aún no se aplicaron
+    db = get_reportes(config)
+    rfc = config["rfc"].upper()
+    if reconstruir:
+        db.borrar(rfc)
+    ya = db.procesados(rfc)
+    por_solicitud = defaultdict(list)
+    for zip_path in paquetes_metadata(config["base_path"]):
+        por_solicitud[_solicitud_de(os.path.splitext(os.path.basename(zip_path))[0])].append(zip_path)
+    resumen = {}
+    for id_solicitud, rutas in sorted(por_solicitud.items()):
+        if all(os.path.splitext(os.path.basename(r))[0] in ya for r in rutas):
+            continue
+        resultado = conciliar_solicitud(config, id_solicitud, rutas)
+        if resultado is not None:
+            resumen[id_solicitud] = resultado
+    return resumen
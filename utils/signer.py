@@ -1,94 +1,132 @@
 import base64
-import uuid
-from lxml import etree
-import xmlsec
+import os
+import threading
+from utils.lazy import lazy_import
+
+etree = lazy_import("lxml.etree")
+xmlsec = lazy_import("xmlsec")
+
+DS_SIGNATURE = "{http://www.w3.org/2000/09/xmldsig#}Signature"
+
+
+class FielSigner:
+    # Llave y certificado de la FIEL de un RFC, leídos y parseados una sola vez.
+    # libxmlsec no permite reutilizar un SignatureContext después de sign(), así que
+    # por firma solo se crea un contexto nuevo a partir de la llave ya cargada.
+
+    def __init__(self, key_path, cert_path):
+        self.key_path = key_path
+        self.cert_path = cert_path
+
+        with open(cert_path, 'rb') as f:
+            self.cert_pem = f.read()
+        # Contenido del BinarySecurityToken de autenticación
+        self.cert_b64 = base64.b64encode(self.cert_pem).decode()
+        self.cert_der = pem_a_der(self.cert_pem)
+
+        self.key = xmlsec.Key.from_file(key_path, xmlsec.KeyFormat.PEM)
+        self.key.load_cert_from_memory(self.cert_pem, xmlsec.KeyFormat.CERT_PEM)
+        self._lock = threading.Lock()
+
+    def new_context(self):
+        ctx = xmlsec.SignatureContext()
+        with self._lock:
+            ctx.key = self.key
+        return ctx
+
+    def sign(self, signature_node, id_node=None, id_attr="Id"):
+        ctx = self.new_context()
+        if id_node is not None:
+            ctx.register_id(id_node, id_attr)
+        ctx.sign(signature_node)
+        return signature_node
+
+    def sign_enveloped(self, node, uri, id_attr=None):
+        # Firma enveloped (RSA-SHA1 / C14N exclusiva) como primer hijo de node; si el nodo
+        # viene de utils.plantillas ya trae la plantilla de firma y solo se llena
+        sig = node.find(DS_SIGNATURE)
+        if sig is None:
+            sig = plantilla_enveloped(node, uri)
+        return self.sign(sig, node if id_attr else None, id_attr)
+
+
+def plantilla_enveloped(node, uri):
+    # Plantilla de firma xmlsec (sin valores) insertada como primer hijo de node
+    sig = xmlsec.template.create(node, xmlsec.Transform.EXCL_C14N,
+                                 xmlsec.Transform.RSA_SHA1, ns="ds")
+    node.insert(0, sig)
+    ref = xmlsec.template.add_reference(sig, xmlsec.Transform.SHA1, uri=uri)
+    xmlsec.template.add_transform(ref, xmlsec.Transform.ENVELOPED)
+    ki = xmlsec.template.ensure_key_info(sig)
+    xmlsec.template.add_x509_data(ki)
+    return sig
+
+
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_signer(key_path, cert_path):
+    # Un FielSigner por par llave/certificado; se recarga si alguno de los archivos cambia
+    paths = (os.path.abspath(key_path), os.path.abspath(cert_path))
+    mtimes = (os.stat(paths[0]).st_mtime_ns, os.stat(paths[1]).st_mtime_ns)
+
+    with _signers_lock:
+        cached = _signers.get(paths)
+        if cached is None or cached[0] != mtimes:
+            cached = (mtimes, FielSigner(key_path, cert_path))
+            _signers[paths] = cached
+        return cached[1]
+
+
+def pem_a_der(pem_bytes):
+    # cert.pem puede traer "Bag Attributes" antes del bloque BEGIN CERTIFICATE
+    inicio = pem_bytes.find(b'-----BEGIN CERTIFICATE-----')
+    fin = pem_bytes.find(b'-----END CERTIFICATE-----')
+    if inicio < 0 or fin < 0:
+        raise ValueError("❌ El archivo no contiene un certificado PEM")
+    cuerpo = pem_bytes[inicio + len(b'-----BEGIN CERTIFICATE-----'):fin]
+    return base64.b64decode(b"".join(cuerpo.split()))
 
 
 def build_soap_envelope(cert_path, key_path):
-    # Fechas
-    import datetime
-    created = datetime.datetime.now(datetime.timezone.utc)
-    expires = created + datetime.timedelta(minutes=5)
-    created_str = created.strftime('%Y-%m-%dT%H:%M:%SZ')
-    expires_str = expires.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-    # Namespaces
-    NSMAP = {
-        's': 'http://schemas.xmlsoap.org/soap/envelope/',
-        'u': 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd',
-        'o': 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd'
-    }
-
-    # SOAP Envelope
-    envelope = etree.Element('{%s}Envelope' % NSMAP['s'], nsmap=NSMAP)
-    header = etree.SubElement(envelope, '{%s}Header' % NSMAP['s'])
-    body = etree.SubElement(envelope, '{%s}Body' % NSMAP['s'])
-
-    # WS-Security
-    security = etree.SubElement(header, '{%s}Security' % NSMAP['o'], nsmap=NSMAP)
-    security.set('{%s}mustUnderstand' % NSMAP['s'], '1')
-
-    # Timestamp
-    timestamp = etree.SubElement(security, '{%s}Timestamp' % NSMAP['u'])
-    timestamp.set('{%s}Id' % NSMAP['u'], 'TS')
-    created_el = etree.SubElement(timestamp, '{%s}Created' % NSMAP['u'])
-    created_el.text = created_str
-    expires_el = etree.SubElement(timestamp, '{%s}Expires' % NSMAP['u'])
-    expires_el.text = expires_str
-
-    # BinarySecurityToken
-    cert_data = open(cert_path, 'rb').read()
-    cert_b64 = base64.b64encode(cert_data).decode()
-    bst_id = f"uuid-{uuid.uuid4()}"
-    bst = etree.SubElement(security, '{%s}BinarySecurityToken' % NSMAP['o'])
-    bst.set('{%s}Id' % NSMAP['u'], bst_id)
-    bst.set("ValueType", "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3")
-    bst.set("EncodingType", "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-soap-message-security-1.0#Base64Binary")
-    bst.text = cert_b64
-
-    # Cuerpo de autenticación
-    auth = etree.SubElement(body, '{http://DescargaMasivaTerceros.gob.mx}Autentica')
-
-
-    return envelope, timestamp, security, bst_id
+    # Sobre de autenticación clonado de la plantilla del RFC (utils/plantillas.py)
+    from utils.plantillas import autenticacion
+    return autenticacion(cert_path, key_path)
 
 
 def sign_envelope(envelope, timestamp, security, key_path, cert_path, bst_id):
-    # Crear template de firma
-    signature_node = xmlsec.template.create(
-        envelope,
-        c14n_method=xmlsec.Transform.EXCL_C14N,
-        sign_method=xmlsec.Transform.RSA_SHA1,
-        ns='ds'
-    )
-
-    security.append(signature_node)
-
-    # Referencia al Timestamp
-    ref = xmlsec.template.add_reference(
-        signature_node,
-        xmlsec.Transform.SHA1,
-        uri="#TS"
-    )
-    xmlsec.template.add_transform(ref, xmlsec.Transform.EXCL_C14N)
-
-    # KeyInfo y SecurityTokenReference
-    key_info = xmlsec.template.ensure_key_info(signature_node)
-    str_el = etree.SubElement(key_info, '{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}SecurityTokenReference')
-    ref_el = etree.SubElement(str_el, '{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}Reference')
-    ref_el.set("URI", f"#{bst_id}")
-    ref_el.set("ValueType", "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3")
+    signature_node = security.find(DS_SIGNATURE)
+    if signature_node is None:
+        # Crear template de firma (los sobres de utils/plantillas.py ya lo traen)
+        signature_node = xmlsec.template.create(
+            envelope,
+            c14n_method=xmlsec.Transform.EXCL_C14N,
+            sign_method=xmlsec.Transform.RSA_SHA1,
+            ns='ds'
+        )
+
+        security.append(signature_node)
+
+        # Referencia al Timestamp
+        ref = xmlsec.template.add_reference(
+            signature_node,
+            xmlsec.Transform.SHA1,
+            uri="#TS"
+        )
+        xmlsec.template.add_transform(ref, xmlsec.Transform.EXCL_C14N)
+
+        # KeyInfo y SecurityTokenReference
+        key_info = xmlsec.template.ensure_key_info(signature_node)
+        str_el = etree.SubElement(key_info, '{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}SecurityTokenReference')
+        ref_el = etree.SubElement(str_el, '{http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd}Reference')
+        ref_el.set("URI", f"#{bst_id}")
+        ref_el.set("ValueType", "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-x509-token-profile-1.0#X509v3")
 
     # 🔑 Esta línea es la que corrige el fallo
     xmlsec.tree.add_ids(timestamp, ["Id"])
 
-    # Cargar clave
-    ctx = xmlsec.SignatureContext()
-    key = xmlsec.Key.from_file(key_path, xmlsec.KeyFormat.PEM)
-    key.load_cert_from_file(cert_path, xmlsec.KeyFormat.PEM)
-    ctx.key = key
-
-    # Firmar
-    ctx.sign(signature_node)
+    # Firmar con la llave ya cargada
+    get_signer(key_path, cert_path).sign(signature_node)
 
     return envelope
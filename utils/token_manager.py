@@ -0,0 +1,171 @@
+import importlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# El SAT entrega tokens con vigencia de 5 minutos
+TOKEN_TTL = 300
+# Se renueva en segundo plano cuando quedan menos de estos segundos
+MARGEN_RENOVACION = 60
+
+
+@contextmanager
+def file_lock(lock_path):
+    # Candado exclusivo entre procesos sobre un archivo auxiliar
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    with open(lock_path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _fetch_desde_auth(config):
+    # get_token vive en 1_auth.py; el nombre del módulo no es importable con "import"
+    return importlib.import_module("1_auth").get_token(config)
+
+
+class TokenProvider:
+    # Token de autenticación de un RFC con fecha de emisión y expiración.
+    # Se comparte entre hilos (lock en memoria) y entre procesos (token.json + token.lock
+    # junto a token_path). token.txt se sigue escribiendo con el token plano.
+
+    def __init__(self, config, fetch=None, ttl=TOKEN_TTL, margen=MARGEN_RENOVACION):
+        self.config = config
+        self.fetch = fetch or _fetch_desde_auth
+        self.ttl = ttl
+        self.margen = margen
+
+        base, _ = os.path.splitext(config["token_path"])
+        self.token_path = config["token_path"]
+        self.cache_path = base + ".json"
+        self.lock_path = base + ".lock"
+
+        self._lock = threading.Lock()           # renovación cuando ya no hay token vigente
+        self._renovando_lock = threading.Lock() # solo para revisar/marcar _renovando
+        self._renovando = False
+        self._actual = None  # {"token", "issued_at", "expires_at"}
+
+    def vigente(self, minimo=0):
+        # Token en memoria o en token.json que dura más de `minimo` segundos, o None.
+        # No espera a ninguna renovación (se puede llamar desde un event loop)
+        ahora = time.time()
+        actual = self._actual
+        if actual is None or actual["expires_at"] <= ahora:
+            actual = self._leer_cache()
+        if actual is None or actual["expires_at"] - ahora <= minimo:
+            return None
+        self._actual = actual
+        if actual["expires_at"] - ahora <= self.margen:
+            self._renovar_en_segundo_plano()
+        return actual["token"]
+
+    def get(self):
+        token = self.vigente()
+        if token is not None:
+            return token
+
+        # Sin token vigente: hay que esperar a la renovación
+        with self._lock:
+            actual = self._actual
+            if actual is None or actual["expires_at"] <= time.time():
+                actual = self._renovar()
+            return actual["token"]
+
+    def expires_in(self):
+        actual = self._actual or self._leer_cache()
+        if actual is None:
+            return 0
+        return max(0.0, actual["expires_at"] - time.time())
+
+    def _renovar_en_segundo_plano(self):
+        # Quien todavía tiene token vigente no espera: la petición al SAT va en otro hilo y
+        # solo toma el candado entre procesos (que también la ordena con get() sin token)
+        with self._renovando_lock:
+            if self._renovando:
+                return
+            self._renovando = True
+
+        def tarea():
+            try:
+                self._renovar()
+            except Exception as e:
+                print(f"(⚠) No se pudo renovar el token en segundo plano: {e}")
+            finally:
+                with self._renovando_lock:
+                    self._renovando = False
+
+        threading.Thread(target=tarea, name="token-refresh", daemon=True).start()
+
+    def _renovar(self):
+        with file_lock(self.lock_path):
+            # Otro proceso pudo haberlo renovado mientras esperábamos el candado
+            actual = self._leer_cache()
+            if actual is not None and actual["expires_at"] - time.time() > self.margen:
+                self._actual = actual
+                return actual
+
+            issued_at = time.time()
+            token = self.fetch(self.config)
+            if not token:
+                raise Exception("Error al autenticar: respuesta sin token.")
+
+            actual = {
+                "token": token,
+                "issued_at": issued_at,
+                "expires_at": issued_at + self.ttl,
+            }
+            self._escribir_cache(actual)
+            self._actual = actual
+            print(f"✓ Token renovado para {self.config['rfc']} (vence en {self.ttl}s)")
+            return actual
+
+    def _leer_cache(self):
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+            return data if data.get("token") else None
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _escribir_cache(self, actual):
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(actual, f)
+        os.replace(tmp, self.cache_path)
+
+        with open(self.token_path, "w", encoding="utf-8") as f:
+            f.write(actual["token"])
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_token_provider(config, fetch=None):
+    # Un TokenProvider por archivo de token (es decir, por RFC) dentro del proceso
+    path = os.path.abspath(config["token_path"])
+    with _providers_lock:
+        provider = _providers.get(path)
+        if provider is None:
+            provider = TokenProvider(config, fetch=fetch)
+            _providers[path] = provider
+        return provider
@@ -0,0 +1,327 @@
+# validacion.py - Validación de los CFDI descargados: recalcula la cadena original del
+# comprobante y del TimbreFiscalDigital y verifica el Sello del emisor (con el certificado que
+# trae el propio CFDI) y el SelloSAT (con el certificado del SAT por NoCertificadoSAT). Cada
+# paquete se valida en un proceso aparte; los certificados se parsean una vez por proceso y
+# los del SAT se descargan una sola vez a validacion.certificados.
+import base64
+import os
+import re
+from utils import archivos
+from utils.cfdi import iter_miembros_almacen, iter_miembros_xml
+from utils.lazy import lazy_import
+
+etree = lazy_import("lxml.etree")
+requests = lazy_import("requests")
+x509 = lazy_import("cryptography.x509")
+hashes = lazy_import("cryptography.hazmat.primitives.hashes")
+padding = lazy_import("cryptography.hazmat.primitives.asymmetric.padding")
+excepciones = lazy_import("cryptography.exceptions")
+
+NS_CFDI = ("http://www.sat.gob.mx/cfd/3", "http://www.sat.gob.mx/cfd/4")
+NS_TFD = "http://www.sat.gob.mx/TimbreFiscalDigital"
+VERSIONES = ("3.3", "4.0")
+URL_CERTIFICADO_SAT = "https://rdc.sat.gob.mx/rccf/{}/{}/{}/{}/{}/{}.cer"
+
+VALIDO = "valido"
+INVALIDO = "invalido"
+NO_VERIFICABLE = "no_verificable"
+
+# Atributos que entran a la cadena original, en el orden de las XSLT del SAT (cadenaoriginal_3_3 y
+# 4_0 comparten el orden; cada versión solo trae los suyos). Los hijos van en orden de documento,
+# que el esquema fija igual que la XSLT, salvo los totales de Impuestos del comprobante (ver
+# _agregar_nodo). Sello, Certificado y la Addenda no entran.
+_CFDI = {
+    "Comprobante": ("Version", "Serie", "Folio", "Fecha", "FormaPago", "NoCertificado", "CondicionesDePago",
+                    "SubTotal", "Descuento", "Moneda", "TipoCambio", "Total", "TipoDeComprobante",
+                    "Exportacion", "MetodoPago", "LugarExpedicion", "Confirmacion"),
+    "InformacionGlobal": ("Periodicidad", "Meses", "Año"),
+    "CfdiRelacionados": ("TipoRelacion",),
+    "CfdiRelacionado": ("UUID",),
+    "Emisor": ("Rfc", "Nombre", "RegimenFiscal", "FacAtrAdquirente"),
+    "Receptor": ("Rfc", "Nombre", "DomicilioFiscalReceptor", "ResidenciaFiscal", "NumRegIdTrib",
+                 "RegimenFiscalReceptor", "UsoCFDI"),
+    "Conceptos": (),
+    "Concepto": ("ClaveProdServ", "NoIdentificacion", "Cantidad", "ClaveUnidad", "Unidad", "Descripcion",
+                 "ValorUnitario", "Importe", "Descuento", "ObjetoImp"),
+    "Impuestos": ("TotalImpuestosRetenidos", "TotalImpuestosTrasladados"),
+    "Traslados": (),
+    "Retenciones": (),
+    "Traslado": ("Base", "Impuesto", "TipoFactor", "TasaOCuota", "Importe"),
+    "Retencion": ("Base", "Impuesto", "TipoFactor", "TasaOCuota", "Importe"),
+    "ACuentaTerceros": ("RfcACuentaTerceros", "NombreACuentaTerceros", "RegimenFiscalACuentaTerceros",
+                        "DomicilioFiscalACuentaTerceros"),
+    "InformacionAduanera": ("NumeroPedimento",),
+    "CuentaPredial": ("Numero",),
+    "Parte": ("ClaveProdServ", "NoIdentificacion", "Cantidad", "Unidad", "Descripcion", "ValorUnitario",
+              "Importe"),
+    "Complemento": (),
+    "ComplementoConcepto": (),
+}
+
+# Complementos con orden propio; con otros hace falta la XSLT del SAT (validacion.xslt)
+_COMPLEMENTOS = {
+    "http://www.sat.gob.mx/Pagos20": {
+        "Pagos": ("Version",),
+        "Totales": ("TotalRetencionesIVA", "TotalRetencionesISR", "TotalRetencionesIEPS",
+                    "TotalTrasladosBaseIVA16", "TotalTrasladosImpuestoIVA16", "TotalTrasladosBaseIVA8",
+                    "TotalTrasladosImpuestoIVA8", "TotalTrasladosBaseIVA0", "TotalTrasladosImpuestoIVA0",
+                    "TotalTrasladosBaseIVAExento", "MontoTotalPagos"),
+        "Pago": ("FechaPago", "FormaDePagoP", "MonedaP", "TipoCambioP", "Monto", "NumOperacion",
+                 "RfcEmisorCtaOrd", "NomBancoOrdExt", "CtaOrdenante", "RfcEmisorCtaBen", "CtaBeneficiario",
+                 "TipoCadPago", "CertPago", "CadPago", "SelloPago"),
+        "DoctoRelacionado": ("IdDocumento", "Serie", "Folio", "MonedaDR", "EquivalenciaDR", "NumParcialidad",
+                             "ImpSaldoAnt", "ImpPagado", "ImpSaldoInsoluto", "ObjetoImpDR"),
+        "ImpuestosDR": (),
+        "RetencionesDR": (),
+        "RetencionDR": ("BaseDR", "ImpuestoDR", "TipoFactorDR", "TasaOCuotaDR", "ImporteDR"),
+        "TrasladosDR": (),
+        "TrasladoDR": ("BaseDR", "ImpuestoDR", "TipoFactorDR", "TasaOCuotaDR", "ImporteDR"),
+        "ImpuestosP": (),
+        "RetencionesP": (),
+        "RetencionP": ("ImpuestoP", "ImporteP"),
+        "TrasladosP": (),
+        "TrasladoP": ("BaseP", "ImpuestoP", "TipoFactorP", "TasaOCuotaP", "ImporteP"),
+    },
+    "http://www.sat.gob.mx/nomina12": {
+        "Nomina": ("Version", "TipoNomina", "FechaPago", "FechaInicialPago", "FechaFinalPago", "NumDiasPagados",
+                   "TotalPercepciones", "TotalDeducciones", "TotalOtrosPagos"),
+        "Emisor": ("Curp", "RegistroPatronal", "RfcPatronOrigen"),
+        "EntidadSNCF": ("OrigenRecurso", "MontoRecursoPropio"),
+        "Receptor": ("Curp", "NumSeguridadSocial", "FechaInicioRelLaboral", "Antigüedad", "TipoContrato",
+                     "Sindicalizado", "TipoJornada", "TipoRegimen", "NumEmpleado", "Departamento", "Puesto",
+                     "RiesgoPuesto", "PeriodicidadPago", "Banco", "CuentaBancaria", "SalarioBaseCotApor",
+                     "SalarioDiarioIntegrado", "ClaveEntFed"),
+        "SubContratacion": ("RfcLabora", "PorcentajeTiempo"),
+        "Percepciones": ("TotalSueldos", "TotalSeparacionIndemnizacion", "TotalJubilacionPensionRetiro",
+                         "TotalGravado", "TotalExento"),
+        "Percepcion": ("TipoPercepcion", "Clave", "Concepto", "ImporteGravado", "ImporteExento"),
+        "AccionesOTitulos": ("ValorMercado", "PrecioAlOtorgarse"),
+        "HorasExtra": ("Dias", "TipoHoras", "HorasExtra", "ImportePagado"),
+        "JubilacionPensionRetiro": ("TotalUnaExhibicion", "TotalParcialidad", "MontoDiario", "IngresoAcumulable",
+                                    "IngresoNoAcumulable"),
+        "SeparacionIndemnizacion": ("TotalPagado", "NumAñosServicio", "UltimoSueldoMensOrd", "IngresoAcumulable",
+                                    "IngresoNoAcumulable"),
+        "Deducciones": ("TotalOtrasDeducciones", "TotalImpuestosRetenidos"),
+        "Deduccion": ("TipoDeduccion", "Clave", "Concepto", "Importe"),
+        "OtrosPagos": (),
+        "OtroPago": ("TipoOtroPago", "Clave", "Concepto", "Importe"),
+        "SubsidioAlEmpleo": ("SubsidioCausado",),
+        "CompensacionSaldosAFavor": ("SaldoAFavor", "Año", "RemanenteSalFav"),
+        "Incapacidades": (),
+        "Incapacidad": ("DiasIncapacidad", "TipoIncapacidad", "ImporteMonetario"),
+    },
+    "http://www.sat.gob.mx/implocal": {
+        "ImpuestosLocales": ("version", "TotaldeRetenciones", "TotaldeTraslados"),
+        "RetencionesLocales": ("ImpLocRetenido", "TasadeRetencion", "Importe"),
+        "TrasladosLocales": ("ImpLocTrasladado", "TasadeTraslado", "Importe"),
+    },
+}
+
+_TFD = ("Version", "UUID", "FechaTimbrado", "RfcProvCertif", "Leyenda", "SelloCFD", "NoCertificadoSAT")
+
+_ESPACIOS = re.compile(r"[ \t\r\n]+")
+
+# Por proceso: certificados del SAT por NoCertificado (None = no se pudo obtener), de los
+# emisores ((Certificado en base64, certificado)) y XSLT compiladas
+_certificados = {}
+_emisores = {}
+_xslt = {}
+_parser = None
+
+
+class NoSoportado(Exception):
+    pass
+
+
+def _separar(tag):
+    ns, _, nombre = tag[1:].partition("}")
+    return ns, nombre
+
+
+def _normalizar(valor):
+    # normalize-space() de XPath
+    return _ESPACIOS.sub(" ", valor).strip(" ")
+
+
+def _agregar_nodo(elem, partes):
+    ns, nombre = _separar(elem.tag)
+    if ns == NS_TFD or nombre == "Addenda":
+        return
+    if ns in NS_CFDI and nombre == "Impuestos" and _separar(elem.getparent().tag)[1] == "Comprobante":
+        # Los del comprobante llevan cada total después de su lista, no al principio
+        for lista, total in (("Retenciones", "TotalImpuestosRetenidos"),
+                             ("Traslados", "TotalImpuestosTrasladados")):
+            for hijo in elem.iterchildren(f"{{{ns}}}{lista}"):
+                _agregar_nodo(hijo, partes)
+            if elem.get(total) is not None:
+                partes.append(_normalizar(elem.get(total)))
+        return
+    tabla = _CFDI if ns in NS_CFDI else _COMPLEMENTOS.get(ns)
+    atributos = tabla.get(nombre) if tabla is not None else None
+    if atributos is None:
+        raise NoSoportado(f"complemento {nombre} ({ns})")
+    for atributo in atributos:
+        valor = elem.get(atributo)
+        if valor is not None:
+            partes.append(_normalizar(valor))
+    for hijo in elem:
+        if isinstance(hijo.tag, str):
+            _agregar_nodo(hijo, partes)
+
+
+def cadena_original(raiz, xslt=None):
+    # Cadena original del comprobante; con complementos que no están en las tablas se usa la
+    # XSLT del SAT de esa versión si está en `xslt` ({version: ruta}), si no NoSoportado
+    try:
+        partes = []
+        _agregar_nodo(raiz, partes)
+        return "||" + "|".join(partes) + "||"
+    except NoSoportado:
+        ruta = (xslt or {}).get(raiz.get("Version"))
+        if not ruta:
+            raise
+    transformacion = _xslt.get(ruta)
+    if transformacion is None:
+        transformacion = _xslt[ruta] = etree.XSLT(etree.parse(ruta))
+    return str(transformacion(raiz.getroottree()))
+
+
+def cadena_timbre(tfd):
+    return "||" + "|".join(_normalizar(tfd.get(a)) for a in _TFD if tfd.get(a) is not None) + "||"
+
+
+def _numero_certificado(cert):
+    # El SAT codifica el número (20 dígitos) como ASCII en el serial del certificado
+    serial = format(cert.serial_number, "x")
+    try:
+        return bytes.fromhex(serial if len(serial) % 2 == 0 else "0" + serial).decode("ascii")
+    except (ValueError, UnicodeDecodeError):
+        return serial
+
+
+def _cargar_certificado(datos):
+    if datos.lstrip().startswith(b"-----BEGIN"):
+        return x509.load_pem_x509_certificate(datos)
+    return x509.load_der_x509_certificate(datos)
+
+
+def certificado_emisor(no_certificado, certificado_b64):
+    # Se parsea una vez por NoCertificado; si un CFDI trae otro Certificado con el mismo número
+    # se usa el que trae, sin reemplazar el guardado
+    guardado = _emisores.get(no_certificado)
+    if guardado is not None and guardado[0] == certificado_b64:
+        return guardado[1]
+    cert = _cargar_certificado(base64.b64decode(certificado_b64))
+    _emisores.setdefault(no_certificado, (certificado_b64, cert))
+    return cert
+
+
+def certificado_sat(no_certificado, carpeta, descargar=True):
+    # Certificado del PAC/SAT: primero en memoria, luego <carpeta>/<NoCertificado>.cer y si no
+    # está se descarga del SAT (una vez por proceso aunque falle)
+    if no_certificado in _certificados:
+        return _certificados[no_certificado]
+    cert = None
+    ruta = os.path.join(carpeta, f"{no_certificado}.cer") if carpeta else None
+    if ruta and os.path.exists(ruta):
+        with open(ruta, "rb") as f:
+            cert = _cargar_certificado(f.read())
+    elif descargar and re.fullmatch(r"\d{20}", no_certificado):
+        n = no_certificado
+        url = URL_CERTIFICADO_SAT.format(n[:6], n[6:12], n[12:14], n[14:16], n[16:18], n)
+        try:
+            resp = requests.get(url, timeout=15)
+            if resp.status_code == 200:
+                cert = _cargar_certificado(resp.content)
+                if ruta:
+                    archivos.escribir_atomico(ruta, resp.content)
+        except (requests.RequestException, ValueError):
+            pass
+    _certificados[no_certificado] = cert
+    return cert
+
+
+def _verificar_firma(cert, texto, firma_b64):
+    try:
+        cert.public_key().verify(base64.b64decode(firma_b64), texto.encode("utf-8"),
+                                 padding.PKCS1v15(), hashes.SHA256())
+        return True
+    except (excepciones.InvalidSignature, ValueError):
+        return False
+
+
+def validar_xml(datos, opciones=None):
+    # {"uuid", "version", "rfc_emisor", "rfc_receptor", "sello", "timbre", "detalle"}; sello y
+    # timbre: valido, invalido o no_verificable (detalle dice por qué)
+    global _parser
+    opciones = opciones or {}
+    if _parser is None:
+        _parser = etree.XMLParser(resolve_entities=False, huge_tree=True, remove_blank_text=False)
+    raiz = etree.fromstring(datos, _parser)
+    ns = _separar(raiz.tag)[0]
+    emisor = raiz.find(f"{{{ns}}}Emisor")
+    receptor = raiz.find(f"{{{ns}}}Receptor")
+    tfd = raiz.find(f"{{{ns}}}Complemento/{{{NS_TFD}}}TimbreFiscalDigital")
+    resultado = {"uuid": tfd.get("UUID", "").upper() if tfd is not None else None,
+                 "version": raiz.get("Version"),
+                 "rfc_emisor": emisor.get("Rfc") if emisor is not None else None,
+                 "rfc_receptor": receptor.get("Rfc") if receptor is not None else None,
+                 "sello": NO_VERIFICABLE, "timbre": NO_VERIFICABLE, "detalle": []}
+    detalle = resultado["detalle"]
+
+    if ns not in NS_CFDI or raiz.get("Version") not in VERSIONES:
+        detalle.append(f"versión {raiz.get('Version')} no soportada")
+        return resultado
+
+    # Sello del emisor
+    sello = raiz.get("Sello")
+    try:
+        cert = certificado_emisor(raiz.get("NoCertificado"), raiz.get("Certificado") or "")
+        if _numero_certificado(cert) != raiz.get("NoCertificado"):
+            resultado["sello"] = INVALIDO
+            detalle.append("NoCertificado no corresponde al Certificado")
+        else:
+            cadena = cadena_original(raiz, opciones.get("xslt"))
+            resultado["sello"] = VALIDO if _verificar_firma(cert, cadena, sello or "") else INVALIDO
+            if resultado["sello"] == INVALIDO:
+                detalle.append("Sello no corresponde a la cadena original")
+    except NoSoportado as e:
+        detalle.append(f"sin cadena original: {e}")
+    except ValueError as e:
+        resultado["sello"] = INVALIDO
+        detalle.append(f"Certificado ilegible: {e}")
+
+    # Timbre del SAT
+    if tfd is None:
+        resultado["timbre"] = INVALIDO
+        detalle.append("sin TimbreFiscalDigital")
+    elif tfd.get("SelloCFD") != sello:
+        resultado["timbre"] = INVALIDO
+        detalle.append("SelloCFD del timbre distinto del Sello")
+    else:
+        cert_sat = certificado_sat(tfd.get("NoCertificadoSAT", ""), opciones.get("certificados"),
+                                   opciones.get("descargar", True))
+        if cert_sat is None:
+            detalle.append(f"sin certificado SAT {tfd.get('NoCertificadoSAT')}")
+        elif _verificar_firma(cert_sat, cadena_timbre(tfd), tfd.get("SelloSAT") or ""):
+            resultado["timbre"] = VALIDO
+        else:
+            resultado["timbre"] = INVALIDO
+            detalle.append("SelloSAT no corresponde al timbre")
+    return resultado
+
+
+def validar_paquete(id_paquete, zip_path=None, almacen_dir=None, opciones=None):
+    # Pensada para correr en un proceso aparte: regresa (id_paquete, [resultado por XML]).
+    # El paquete se lee del zip o, si ya no está, del almacén (utils/almacen.py)
+    miembros = iter_miembros_xml(zip_path) if zip_path else iter_miembros_almacen(almacen_dir, id_paquete)
+    resultados = []
+    for nombre, f in miembros:
+        try:
+            resultado = validar_xml(f.read(), opciones)
+        except etree.XMLSyntaxError as e:
+            resultado = {"uuid": None, "version": None, "rfc_emisor": None, "rfc_receptor": None,
+                         "sello": INVALIDO, "timbre": INVALIDO, "detalle": [f"XML inválido: {e}"]}
+        resultado["archivo"] = nombre
+        resultados.append(resultado)
+    return id_paquete, resultados
@@ -0,0 +1,97 @@
+import base64
+from utils.lazy import lazy_import
+
+etree = lazy_import("lxml.etree")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1] if isinstance(tag, str) else ""
+
+
+class Base64StreamDecoder:
+    # Decodifica base64 por bloques hacia un archivo abierto, sin juntar todo el texto
+
+    def __init__(self, out, buffer_size=CHUNK_SIZE):
+        self.out = out
+        self.buffer_size = buffer_size
+        self.bytes_escritos = 0
+        self._pendiente = []
+        self._tam_pendiente = 0
+        self._resto = b""
+
+    def feed(self, text):
+        limpio = "".join(text.split())
+        if not limpio:
+            return
+        self._pendiente.append(limpio)
+        self._tam_pendiente += len(limpio)
+        if self._tam_pendiente >= self.buffer_size:
+            self._flush()
+
+    def _flush(self, final=False):
+        data = self._resto + "".join(self._pendiente).encode("ascii")
+        self._pendiente = []
+        self._tam_pendiente = 0
+
+        corte = len(data) if final else len(data) - len(data) % 4
+        if corte:
+            raw = base64.b64decode(data[:corte], validate=True)
+            self.out.write(raw)
+            self.bytes_escritos += len(raw)
+        self._resto = data[corte:]
+
+    def close(self):
+        self._flush(final=True)
+        return self.bytes_escritos
+
+
+class _DescargaTarget:
+    # Eventos del parser incremental: atributos de <respuesta> y texto de <Paquete>
+
+    def __init__(self, out):
+        self.decoder = Base64StreamDecoder(out)
+        self.respuesta = None
+        self.fault = None
+        self._en_paquete = False
+        self._en_fault = None
+
+    def start(self, tag, attrib):
+        nombre = local_name(tag)
+        if nombre == "respuesta" and self.respuesta is None:
+            self.respuesta = dict(attrib)
+        elif nombre == "Paquete":
+            self._en_paquete = True
+        elif nombre in ("faultcode", "faultstring"):
+            self.fault = self.fault or {}
+            self._en_fault = nombre
+
+    def data(self, data):
+        if self._en_paquete:
+            self.decoder.feed(data)
+        elif self._en_fault:
+            self.fault[self._en_fault] = self.fault.get(self._en_fault, "") + data
+
+    def end(self, tag):
+        nombre = local_name(tag)
+        if nombre == "Paquete":
+            self._en_paquete = False
+        elif nombre == self._en_fault:
+            self._en_fault = None
+
+    def close(self):
+        return self
+
+
+def stream_descarga(chunks, out):
+    # Recorre la respuesta de Descargar por bloques y escribe el paquete
+    # decodificado en `out`. Regresa (atributos de <respuesta>, fault, bytes escritos).
+    target = _DescargaTarget(out)
+    parser = etree.XMLParser(target=target, huge_tree=True, resolve_entities=False)
+    for chunk in chunks:
+        if chunk:
+            parser.feed(chunk)
+    parser.close()
+    escritos = target.decoder.close()
+    return target.respuesta or {}, target.fault, escritos
@@ -0,0 +1,120 @@
+# validar.py - Verifica el sello del emisor y el timbre del SAT de cada CFDI descargado
+# (utils/validacion.py) y cruza RfcEmisor/RfcReceptor con la metadata del cliente.
+# Deja un reporte por paquete en clientes/<RFC>/validacion/<IdPaquete>.csv
+# Uso: python validar.py [--rfc RFC] [--workers N] [--forzar] [--sin-descarga]
+import argparse
+import csv
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ingesta import paquetes_por_ingestar
+from utils import archivos
+from utils.almacen import get_almacen
+from utils.config import load_config
+from utils.metadata import iter_metadata, paquetes_metadata
+from utils.validacion import INVALIDO, NO_VERIFICABLE, VALIDO, validar_paquete
+
+COLUMNAS = ["uuid", "archivo", "estado", "sello", "timbre", "metadata", "rfc_emisor", "rfc_receptor", "detalle"]
+
+
+def reportes_dir(config):
+    return (config.get("validacion") or {}).get("dir") or os.path.join(config["base_path"], "validacion")
+
+
+def cargar_metadata(config):
+    # UUID → (RfcEmisor, RfcReceptor) de todos los paquetes de metadata del cliente
+    rfcs = {}
+    for zip_path in paquetes_metadata(config["base_path"]):
+        for fila in iter_metadata(zip_path):
+            rfcs[fila["Uuid"].upper()] = (fila.get("RfcEmisor"), fila.get("RfcReceptor"))
+    return rfcs
+
+
+def cruzar(resultado, metadata):
+    # Agrega "metadata" (coincide, difiere, sin_metadata) y el "estado" final del CFDI
+    esperado = metadata.get(resultado["uuid"] or "")
+    if esperado is None:
+        resultado["metadata"] = "sin_metadata"
+    elif esperado == (resultado["rfc_emisor"], resultado["rfc_receptor"]):
+        resultado["metadata"] = "coincide"
+    else:
+        resultado["metadata"] = "difiere"
+        resultado["detalle"].append(f"metadata: emisor {esperado[0]}, receptor {esperado[1]}")
+
+    verificaciones = (resultado["sello"], resultado["timbre"])
+    if INVALIDO in verificaciones or resultado["metadata"] == "difiere":
+        resultado["estado"] = INVALIDO
+    elif NO_VERIFICABLE in verificaciones:
+        resultado["estado"] = NO_VERIFICABLE
+    else:
+        resultado["estado"] = VALIDO
+    return resultado
+
+
+def escribir_reporte(path, resultados):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=COLUMNAS, extrasaction="ignore", lineterminator="\n")
+    writer.writeheader()
+    for r in resultados:
+        writer.writerow(dict(r, detalle="; ".join(r["detalle"])))
+    archivos.escribir_atomico(path, buf.getvalue())
+
+
+def validar(config, workers=None, forzar=False, descargar=True):
+    destino = reportes_dir(config)
+    pendientes = {p: ruta for p, ruta in paquetes_por_ingestar(config).items()
+                  if forzar or not os.path.exists(os.path.join(destino, f"{p}.csv"))}
+    if not pendientes:
+        print("No hay paquetes nuevos por validar.")
+        return {}
+
+    opciones = dict(config.get("validacion") or {}, descargar=descargar)
+    opciones.setdefault("certificados", "certificados_sat")
+    metadata = cargar_metadata(config)
+    almacen = get_almacen(config)
+    almacen_dir = almacen.directorio if almacen is not None else None
+
+    print(f"Paquetes por validar: {len(pendientes)} (metadata de {len(metadata)} UUID)")
+    inicio = time.perf_counter()
+    resumen = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futuros = {pool.submit(validar_paquete, p, ruta, almacen_dir, opciones): p for p, ruta in pendientes.items()}
+        for futuro in as_completed(futuros):
+            try:
+                id_paquete, resultados = futuro.result()
+            except Exception as e:
+                print(f"✗ Error al validar {futuros[futuro]}: {e}")
+                continue
+            resultados = [cruzar(r, metadata) for r in resultados]
+            escribir_reporte(os.path.join(destino, f"{id_paquete}.csv"), resultados)
+            conteo = {e: sum(r["estado"] == e for r in resultados) for e in (VALIDO, INVALIDO, NO_VERIFICABLE)}
+            resumen[id_paquete] = conteo
+            marca = "✗" if conteo[INVALIDO] else "✓"
+            print(f"{marca} {id_paquete}: {conteo[VALIDO]} válidos, {conteo[INVALIDO]} inválidos, "
+                  f"{conteo[NO_VERIFICABLE]} sin verificar")
+            for r in resultados:
+                if r["estado"] == INVALIDO:
+                    print(f"  (⚠) {r['archivo']}: {'; '.join(r['detalle'])}")
+
+    total = sum(sum(c.values()) for c in resumen.values())
+    segundos = time.perf_counter() - inicio
+    print(f"\n✓ {total} CFDI en {segundos:.1f}s ({total / segundos * 60:,.0f} por minuto) → {destino}")
+    return resumen
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validación de sello y timbre de los CFDI descargados")
+    parser.add_argument("--rfc", help="Cliente (por defecto cliente_rfc de config.yml)")
+    parser.add_argument("--workers", type=int, help="Procesos (por defecto uno por núcleo)")
+    parser.add_argument("--forzar", action="store_true", help="Volver a validar paquetes con reporte")
+    parser.add_argument("--sin-descarga", action="store_true",
+                        help="No descargar certificados del SAT que no estén en validacion.certificados")
+    args = parser.parse_args()
+
+    print("=== Validación de CFDIs ===")
+    validar(load_config(args.rfc), args.workers, args.forzar, not args.sin_descarga)
+
+
+if __name__ == "__main__":
+    main()